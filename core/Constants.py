@@ -55,10 +55,23 @@ TITLE = 'Actually Working Game II'  # window name
 DEBUG = False
 
 
+# PROFILER (utils.profiler)
+PROFILER_ENABLED = False  # state on start, toggled in game with K_PROFILER
+PROFILER_FRAMES = 1024  # frames in ring buffer for percentiles
+PROFILER_MAX_STAGES = 64
+PROFILER_TRACE_EVENTS = 2 ** 16  # last timed scopes kept for Chrome trace
+PROFILER_GPU_FRAMES = 3  # frames of GPU timer queries in flight, results are read this many frames later
+
+
+# ASSETS (utils.assets)
+ASSET_WORKERS = 4  # threads decoding assets
+ASSET_UPLOAD_BUDGET = 0.004  # s per frame spent on GL / AL uploads while assets load in background
+
+
 # FPS
 FPS_LOCK = 60  # Do not set more than 60. Game only optimized for <=60
 FPS_SHOW = False  # Display FPS counter in console
-PHYSIC_UPDATE_FREQUENCY = 1 / 60  # optimal with FPS_LOCK==60
+PHYSIC_UPDATE_FREQUENCY = 1 / 60  # fixed physic step, simulation rate does not depend on FPS
 
 
 # FONT
@@ -87,7 +100,15 @@ FOV: float = 1.0  # multiplier of screen size
 # PHYSICS
 GRAVITY_VECTOR = (0, -2000)
 SLEEP_TIME_THRESHOLD = 0.3
-MAX_PHYSIC_STEP = 1 / 60
+MAX_PHYSIC_SUBSTEPS = 5  # physic steps per frame at most, the rest of frame time is dropped
+PHYSIC_SNAPSHOT_SIZE = 2 ** 10  # initial rows of World snapshot arrays. Grows if needed
+
+
+# LEVEL STREAMING
+LEVEL_CHUNK_SIZE = TILE_SIZE * 32  # units, if map does not define its own "chunk_size"
+LEVEL_STREAM_RADIUS = 1  # chunks around camera field that are kept loaded
+LEVEL_SUMMON_BUDGET = 32  # objects created per frame
+LEVEL_TEARDOWN_BUDGET = 32  # objects deleted per frame
 
 
 # BODY TYPES
@@ -102,13 +123,45 @@ BODY_TYPES = {
 AMBIENT_LIGHT = 1.0  # default: 1.0
 LIGHT_MULTIPLY = 1.0  # default: 1.0
 MAX_LIGHT_SOURCES = 2 ** 10
+LIGHT_GROUP_CAPACITY = 16  # rows of packed light arrays of one texture allocated at first, doubled when full
 LIGHT_POWER_UNIT = 8
+LIGHT_TILED = False  # lights are binned into screen tiles and summed in one full-screen pass per texture set
+LIGHT_TILE_SIZE = 32  # px of light buffer
+LIGHT_BUFFER_SCALE = 2  # light buffer is 1 / LIGHT_BUFFER_SCALE of window resolution: 1, 2 or 4
+LIGHT_BUFFER_HDR = True  # light buffer is RGBA16F, overlapping lights are not clipped at 1.0
+LIGHT_BUFFER_RESOLUTION = tuple(max(1, x // LIGHT_BUFFER_SCALE) for x in STN_WINDOW_RESOLUTION)
+LIGHT_UPSAMPLE_DEPTH = 0.01  # depth difference at which light texel weight halves when light buffer is upsampled
+
+# SHADOWS
+SHADOWS_ENABLED = True  # static level rectangles cast shadows of lights
+SHADOW_MAP_RESOLUTION = 256  # rays of 1D shadow map of one light
+SHADOW_MAX_LIGHTS = 256  # rows of shadow map texture, lights with shadows in camera field at once
+SHADOW_SOFTNESS = 6.0  # units behind occluder over which shadow fades in
+SHADOW_CHANGES_KEPT = 64  # occluder changes remembered for invalidation of cached shadow maps
 
 # RENDER
-MAX_INSTANCES = 128
-MAX_TEXTURES_BIND = 32
-MAX_TEXTURE_3D_LAYERS = 2048
+MAX_INSTANCES = 2 ** 14  # instances in one draw call. Bigger batches are split
+MAX_TEXTURES_BIND = 32  # texture units in one draw call. Bigger batches are split
 MATERIAL_SIZE = TILE_SIZE
+MATERIAL_MIN_LAYERS = 4  # layers of material array allocated at first, it is doubled when full
+MATERIAL_COMPRESSED = False  # material array is stored in compressed format chosen by driver
+SPATIAL_CELL_SIZE = TILE_SIZE * 16  # cell of static objects culling grid, units
+
+# TEXTURE ATLAS
+ATLAS_PAGE_SIZE = 2048  # px, max width and height of atlas page
+ATLAS_PADDING = 2  # px of repeated edge pixels around each texture on atlas page
+ATLAS_EXCLUDE = ('Light', )  # directories of texture pack, which textures keep their own GL texture and are loaded on demand
+
+
+# TEXTURE RESIDENCY (textures out of atlas, see TextureStorage)
+TEXTURE_VRAM_BUDGET = 256 * 2 ** 20  # bytes of textures loaded on demand, unused ones are evicted above it
+TEXTURE_EVICT_FRAMES = 600  # frames texture must be unused to be evicted
+TEXTURE_PLACEHOLDER = (0, 0, 0, 0)  # RGBA of 1x1 image drawn while texture is not loaded
+
+# STREAMING (per-frame vertex data)
+STREAM_BUFFER_SIZE = 2 ** 22  # bytes in one segment of ring buffer
+STREAM_BUFFER_SEGMENTS = 3  # frames in flight
+STREAM_BUFFER_PERSISTENT = True  # use persistent mapping if GL 4.4 is available
 
 # OPENGL FLAGS
 GL_ERROR_CHECKING = False
@@ -1,12 +1,15 @@
 from openal import *
 
 from utils.files import get_full_path
+from utils.assets import AssetJob, MainAssetPipeline
 from utils.debug import dprint
+from utils.profiler import profiled
 from core.math.prandom import randf
 from core.Constants import \
     STN_MASTER_VOLUME, STN_GAME_VOLUME, STN_MUSIC_VOLUME, STN_SOUND_PACK, MAX_SOUND_SOURCES
 
 from pyogg import VorbisFile
+from functools import partial
 from os.path import join, splitext
 from os import listdir
 
@@ -60,6 +63,7 @@ class AudioManager:
         self.buffers = {}
         oalQuit()
 
+    @profiled("audio.streams")
     def update_streams(self, dt):
         for key, [stream, sound, loop] in self.streams.items():
             if stream:
@@ -104,14 +108,15 @@ class AudioManager:
 
     # BUFFERS
     def load_sound(self, path: str, name: str):
+        self.upload_sound(name, decodeSound(path))
+
+    def upload_sound(self, name: str, data):
+        """<data> of decodeSound, must be called on main thread"""
         buffer = ctypes.c_uint()
         alGenBuffers(1, ctypes.pointer(buffer))
 
-        ops = VorbisFile(path)
-        data = soundData(ops)
         alBufferData(buffer, *data)
         self.buffers[name] = buffer.value
-        del ops
 
         dprint(f'<Sound[{buffer.value}]\tsize: {data[2].value}\tname:{name}>')
 
@@ -121,7 +126,8 @@ class AudioManager:
         pos3f = gamePosToSoundPos(pos3f)
         vel3f = gamePosToSoundPos(vel3f)
 
-        if not self.free_ids:
+        # sound pack could be still loading
+        if not self.free_ids or sound not in self.buffers:
             return
 
         source = self.free_ids.pop()
@@ -165,6 +171,12 @@ class AudioManager:
         self.streams_fade[stream] = [fade, fade]
 
 
+def decodeSound(path: str):
+    """Decodes whole .ogg file, no AL calls, can be called from worker thread
+    :returns args of alBufferData"""
+    return soundData(VorbisFile(path))
+
+
 def soundData(py_ogg_file: VorbisFile):
     file = py_ogg_file
     channels = AL_FORMAT_MONO16 if file.channels == 1 else AL_FORMAT_STEREO16
@@ -173,23 +185,27 @@ def soundData(py_ogg_file: VorbisFile):
     return [channels, file.buffer, length, freq]
 
 
-def loadSoundPack(name):
+def loadSoundPack(name) -> AssetJob:
+    """Sounds are decoded in MainAssetPipeline workers and uploaded while it is drained,
+    streamed music is only listed, so it can be played at once"""
     print(f'\n-- loading Sound Pack: {name}')
 
-    # SOUNDS [LOAD]
-    path = get_full_path(join(name, 'sound'), file_type='snd')
-    files = listdir(path)
-    for file in files:
-        AudioManagerSingleton.load_sound(path=join(path, file), name=splitext(file)[-2])
-
     # SOUNDS [STREAM]
     path = get_full_path(join(name, 'music'), file_type='snd')
     files = listdir(path)
     for file in files:
         AudioManagerSingleton.ambient_paths[splitext(file)[-2]] = join(path, file)
 
-    dprint(f'-- Done.\n')
-    
+    # SOUNDS [LOAD]
+    path = get_full_path(join(name, 'sound'), file_type='snd')
+    files = listdir(path)
+    return MainAssetPipeline.job(
+        'sounds', [(partial(decodeSound, join(path, file)), partial(AudioManagerSingleton.upload_sound,
+                                                                  splitext(file)[-2])) for file in files],
+        lambda: dprint(f'-- Done.\n')
+    )
+
+
 
 def gamePosToSoundPos(pos):
     if len(pos) == 3:
@@ -198,4 +214,10 @@ def gamePosToSoundPos(pos):
 
 
 AudioManagerSingleton = AudioManager()
-loadSoundPack(STN_SOUND_PACK)
+
+
+def loadSounds(wait=True):
+    """If not <wait>, sounds are loaded while MainAssetPipeline is drained"""
+    job = loadSoundPack(STN_SOUND_PACK)
+    if wait:
+        MainAssetPipeline.wait(job.name)
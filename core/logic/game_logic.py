@@ -1,4 +1,16 @@
-from utils.files import load_map
+from core.logic.level_format import openMap
+from core.objects.gObjects import summon, bakeRects, bakeRectArray, occluderColumns, occluderSegments, \
+    WorldGeometryBaked, BAKED_TYPES, OCCLUDER_TYPES
+from core.rendering.Shadows import MainOccluders
+from core.objects.gObjectTools import deleteObject
+from utils.profiler import profiled
+from core.Constants import LEVEL_CHUNK_SIZE, LEVEL_STREAM_RADIUS, LEVEL_SUMMON_BUDGET, LEVEL_TEARDOWN_BUDGET
+
+from collections import deque
+from queue import Queue, Empty
+from math import floor
+import threading
+import numpy as np
 
 MAX_GAME_CONTEST_IDS = 65_536
 
@@ -16,5 +28,186 @@ class GameContext:
     _to_update_ids: tuple
 
 
-def loadMap():
-    pass
+class LevelStreamer:
+    """Loads and unloads chunks of map around camera.
+
+    Map can be of any format supported by level_format.openMap.
+    Chunk "x.y" covers [x * chunk_size, (x + 1) * chunk_size) area of the map.
+    Reading and decompressing of chunks is done in background thread,
+    objects are summoned and deleted on main thread, not more than LEVEL_*_BUDGET of them per frame.
+
+    Loaded chunk is kept while bounds of its objects intersect streaming area,
+    so big objects do not disappear when camera leaves chunk they are stored in.
+
+    If baked_group is given, level rectangles of chunk are merged into one WorldGeometryBaked.
+    Edges of level rectangles of loaded chunks are kept in MainOccluders for shadows"""
+
+    def __init__(self, name: str, groups: dict, baked_group=None):
+        """groups:: maps group names used in map ("world_gr") to RenderUpdateGroups"""
+        self.name = name
+        self.map = openMap(name)
+        self.header = self.map.header
+        self.groups = groups
+        self.baked_group = baked_group
+        self.chunk_size = self.header.get("chunk_size", LEVEL_CHUNK_SIZE)
+
+        self.loaded = {}
+        """::keys       chunk key
+        ::values     list of summoned objects"""
+        self.bounds = {}
+        """::keys       chunk key
+        ::values     [l, b, r, t] of chunk and its objects"""
+        self.pending = set()  # chunk keys that are loading in background
+        self.summoning = deque()  # (chunk key, (type, args, kwargs) or baked parts)
+        self.teardown = deque()  # objects to delete
+
+        self.__requests = Queue()
+        self.__results = Queue()
+        self.__worker = threading.Thread(target=self.__work, name=f"LevelStreamer({name})", daemon=True)
+        self.__worker.start()
+
+    def __work(self):
+        # background thread
+        while True:
+            key = self.__requests.get()
+            if key is None:
+                return
+            try:
+                chunk = self.__load(key)
+            except Exception as e:
+                chunk = e
+            self.__results.put((key, chunk))
+
+    def __load(self, key):
+        # rects of .bmap are used as columns, entries of other formats and spawns are (type, args, kwargs)
+        map_ = self.map
+        rects, entries, bounds = map_.load_chunk(key, self.chunk_size)
+
+        occluders = rects[map_.type_mask(rects, OCCLUDER_TYPES)]
+        segments = np.concatenate((
+            occluderSegments(occluders['pos'], occluders['size']), occluderSegments(*occluderColumns(entries))
+        ))
+        if self.baked_group is None:
+            return map_.rect_entries(rects) + entries, bounds, segments
+
+        baked = map_.type_mask(rects, BAKED_TYPES)
+        parts, entries = bakeRects(entries)
+        parts = np.concatenate((bakeRectArray(rects[baked], map_.types, map_.materials), parts))
+        entries = map_.rect_entries(rects[~baked]) + entries
+        if len(parts):
+            entries.insert(0, parts)
+        return entries, bounds, segments
+
+    @property
+    def start_chunk(self):
+        return self.header.get("start_chunk", "0.0")
+
+    def chunk_key(self, x, y) -> str:
+        return f"{floor(x / self.chunk_size)}.{floor(y / self.chunk_size)}"
+
+    def chunks_in(self, l_, b, r, t):
+        size = self.chunk_size
+        for x in range(floor(l_ / size), floor(r / size) + 1):
+            for y in range(floor(b / size), floor(t / size) + 1):
+                yield f"{x}.{y}"
+
+    # LOADING
+    def load_now(self, key: str):
+        """Loads and summons whole chunk synchronously, e.g. start chunk"""
+        if key in self.loaded or key not in self.header["chunks"]:
+            return
+        self.pending.discard(key)
+        self.__loaded(key, self.__load(key))
+        self.__summon(len(self.summoning))
+
+    def __loaded(self, key, chunk):
+        entries, bounds, segments = chunk
+        self.loaded[key] = []
+        self.bounds[key] = bounds
+        MainOccluders.add(key, segments)
+        self.summoning.extend((key, entry) for entry in entries)
+
+    def __summon(self, budget):
+        while self.summoning and budget > 0:
+            key, entry = self.summoning.popleft()
+            budget -= 1
+
+            if isinstance(entry, np.ndarray):
+                self.loaded[key].append(WorldGeometryBaked(self.baked_group, entry))
+                continue
+
+            type_, args, kwargs = entry
+            args = [self.groups.get(arg, arg) if isinstance(arg, str) else arg for arg in args]
+            self.loaded[key].append(summon(type_, *args, **kwargs))
+
+    # UNLOADING
+    def unload(self, key: str):
+        """Chunk objects are deleted later, in teardown"""
+        self.teardown.extend(self.loaded.pop(key))
+        del self.bounds[key]
+        MainOccluders.remove(key)
+        if any(k == key for k, _ in self.summoning):
+            self.summoning = deque(item for item in self.summoning if item[0] != key)
+
+    def __teardown(self, budget):
+        while self.teardown and budget > 0:
+            deleteObject(self.teardown.popleft())
+            budget -= 1
+
+    # UPDATE
+    @profiled("level.streaming")
+    def update(self, camera):
+        """Called every frame on main thread"""
+        l_, r, b, t = camera.ortho_params
+        margin = self.chunk_size * LEVEL_STREAM_RADIUS
+        l_, b, r, t = l_ - margin, b - margin, r + margin, t + margin
+
+        # request chunks near camera
+        chunks = self.header["chunks"]
+        for key in self.chunks_in(l_, b, r, t):
+            if key in chunks and key not in self.loaded and key not in self.pending:
+                self.pending.add(key)
+                self.__requests.put(key)
+
+        # receive loaded chunks
+        while True:
+            try:
+                key, chunk = self.__results.get_nowait()
+            except Empty:
+                break
+            if key not in self.pending:
+                continue  # loaded synchronously in the meantime
+            self.pending.discard(key)
+            if isinstance(chunk, Exception):
+                raise chunk
+            self.__loaded(key, chunk)
+
+        self.__summon(LEVEL_SUMMON_BUDGET)
+
+        # unload far chunks, half of chunk more than streaming area to avoid loading back and forth
+        margin = self.chunk_size / 2
+        l_, b, r, t = l_ - margin, b - margin, r + margin, t + margin
+        for key, (bl, bb, br, bt) in list(self.bounds.items()):
+            if br < l_ or bl > r or bt < b or bb > t:
+                self.unload(key)
+
+        self.__teardown(LEVEL_TEARDOWN_BUDGET)
+
+    def close(self):
+        """Stops background thread. Objects must be deleted by their groups"""
+        self.__requests.put(None)
+        self.__worker.join()
+        self.map.close()
+        for key in self.loaded:
+            MainOccluders.remove(key)
+        self.loaded.clear()
+        self.bounds.clear()
+        self.pending.clear()
+        self.summoning.clear()
+        self.teardown.clear()
+
+
+def loadMap(name: str, groups: dict, baked_group=None) -> LevelStreamer:
+    streamer = LevelStreamer(name, groups, baked_group)
+    streamer.load_now(streamer.start_chunk)
+    return streamer
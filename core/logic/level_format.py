@@ -0,0 +1,288 @@
+"""
+Level files
+
+.json / .lvl    object entries, see utils.files.load_map
+.bmap           binary map, arrays are used straight from memory mapped file:
+
+    magic       b"BMAP"
+    version     uint32
+    meta size   uint32
+    meta        utf-8 json: map header without "chunks" and
+                    "types", "materials", "groups"  string tables used by arrays
+                    "params"                        extra args and kwargs of spawns
+                    "chunk_keys"                    keys of chunks in chunk table order
+                    "offsets"                       byte offsets of chunks, rects, spawns arrays
+    chunks      CHUNK_DTYPE[len(chunk_keys)]
+    rects       RECT_DTYPE[]    static geometry, ordered by chunk
+    spawns      SPAWN_DTYPE[]   other entities, ordered by chunk
+"""
+
+import numpy as np
+import struct
+import mmap
+import json
+import sys
+
+from utils.files import load_map, load_map_chunk, get_full_path
+
+
+__all__ = [
+    'CHUNK_DTYPE',
+    'RECT_DTYPE',
+    'SPAWN_DTYPE',
+    'RECT_TYPES',
+    'EntriesMap',
+    'BinaryMap',
+    'openMap',
+    'convertMap'
+]
+
+
+MAGIC = b"BMAP"
+VERSION = 1
+ALIGN = 16
+NO_GROUP = 0xFFFF
+
+CHUNK_DTYPE = np.dtype([
+    ('x', '<i4'), ('y', '<i4'),
+    ('rects_first', '<u4'), ('rects_count', '<u4'),
+    ('spawns_first', '<u4'), ('spawns_count', '<u4'),
+])
+RECT_DTYPE = np.dtype([
+    ('pos', '<f4', (2,)), ('size', '<f4', (2,)),
+    ('type', '<u2'), ('material', '<u2'), ('group', '<u2'), ('layer', 'u1'), ('_pad', 'u1'),
+])
+SPAWN_DTYPE = np.dtype([
+    ('pos', '<f4', (2,)), ('type', '<u2'), ('group', '<u2'), ('params', '<u4'),
+])
+
+RECT_TYPES = ('WorldRectangleRigid', 'WorldRectangleRigidTrue', 'WorldRectangleSensor')
+"""Entries of these types are stored as RECT_DTYPE if they only have pos, size, material, layer"""
+RECT_KWARGS = {'pos', 'size', 'material', 'layer'}
+RECT_DEFAULT_LAYER = 4
+
+
+def _chunkRect(key: str, chunk_size) -> list:
+    x, y = (int(v) * chunk_size for v in key.split("."))
+    return [x, y, x + chunk_size, y + chunk_size]
+
+
+class EntriesMap:
+    """Map stored as object entries (.json, .lvl)"""
+    types = materials = groups = ()
+
+    def __init__(self, name):
+        self.name = name
+        self.header = load_map(name)
+
+    @property
+    def chunk_keys(self):
+        return self.header["chunks"].keys()
+
+    def load_chunk(self, key: str, chunk_size) -> tuple:
+        """Safe to call from background thread
+        :returns (empty RECT_DTYPE array, list of (type, args, kwargs), [l, b, r, t] bounds of chunk and its objects)
+            all objects of entries map are entries"""
+        entries = [
+            (e["type"], e.get("args", ()), e.get("kwargs", {}))
+            for e in load_map_chunk(self.name, self.header, key)
+        ]
+
+        bounds = _chunkRect(key, chunk_size)
+        for _, _, kwargs in entries:
+            if "pos" in kwargs:
+                x, y = kwargs["pos"]
+                w, h = kwargs.get("size", (0, 0))
+                bounds[0], bounds[1] = min(bounds[0], x - w / 2), min(bounds[1], y - h / 2)
+                bounds[2], bounds[3] = max(bounds[2], x + w / 2), max(bounds[3], y + h / 2)
+        return np.empty(0, dtype=RECT_DTYPE), entries, bounds
+
+    @staticmethod
+    def rect_entries(rects: np.ndarray) -> list:
+        return []
+
+    @staticmethod
+    def type_mask(rects: np.ndarray, names) -> np.ndarray:
+        return np.zeros(len(rects), dtype=bool)
+
+    def close(self):
+        pass
+
+
+class BinaryMap:
+    """Map stored as .bmap. Arrays are views of memory mapped file, nothing is copied while loading"""
+
+    def __init__(self, name):
+        self.name = name
+        self.__file = open(get_full_path(name, file_type='maps'), mode="rb")
+        self.__mm = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, meta_size = struct.unpack_from("<4sII", self.__mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{name} is not a .bmap file of version {VERSION}")
+
+        meta = json.loads(self.__mm[12: 12 + meta_size])
+        self.types = meta.pop("types")
+        self.materials = meta.pop("materials")
+        self.groups = meta.pop("groups")
+        self.params = meta.pop("params")
+        keys = meta.pop("chunk_keys")
+        offsets = meta.pop("offsets")
+
+        self.chunks = self.__array(CHUNK_DTYPE, offsets["chunks"], len(keys))
+        self.rects = self.__array(RECT_DTYPE, offsets["rects"], offsets["rects_count"])
+        self.spawns = self.__array(SPAWN_DTYPE, offsets["spawns"], offsets["spawns_count"])
+
+        self.header = meta
+        self.header["chunks"] = {key: i for i, key in enumerate(keys)}
+
+    def __array(self, dtype, offset, count) -> np.ndarray:
+        if not count:
+            return np.empty(0, dtype=dtype)
+        return np.frombuffer(self.__mm, dtype=dtype, count=count, offset=offset)
+
+    @property
+    def chunk_keys(self):
+        return self.header["chunks"].keys()
+
+    def chunk_arrays(self, key: str) -> tuple:
+        """:returns (rects, spawns) of chunk, views of mapped file"""
+        c = self.chunks[self.header["chunks"][key]]
+        first, count = int(c['rects_first']), int(c['rects_count'])
+        rects = self.rects[first: first + count]
+        first, count = int(c['spawns_first']), int(c['spawns_count'])
+        return rects, self.spawns[first: first + count]
+
+    def load_chunk(self, key: str, chunk_size) -> tuple:
+        """Safe to call from background thread
+        :returns (rects, list of (type, args, kwargs) of spawns, [l, b, r, t] bounds of chunk and its objects)
+            rects is RECT_DTYPE view of mapped file, "type", "material" and "group" columns
+            index self.types, self.materials and self.groups"""
+        rects, spawns = self.chunk_arrays(key)
+        types, groups = self.types, self.groups
+        entries = []
+
+        for s in spawns.tolist():
+            pos, type_, group, params = s
+            params = self.params[params]
+            args = ((groups[group], ) if group != NO_GROUP else ()) + tuple(params["args"])
+            entries.append((types[type_], args, {"pos": [float(v) for v in pos], **params["kwargs"]}))
+
+        # bounds are computed on arrays, it also pages chunk data in while in background thread
+        bounds = _chunkRect(key, chunk_size)
+        if len(rects):
+            half = rects['size'] / 2
+            low, high = (rects['pos'] - half).min(axis=0), (rects['pos'] + half).max(axis=0)
+            bounds = [min(bounds[0], low[0]), min(bounds[1], low[1]),
+                      max(bounds[2], high[0]), max(bounds[3], high[1])]
+        if len(spawns):
+            low, high = spawns['pos'].min(axis=0), spawns['pos'].max(axis=0)
+            bounds = [min(bounds[0], low[0]), min(bounds[1], low[1]),
+                      max(bounds[2], high[0]), max(bounds[3], high[1])]
+        return rects, entries, [float(b) for b in bounds]
+
+    def type_mask(self, rects: np.ndarray, names) -> np.ndarray:
+        """:returns bool mask of rects of given type names"""
+        return np.isin(rects['type'], [i for i, type_ in enumerate(self.types) if type_ in names])
+
+    def rect_entries(self, rects: np.ndarray) -> list:
+        """:returns (type, args, kwargs) entries of rects, for objects summoned one by one"""
+        types, groups, materials = self.types, self.groups, self.materials
+        return [
+            (types[type_], (groups[group], ) if group != NO_GROUP else (None, ),
+             {"pos": pos, "size": size, "material": materials[material], "layer": layer})
+            for pos, size, type_, material, group, layer in zip(
+                rects['pos'].tolist(), rects['size'].tolist(), rects['type'].tolist(),
+                rects['material'].tolist(), rects['group'].tolist(), rects['layer'].tolist()
+            )
+        ]
+
+    def close(self):
+        # views must be released before mmap is closed,
+        # if arrays returned by load_chunk are still referenced, unmap is left to GC
+        self.chunks = self.rects = self.spawns = None
+        try:
+            self.__mm.close()
+        except BufferError:
+            pass
+        self.__file.close()
+
+
+def openMap(name: str):
+    if name.endswith(".bmap"):
+        return BinaryMap(name)
+    return EntriesMap(name)
+
+
+# CONVERTER
+def convertMap(source: str, target: str):
+    """Converts .json or .lvl map to .bmap"""
+    src = EntriesMap(source)
+    meta = {k: v for k, v in src.header.items() if k not in ("chunks", "data_offset")}
+
+    tables = {"types": [], "materials": [], "groups": []}
+
+    def index(table, value):
+        values = tables[table]
+        if value not in values:
+            values.append(value)
+        return values.index(value)
+
+    def group(args):
+        return index("groups", args[0]) if args and isinstance(args[0], str) else NO_GROUP
+
+    params = []
+    keys = list(src.chunk_keys)
+    chunks = np.zeros(len(keys), dtype=CHUNK_DTYPE)
+    rects, spawns = [], []
+
+    for i, key in enumerate(keys):
+        chunks[i]['x'], chunks[i]['y'] = (int(v) for v in key.split("."))
+        chunks[i]['rects_first'], chunks[i]['spawns_first'] = len(rects), len(spawns)
+
+        for e in load_map_chunk(source, src.header, key):
+            type_, args, kwargs = e["type"], list(e.get("args", ())), dict(e.get("kwargs", {}))
+
+            if type_ in RECT_TYPES and len(args) <= 1 and set(kwargs) <= RECT_KWARGS and "size" in kwargs:
+                rects.append((
+                    kwargs["pos"], kwargs["size"], index("types", type_),
+                    index("materials", list(kwargs["material"])), group(args),
+                    kwargs.get("layer", RECT_DEFAULT_LAYER), 0
+                ))
+                continue
+
+            pos = kwargs.pop("pos", (0, 0))
+            gr = group(args)
+            params.append({"args": args[1:] if gr != NO_GROUP else args, "kwargs": kwargs})
+            spawns.append((pos, index("types", type_), gr, len(params) - 1))
+
+        chunks[i]['rects_count'] = len(rects) - chunks[i]['rects_first']
+        chunks[i]['spawns_count'] = len(spawns) - chunks[i]['spawns_first']
+
+    rects = np.array(rects, dtype=RECT_DTYPE)
+    spawns = np.array(spawns, dtype=SPAWN_DTYPE)
+
+    def aligned(n):
+        return (n + ALIGN - 1) // ALIGN * ALIGN
+
+    # offsets depend on meta size, meta contains offsets. Meta is padded to fixed size after first pass
+    meta.update(tables, params=params, chunk_keys=keys, offsets={})
+    meta_size = aligned(len(json.dumps(meta).encode()) + 128)
+    offsets = {"chunks": aligned(12 + meta_size)}
+    offsets["rects"] = aligned(offsets["chunks"] + chunks.nbytes)
+    offsets["spawns"] = aligned(offsets["rects"] + rects.nbytes)
+    offsets["rects_count"], offsets["spawns_count"] = len(rects), len(spawns)
+    meta["offsets"] = offsets
+    meta_bytes = json.dumps(meta).encode().ljust(meta_size)
+
+    with open(get_full_path(target, file_type='maps'), mode="wb") as file:
+        file.write(struct.pack("<4sII", MAGIC, VERSION, meta_size))
+        file.write(meta_bytes)
+        for name, array in (("chunks", chunks), ("rects", rects), ("spawns", spawns)):
+            file.write(b"\0" * (offsets[name] - file.tell()))
+            file.write(array.tobytes())
+
+
+if __name__ == '__main__':
+    # python -m core.logic.level_format test_map.json test_map.bmap
+    convertMap(*sys.argv[1:3])
@@ -107,3 +107,51 @@ def CachedTransform(
 @beartype
 def TransformMatConstant(camera_matrix: TYPE_MAT, cached: TYPE_MAT) -> TYPE_MAT:
     return np.matmul(camera_matrix, cached)
+
+
+# BATCH TRANSFORM -> FullTransformMat FOR N OBJECTS AT ONCE
+def BatchTransformMat(
+        camera_matrix: TYPE_MAT,
+        pos: np.ndarray,
+        z_rotation: np.ndarray,
+        y_reflect: np.ndarray,
+        scale_xy: np.ndarray,
+        quad: np.ndarray = None
+) -> np.ndarray:
+    """Same as FullTransformMat, but for arrays of params
+    ::arg pos           (N, 2) positions
+    ::arg z_rotation    (N, ) rotations in degrees
+    ::arg y_reflect     (N, ) 1 or -1
+    ::arg scale_xy      (N, 2) scales
+    ::arg quad          (N, 3) width, height and z of objects drawn with unit quad, optional
+    ::returns (N, 4, 4) FLOAT32 matrices = camera @ translate @ rotz @ reflectY @ scale"""
+    a = np.radians(z_rotation)
+    s, c = np.sin(a), np.cos(a)
+    sx = y_reflect * scale_xy[:, 0]
+    sy = scale_xy[:, 1]
+    if quad is not None:
+        sx = sx * quad[:, 0]
+        sy = sy * quad[:, 1]
+
+    local = np.zeros((len(pos), 4, 4), dtype=FLOAT32)
+    local[:, 0, 0] = c * sx
+    local[:, 0, 1] = -s * sy
+    local[:, 1, 0] = s * sx
+    local[:, 1, 1] = c * sy
+    local[:, 0, 3] = pos[:, 0]
+    local[:, 1, 3] = pos[:, 1]
+    local[:, 2, 2] = 1.0
+    local[:, 3, 3] = 1.0
+    if quad is not None:
+        local[:, 2, 3] = quad[:, 2]
+
+    return np.matmul(np.asarray(camera_matrix, dtype=FLOAT32), local)
+
+
+def BatchTransformFromParams(camera_matrix: TYPE_MAT, params: np.ndarray, quad: np.ndarray = None) -> np.ndarray:
+    """::arg params (N, 6) rows of RenderObject.transform_params():
+    x, y, z_rotation, y_reflect, scale_x, scale_y
+    ::arg quad  (N, 3) rows of RenderObject.quad_params, optional"""
+    return BatchTransformMat(
+        camera_matrix, params[:, 0:2], params[:, 2], params[:, 3], params[:, 4:6], quad
+    )
@@ -0,0 +1,184 @@
+import numpy as np
+from math import floor
+from core.Constants import SPATIAL_CELL_SIZE
+
+
+__all__ = [
+    'SpatialHash',
+    'cullCircles',
+    'binCircles',
+    'rectSegments',
+    'segmentsInRect',
+    'rectsContaining',
+    'shadowMap1D'
+]
+
+
+class SpatialHash:
+    """Uniform grid of SPATIAL_CELL_SIZE cells.
+    Stores integer keys with their axis aligned bounds, one key can cover several cells.
+    Used for objects that do not move, query() returns keys that may intersect given bounds"""
+    __slots__ = ('cell', 'cells', 'bounds')
+
+    def __init__(self, cell: float = SPATIAL_CELL_SIZE):
+        self.cell = cell
+        self.cells = {}
+        """::keys       (cx, cy)
+        ::values     set of keys"""
+        self.bounds = {}
+        """::keys       key
+        ::values     (cx0, cy0, cx1, cy1) covered cells"""
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def _cell_range(self, x0, y0, x1, y1):
+        c = self.cell
+        return floor(x0 / c), floor(y0 / c), floor(x1 / c), floor(y1 / c)
+
+    def insert(self, key: int, x0, y0, x1, y1):
+        if key in self.bounds:
+            self.remove(key)
+
+        cx0, cy0, cx1, cy1 = bounds = self._cell_range(x0, y0, x1, y1)
+        self.bounds[key] = bounds
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                self.cells.setdefault((cx, cy), set()).add(key)
+
+    def remove(self, key: int):
+        cx0, cy0, cx1, cy1 = self.bounds.pop(key)
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                cell = self.cells[cx, cy]
+                cell.discard(key)
+                if not cell:
+                    del self.cells[cx, cy]
+
+    def clear(self):
+        self.cells.clear()
+        self.bounds.clear()
+
+    def query(self, x0, y0, x1, y1) -> np.ndarray:
+        """:returns sorted unique keys from all cells intersecting given bounds"""
+        cx0, cy0, cx1, cy1 = self._cell_range(x0, y0, x1, y1)
+        cells = self.cells
+        found = set()
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                cell = cells.get((cx, cy))
+                if cell:
+                    found |= cell
+
+        keys = np.fromiter(found, dtype=np.intp, count=len(found))
+        keys.sort()
+        return keys
+
+
+def cullCircles(positions: np.ndarray, radii: np.ndarray, ortho_params) -> np.ndarray:
+    """Vectorized visibility test of bounding circles against camera field
+    ortho_params: (left, right, bottom, top)
+    :returns bool mask of circles that intersect the field"""
+    l_, r, b, t = ortho_params
+    x, y = positions[:, 0], positions[:, 1]
+    return (x + radii >= l_) & (x - radii <= r) & (y + radii >= b) & (y - radii <= t)
+
+
+def binCircles(positions: np.ndarray, radii: np.ndarray, ortho_params, tiles_x: int, tiles_y: int):
+    """Assigns bounding circles to tiles of camera field split into tiles_x * tiles_y grid, vectorized.
+    Circle is assigned to every tile its bounding box covers, circles out of the field must be culled before
+    :returns (tiles (tiles_x * tiles_y, 2) uint32 offset and count of tile in indices,
+              indices uint32 circle indices sorted by tile)"""
+    l_, r, b, t = ortho_params
+    sx, sy = tiles_x / (r - l_), tiles_y / (t - b)
+    x, y = positions[:, 0], positions[:, 1]
+    x0 = np.clip(np.floor((x - radii - l_) * sx), 0, tiles_x - 1).astype(np.int64)
+    x1 = np.clip(np.floor((x + radii - l_) * sx), 0, tiles_x - 1).astype(np.int64)
+    y0 = np.clip(np.floor((y - radii - b) * sy), 0, tiles_y - 1).astype(np.int64)
+    y1 = np.clip(np.floor((y + radii - b) * sy), 0, tiles_y - 1).astype(np.int64)
+
+    # one (tile, circle) pair for every covered tile
+    w = x1 - x0 + 1
+    counts = w * (y1 - y0 + 1)
+    circle = np.repeat(np.arange(len(positions)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    tile = (y0[circle] + local // w[circle]) * tiles_x + x0[circle] + local % w[circle]
+
+    per_tile = np.bincount(tile, minlength=tiles_x * tiles_y)
+    tiles = np.empty((tiles_x * tiles_y, 2), dtype=np.uint32)
+    tiles[:, 0] = np.cumsum(per_tile) - per_tile
+    tiles[:, 1] = per_tile
+    return tiles, circle[np.argsort(tile, kind='stable')].astype(np.uint32)
+
+
+def rectSegments(pos: np.ndarray, size: np.ndarray) -> np.ndarray:
+    """Edges of axis aligned rectangles, vectorized
+    ::arg pos   (N, 2) centers
+    ::arg size  (N, 2) width, height
+    :returns (N * 4, 4) FLOAT32 segments x0, y0, x1, y1"""
+    half = np.asarray(size, dtype=np.float32) / 2
+    pos = np.asarray(pos, dtype=np.float32)
+    l_, r = pos[:, 0] - half[:, 0], pos[:, 0] + half[:, 0]
+    b, t = pos[:, 1] - half[:, 1], pos[:, 1] + half[:, 1]
+
+    segments = np.empty((len(pos), 4, 4), dtype=np.float32)
+    segments[:, 0] = np.stack((l_, b, r, b), axis=1)
+    segments[:, 1] = np.stack((r, b, r, t), axis=1)
+    segments[:, 2] = np.stack((r, t, l_, t), axis=1)
+    segments[:, 3] = np.stack((l_, t, l_, b), axis=1)
+    return segments.reshape(-1, 4)
+
+
+def segmentsInRect(segments: np.ndarray, l_, b, r, t) -> np.ndarray:
+    """:returns bool mask of segments which bounding boxes intersect [l_, r] x [b, t]"""
+    x0, y0, x1, y1 = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+    return (np.minimum(x0, x1) <= r) & (np.maximum(x0, x1) >= l_) & \
+           (np.minimum(y0, y1) <= t) & (np.maximum(y0, y1) >= b)
+
+
+def rectsContaining(segments: np.ndarray, point) -> np.ndarray:
+    """::arg segments   edges of rectangles, 4 per rectangle in rectSegments order
+    :returns bool mask of segments, which rectangle contains point"""
+    xs = segments[:, 0::2].reshape(-1, 8)
+    ys = segments[:, 1::2].reshape(-1, 8)
+    x, y = point
+    inside = (xs.min(axis=1) < x) & (x < xs.max(axis=1)) & (ys.min(axis=1) < y) & (y < ys.max(axis=1))
+    return np.repeat(inside, 4)
+
+
+def shadowMap1D(segments: np.ndarray, origin, z_rotation: float, radius: float, resolution: int) -> np.ndarray:
+    """Distance from origin to the far edge of the nearest rectangle along <resolution> rays, vectorized.
+    Shadow starts behind the rectangle, so faces of rectangles turned to light stay lit.
+    Ray i goes at angle -pi + (i + 0.5) * 2pi / resolution in space rotated by z_rotation (degrees),
+    rays that hit nothing get radius
+    ::arg segments  edges of rectangles, 4 per rectangle in rectSegments order, rectangles must not contain origin
+    :returns (resolution, ) FLOAT32 distances"""
+    distances = np.full(resolution, radius, dtype=np.float32)
+    if not len(segments):
+        return distances
+
+    # segments into light space, relative to origin and rotated back
+    a = np.radians(z_rotation)
+    c, s = np.cos(a), np.sin(a)
+    points = segments.reshape(-1, 2) - np.asarray(origin, dtype=np.float32)
+    points = np.stack((points[:, 0] * c + points[:, 1] * s, points[:, 1] * c - points[:, 0] * s), axis=1)
+    points = points.reshape(-1, 4)
+    ax, ay = points[:, 0], points[:, 1]
+    ex, ey = points[:, 2] - ax, points[:, 3] - ay
+
+    angles = -np.pi + (np.arange(resolution) + 0.5) * (2 * np.pi / resolution)
+    dx, dy = np.cos(angles)[:, None], np.sin(angles)[:, None]
+
+    # ray s * d and segment a + t * e meet where s = (a x e) / (d x e), t = (a x d) / (d x e)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denom = dx * ey - dy * ex
+        dist = (ax * ey - ay * ex) / denom
+        t = (ax * dy - ay * dx) / denom
+    hit = (denom != 0) & (dist > 0) & (t >= 0) & (t <= 1)
+
+    # ray leaves rectangle at the farthest hit of its edges
+    far = np.where(hit, dist, -1.0).reshape(resolution, -1, 4).max(axis=2)
+    far = np.where(far < 0.0, radius, far)
+
+    np.minimum(distances, far.min(axis=1), out=distances)
+    return distances
@@ -2,7 +2,7 @@ from pymunk import ShapeFilter
 from core.physic.physics import PhysicObject, Body
 from core.rendering.PyOGL import \
     AnimatedRenderComponent, StaticRenderComponent, RenderObjectComposite,\
-    RenderObjectPhysic, RenderObjectPlaced, MaterialRenderComponent
+    RenderObjectPhysic, RenderObjectPlaced, MaterialRenderComponent, RenderObjectBaked
 from core.rendering.PyOGL_line import drawLine
 from core.Typing import FLOAT32, TYPE_FLOAT, INT64, TYPE_INT, INF, TYPE_NUM
 
@@ -34,6 +34,7 @@ __all__ = [
 
     'RO_Placed',
     'RO_Physic',
+    'RO_Baked',
 
     'Direct',
     'Mortal',
@@ -133,8 +134,13 @@ def deleteObject(obj):
     Slowest deletion method, but universal"""
     if hasattr(obj, 'delete_Mortal'):
         obj.delete_Mortal()
-    if hasattr(obj, 'body'):
+    if hasattr(obj, 'body') and obj.body.snapshot_index != -1:
         PhysicObject.delete_from_physic(obj)
+    if hasattr(obj, 'delete'):
+        obj.delete()
+    if isinstance(obj, InGameObject) and obj._UID:
+        free_render_UIDs.add(obj._UID)
+        obj._UID = 0
 
 
 @beartype
@@ -337,6 +343,7 @@ RC_Material = MaterialRenderComponent
 #  RENDER OBJECTS
 RO_Placed = RenderObjectPlaced
 RO_Physic = RenderObjectPhysic  # requires PhysObject
+RO_Baked = RenderObjectBaked
 
 PhysObject = PhysicObject
 PhysThrowable = PhysicObjectThrowable
@@ -3,7 +3,9 @@ THIS MODUlE CONTAINS ALL GAME OBJECTS THAT CAN BE USED IN GAME (screens.game)
 """
 
 from core.objects.gObjectTools import *
-from core.physic.physics import triggers, reyCastFirst
+from core.physic.physics import triggers, reyCastFirst, MainPhysicSpace, Body, makeShapePolygon
+from core.rendering.PyOGL_utils import zFromLayer
+from core.rendering.Materials import EssentialMaterialStorage as Ems
 from pymunk import PinJoint
 from core.rendering.Textures import EssentialTextureStorage as Ets
 from core.Constants import *
@@ -11,6 +13,8 @@ from core.Typing import FLOAT32, TYPE_MATERIAL, PhysicProperties
 from core.audio.PyOAL import AudioManagerSingleton
 from core.objects.gItems import InventoryAndItemsManager
 from core.math.linear import projectedMovement, degreesFromNormal
+from core.math.spatial import rectSegments
+from utils.debug import dprint
 from core.rendering.Particles import ParticleManager
 
 from pymunk.vec2d import Vec2d
@@ -85,7 +89,7 @@ class WorldRectangleRigid(RO_Physic, RC_Material, PhysObject, Direct):
             self.shape.filter = shape_f
 
 
-class WorldRectangleRigidTrue:
+class WorldRectangleRigidTrue(Direct):
     """Level Rectangle with no friction on side parts"""
 
     def __init__(self, gr, pos, size, material: TYPE_MATERIAL, shape_f=None, layer=4):
@@ -99,12 +103,147 @@ class WorldRectangleRigidTrue:
             gr, pos=[xp, yp + h / 2 - 4], size=[w, 8],
             material=material, shape_f=shape_f, layer=layer)
         top_.visible = True
+        self.parts = (main, top_)
+
+    def delete(self):
+        for part in self.parts:
+            deleteObject(part)
 
 
 class WorldRectangleSensor(WorldRectangleRigid):
     shape_filter = shapeFilter('no_collision', collide_with=())
 
 
+# BAKED WORLD GEOMETRY
+BAKED_TYPES = ('WorldRectangleRigid', 'WorldRectangleRigidTrue')  # sensors are summoned, baked shapes are solid
+BAKED_KWARGS = {'pos', 'size', 'material', 'layer', 'shape_f'}
+
+BAKED_PART_DTYPE = np.dtype([
+    ('pos', FLOAT32, (2, )),
+    ('size', FLOAT32, (2, )),
+    ('friction', FLOAT32),
+    ('tex_layer', FLOAT32),
+    ('z', FLOAT32),
+])
+
+
+def bakeRects(entries) -> tuple:
+    """Takes level rectangles out of (type, args, kwargs) entries and turns them into BAKED_PART_DTYPE parts.
+    WorldRectangleRigidTrue gives 2 parts, as it does when summoned.
+    Does not touch GL or physic, can be called in background thread
+    :returns (parts, rest of entries)"""
+    parts, rest = [], []
+    friction = WorldRectangleRigid.physic_data['friction']
+
+    for entry in entries:
+        type_, args, kwargs = entry
+        if type_ not in BAKED_TYPES or not set(kwargs) <= BAKED_KWARGS or kwargs.get('shape_f'):
+            rest.append(entry)
+            continue
+
+        (x, y), (w, h) = kwargs['pos'], kwargs['size']
+        texture, preset = kwargs['material']
+        _, tex_layer = Ems.get(preset, texture)
+        z = zFromLayer(kwargs.get('layer', 4))
+
+        if type_ == 'WorldRectangleRigidTrue':
+            parts.append(((x, y - 4), (w, h - 8), 0.0, tex_layer, z))
+            parts.append(((x, y + h / 2 - 4), (w, 8), friction, tex_layer, z))
+        else:
+            parts.append(((x, y), (w, h), friction, tex_layer, z))
+
+    return np.array(parts, dtype=BAKED_PART_DTYPE), rest
+
+
+def bakeRectArray(rects: np.ndarray, types, materials) -> np.ndarray:
+    """Same as bakeRects for RECT_DTYPE columns of .bmap chunk, vectorized.
+    Rects must be of BAKED_TYPES, "type" and "material" columns index <types> and <materials> tables.
+    Does not touch GL or physic, can be called in background thread
+    :returns parts"""
+    if not len(rects):
+        return np.empty(0, dtype=BAKED_PART_DTYPE)
+
+    friction = WorldRectangleRigid.physic_data['friction']
+    tex_layers = np.zeros(len(materials), dtype=FLOAT32)
+    for m in np.unique(rects['material']).tolist():
+        texture, preset = materials[m]
+        tex_layers[m] = Ems.get(preset, texture)[1]
+
+    true_ = rects['type'] == (types.index('WorldRectangleRigidTrue') if 'WorldRectangleRigidTrue' in types else -1)
+    rigid, main = rects[~true_], rects[true_]
+    top = main.copy()
+
+    # WorldRectangleRigidTrue: frictionless body and 8 units high top part with friction
+    main['pos'][:, 1] -= 4
+    main['size'][:, 1] -= 8
+    top['pos'][:, 1] += top['size'][:, 1] / 2 - 4
+    top['size'][:, 1] = 8
+
+    parts = np.empty(len(rigid) + 2 * len(main), dtype=BAKED_PART_DTYPE)
+    start = 0
+    for chunk, chunk_friction in ((rigid, friction), (main, 0.0), (top, friction)):
+        part = parts[start: start + len(chunk)]
+        part['pos'] = chunk['pos']
+        part['size'] = chunk['size']
+        part['friction'] = chunk_friction
+        part['tex_layer'] = tex_layers[chunk['material']]
+        part['z'] = zFromLayer(chunk['layer'].astype(FLOAT32))
+        start += len(chunk)
+    return parts
+
+
+# SHADOW OCCLUDERS
+OCCLUDER_TYPES = ('WorldRectangleRigid', 'WorldRectangleRigidTrue')
+
+
+def occluderColumns(entries) -> tuple:
+    """:returns (pos, size) (N, 2) columns of OCCLUDER_TYPES rectangles of (type, args, kwargs) entries"""
+    rects = [(kwargs['pos'], kwargs['size']) for type_, _, kwargs in entries
+             if type_ in OCCLUDER_TYPES and 'pos' in kwargs and 'size' in kwargs]
+    if not rects:
+        return np.empty((0, 2), dtype=FLOAT32), np.empty((0, 2), dtype=FLOAT32)
+    pos, size = zip(*rects)
+    return np.array(pos, dtype=FLOAT32), np.array(size, dtype=FLOAT32)
+
+
+def occluderSegments(pos: np.ndarray, size: np.ndarray) -> np.ndarray:
+    """Edges of static level rectangles, which cast shadows.
+    Does not touch GL or physic, can be called in background thread
+    ::arg pos   (N, 2) centers
+    ::arg size  (N, 2) width, height
+    :returns (N * 4, 4) FLOAT32 segments x0, y0, x1, y1"""
+    if not len(pos):
+        return np.empty((0, 4), dtype=FLOAT32)
+    return rectSegments(pos, size)
+
+
+class WorldGeometryBaked(RO_Baked, Direct):
+    """Static level rectangles merged together:
+    one static body with shape per rectangle and one mesh drawn with one call"""
+    physic_data = WorldRectangleRigid.physic_data
+
+    def __init__(self, gr, parts: np.ndarray):
+        _, body_type, _, shape_filter, elasticity = self.physic_data.get()
+
+        # PHYSIC
+        self.body = Body(body_type=BODY_TYPES[body_type])
+        self.shapes = [
+            makeShapePolygon(self.body, rectPoints(w, h, x, y), friction,
+                             shape_filter=shape_filter, elasticity=elasticity)
+            for (x, y), (w, h), friction in zip(
+                parts['pos'].tolist(), parts['size'].tolist(), parts['friction'].tolist()
+            )
+        ]
+        MainPhysicSpace.add(self.body, *self.shapes)
+
+        # IMAGE
+        super().__init__(gr, parts['pos'], parts['size'], parts['tex_layer'], parts['z'])
+
+    def delete(self):
+        MainPhysicSpace.delete(self.body, *self.shapes)
+        super().delete()
+
+
 class BackgroundColor(Direct, RO_Placed, RC_Static):
     # BackgroundColor
     color: np.array = [0.35, 0.35, 0.5, 1.0]
@@ -535,5 +674,5 @@ for x in Direct.__subclasses__():
 def summon(entity_type, *args, **kwargs):
     """Create object of given type with given args"""
     new = allObjects[entity_type](*args, **kwargs)
-    print(f'+object: {new}\nbhash:{new.bhash if hasattr(new, "bhash") else None}')
+    dprint('+object:', new)
     return new
@@ -3,10 +3,13 @@ from pymunk import Vec2d
 
 from core.math.linear import degreesFromNormal
 from core.Constants import \
-    GRAVITY_VECTOR, BODY_TYPES, SLEEP_TIME_THRESHOLD, MAX_PHYSIC_STEP
+    GRAVITY_VECTOR, BODY_TYPES, SLEEP_TIME_THRESHOLD, PHYSIC_SNAPSHOT_SIZE, \
+    PHYSIC_UPDATE_FREQUENCY, MAX_PHYSIC_SUBSTEPS
 from core.Typing import TYPE_VEC, FLOAT32, List, PhysicProperties, TYPE_NUM
 inf = float('inf')
 from beartype import beartype
+from utils.profiler import profiled
+import numpy as np
 
 from pymunk.shapes import cp
 
@@ -24,6 +27,8 @@ triggers = []
 
 class Body(pymunk.Body):
     hash_key = None
+    snapshot_index = -1
+    """Row of this body in World snapshot arrays. -1 if body is not tracked"""
 
     @property
     def get_hash_key(self):
@@ -177,7 +182,24 @@ class PhysicObject:
 
 class World:
     __instance = None
-    """Pymunk.World singleton abstraction"""
+    """Pymunk.World singleton abstraction
+
+    Snapshot:
+    After each step state of all tracked bodies is copied into arrays
+        positions:  np.ndarray[N, 2]
+        velocities: np.ndarray[N, 2]
+        angles:     np.ndarray[N]     (radians)
+    Row of a body is body.snapshot_index, it does not change while body is tracked.
+    Static bodies are read once, when tracked.
+
+    Fixed step:
+    step(dt) accumulates frame time and simulates it with constant PHYSIC_UPDATE_FREQUENCY steps,
+    not more than MAX_PHYSIC_SUBSTEPS per frame. Leftover time is kept for the next frame and
+        alpha:              float in [0, 1), how far render time is between previous and current step
+        render_positions:   np.ndarray[N, 2]
+        render_angles:      np.ndarray[N]
+    are state of bodies blended between previous and current step. Renderer must use them.
+    """
 
     def __init__(self):
         # setting up space
@@ -191,6 +213,22 @@ class World:
         self.__add_query = []
         self.__del_query = []
 
+        # snapshot
+        self.positions = np.zeros((PHYSIC_SNAPSHOT_SIZE, 2), dtype=FLOAT32)
+        self.velocities = np.zeros((PHYSIC_SNAPSHOT_SIZE, 2), dtype=FLOAT32)
+        self.angles = np.zeros(PHYSIC_SNAPSHOT_SIZE, dtype=FLOAT32)
+        self.prev_positions = np.zeros_like(self.positions)
+        self.prev_angles = np.zeros_like(self.angles)
+        self.render_positions = np.zeros_like(self.positions)
+        self.render_angles = np.zeros_like(self.angles)
+        self.__free_rows = list(range(PHYSIC_SNAPSHOT_SIZE - 1, -1, -1))
+        self.__moving = {}  # row: non static Body
+        self.__moving_cache = None
+
+        # fixed step
+        self.__accumulator = 0.0
+        self.alpha = 0.0
+
         # setting up collision handlers
         from core.physic.collision_handlers import setup
         setup(self.space)
@@ -198,11 +236,81 @@ class World:
     def vanish(self, obj):
         # Delete object from world
         del objects[obj.bhash]
+        self.untrack(obj.body)
         self.delete(obj.body, obj.shape)
 
-    @staticmethod
-    def add_object(obj):
+    def add_object(self, obj):
         objects[obj.body.get_hash_key] = obj
+        self.track(obj.body)
+
+    # SNAPSHOT
+    def track(self, body: "Body"):
+        """Body will get its row in snapshot arrays"""
+        if body.snapshot_index != -1:
+            return
+        if not self.__free_rows:
+            self.__grow_snapshot()
+
+        row = self.__free_rows.pop()
+        body.snapshot_index = row
+
+        p, v = body.position, body.velocity
+        self.positions[row] = p.x, p.y
+        self.velocities[row] = v.x, v.y
+        self.angles[row] = body.angle
+        # new body must not be blended with previous owner of the row
+        self.prev_positions[row] = self.render_positions[row] = self.positions[row]
+        self.prev_angles[row] = self.render_angles[row] = self.angles[row]
+
+        if body.body_type != pymunk.Body.STATIC:
+            self.__moving[row] = body
+            self.__moving_cache = None
+
+    def untrack(self, body: "Body"):
+        row = body.snapshot_index
+        if row == -1:
+            return
+
+        body.snapshot_index = -1
+        self.__free_rows.append(row)
+        if self.__moving.pop(row, None) is not None:
+            self.__moving_cache = None
+
+    def __grow_snapshot(self):
+        size = len(self.angles)
+        for name in ('positions', 'velocities', 'angles', 'prev_positions', 'prev_angles',
+                     'render_positions', 'render_angles'):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+        self.__free_rows.extend(range(size * 2 - 1, size - 1, -1))
+
+    def snapshot(self):
+        """Copies state of all non static tracked bodies in one pass"""
+        if self.__moving_cache is None:
+            rows = np.fromiter(self.__moving.keys(), dtype=np.intp, count=len(self.__moving))
+            handles = [b._body for b in self.__moving.values()]
+            self.__moving_cache = rows, handles
+
+        rows, handles = self.__moving_cache
+        if not handles:
+            return
+
+        get_pos, get_vel, get_angle = cp.cpBodyGetPosition, cp.cpBodyGetVelocity, cp.cpBodyGetAngle
+        state = []
+        append = state.append
+        for h in handles:
+            p, v = get_pos(h), get_vel(h)
+            append((p.x, p.y, v.x, v.y, get_angle(h)))
+
+        state = np.array(state, dtype=FLOAT32)
+        self.positions[rows] = state[:, 0:2]
+        self.velocities[rows] = state[:, 2:4]
+        self.angles[rows] = state[:, 4]
+
+    def state(self, body: "Body"):
+        """:returns position and velocity of tracked body from last snapshot"""
+        row = body.snapshot_index
+        return self.positions[row], self.velocities[row]
 
     def add(self, *args):
         for f in args:
@@ -212,12 +320,47 @@ class World:
         for f in args:
             self.__del_query.append(f)
 
-    def step(self, dt: float):
-        dt = min( dt, MAX_PHYSIC_STEP )
-        self.space.step(dt)
-        self.update_triggers(dt)
-        self.post_step()
-        return dt
+    @profiled("physics.step")
+    def step(self, dt: float, substep=None) -> int:
+        """Simulates <dt> of frame time with fixed PHYSIC_UPDATE_FREQUENCY steps
+        substep(step_dt) is called before every step, objects should apply their forces there
+        :returns amount of steps made"""
+        self.__accumulator += dt
+        steps = 0
+
+        while self.__accumulator >= PHYSIC_UPDATE_FREQUENCY:
+            if steps == MAX_PHYSIC_SUBSTEPS:
+                # spiral of death, simulation slows down instead of freezing the game
+                self.__accumulator = 0.0
+                break
+
+            self.prev_positions[:] = self.positions
+            self.prev_angles[:] = self.angles
+
+            if substep is not None:
+                substep(PHYSIC_UPDATE_FREQUENCY)
+            self.space.step(PHYSIC_UPDATE_FREQUENCY)
+            self.snapshot()
+            self.update_triggers(PHYSIC_UPDATE_FREQUENCY)
+            self.post_step()
+
+            self.__accumulator -= PHYSIC_UPDATE_FREQUENCY
+            steps += 1
+
+        self.alpha = self.__accumulator / PHYSIC_UPDATE_FREQUENCY
+        self.interpolate()
+        return steps
+
+    def interpolate(self):
+        """Blends previous and current snapshot by alpha into render_positions, render_angles"""
+        alpha = FLOAT32(self.alpha)
+        np.subtract(self.positions, self.prev_positions, out=self.render_positions)
+        self.render_positions *= alpha
+        self.render_positions += self.prev_positions
+
+        np.subtract(self.angles, self.prev_angles, out=self.render_angles)
+        self.render_angles *= alpha
+        self.render_angles += self.prev_angles
 
     def post_step(self):
         self.space.add(*self.__add_query)
@@ -232,13 +375,14 @@ class World:
         for tr in triggers:
             tr.update(dt)
 
-    @staticmethod
-    def clear():
+    def clear(self):
         # Clearing physic world
         while objects.values():
             obj = list(objects.values())[0]
             # Physically delete_Mortal object
             obj.__class__.delete_from_physic(obj, )
+        self.__accumulator = 0.0
+        self.alpha = 0.0
 
     def get_geometry(self, camera):
         pass
@@ -0,0 +1,153 @@
+"""
+Texture atlas
+
+Textures of texture pack are packed into few atlas pages at load time,
+so sprites with different textures can be drawn in one instanced draw without rebinding.
+Each GlTexture of atlas keeps key of its page and uv rect (u, v, width, height) on it.
+
+Pages are packed with skyline bottom-left heuristic, textures are sorted by height first.
+Every texture is surrounded by ATLAS_PADDING of its own edge pixels,
+so sampling near the edge never reads neighbouring texture.
+"""
+
+from core.Constants import ATLAS_PAGE_SIZE, ATLAS_PADDING
+from core.Typing import FLOAT32
+from core.rendering.PyOGL_utils import makeGLTexture
+
+from typing import List, Tuple, Optional
+from OpenGL.GL import glGetIntegerv, GL_MAX_TEXTURE_SIZE
+import numpy as np
+
+
+__all__ = [
+    'SkylinePacker',
+    'packAtlas',
+    'buildAtlas'
+]
+
+
+class SkylinePacker:
+    """Packs rectangles into one page of fixed size.
+    Skyline is list of [x, y, width] segments, top edge of already placed rectangles"""
+    __slots__ = ('width', 'height', 'skyline')
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.skyline = [[0, 0, width]]
+
+    def _fit(self, index, w, h) -> int:
+        """:returns y at which rectangle placed at skyline[index].x rests, -1 if it does not fit"""
+        x = self.skyline[index][0]
+        if x + w > self.width:
+            return -1
+
+        y, left = 0, w
+        for sx, sy, sw in self.skyline[index:]:
+            y = max(y, sy)
+            if y + h > self.height:
+                return -1
+            left -= sw
+            if left <= 0:
+                return y
+        return -1
+
+    def insert(self, w: int, h: int) -> Optional[Tuple[int, int]]:
+        """:returns (x, y) of placed rectangle, None if page is full"""
+        best, best_y, best_x = -1, self.height, self.width
+        for i, (x, _, _) in enumerate(self.skyline):
+            y = self._fit(i, w, h)
+            if y != -1 and (y < best_y or y == best_y and x < best_x):
+                best, best_y, best_x = i, y, x
+
+        if best == -1:
+            return None
+        self._add(best, best_x, best_y + h, w)
+        return best_x, best_y
+
+    def _add(self, index, x, top, w):
+        skyline = self.skyline
+        skyline.insert(index, [x, top, w])
+
+        # cut segments covered by the new one
+        i = index + 1
+        while i < len(skyline):
+            sx, sy, sw = skyline[i]
+            covered = x + w - sx
+            if covered <= 0:
+                break
+            if covered < sw:
+                skyline[i] = [sx + covered, sy, sw - covered]
+                break
+            del skyline[i]
+
+        # merge neighbours of the same height
+        i = 0
+        while i < len(skyline) - 1:
+            if skyline[i][1] == skyline[i + 1][1]:
+                skyline[i][2] += skyline[i + 1][2]
+                del skyline[i + 1]
+            else:
+                i += 1
+
+    @property
+    def used_height(self) -> int:
+        return max(sy for _, sy, _ in self.skyline)
+
+
+def packAtlas(sizes: List[Tuple[int, int]], page_size: int = ATLAS_PAGE_SIZE, padding: int = ATLAS_PADDING):
+    """Packs rectangles of given sizes (padding is added around each)
+    :returns (placements, page heights)
+        placements: (page, x, y) of rectangle without padding, None if it is bigger than page"""
+    placements: List[Optional[Tuple[int, int, int]]] = [None] * len(sizes)
+    pages: List[SkylinePacker] = []
+
+    for i in sorted(range(len(sizes)), key=lambda j: (-sizes[j][1], -sizes[j][0])):
+        w, h = sizes[i][0] + 2 * padding, sizes[i][1] + 2 * padding
+        if w > page_size or h > page_size:
+            continue
+
+        for page, packer in enumerate(pages):
+            pos = packer.insert(w, h)
+            if pos is not None:
+                break
+        else:
+            packer = SkylinePacker(page_size, page_size)
+            pages.append(packer)
+            page, pos = len(pages) - 1, packer.insert(w, h)
+
+        placements[i] = (page, pos[0] + padding, pos[1] + padding)
+
+    # last rows of pages are usually empty, pages are cut to power of two height
+    heights = [min(page_size, 1 << (packer.used_height - 1).bit_length()) for packer in pages]
+    return placements, heights
+
+
+def buildAtlas(images: List[Tuple[bytes, Tuple[int, int]]], page_size: int = ATLAS_PAGE_SIZE,
+               padding: int = ATLAS_PADDING):
+    """Packs RGBA images (data, (w, h)) and uploads atlas pages
+    :returns (page keys, [(page key, uv rect) or None for every image])
+        images bigger than page are not packed, they should keep their own texture"""
+    page_size = min(page_size, int(glGetIntegerv(GL_MAX_TEXTURE_SIZE)))
+    placements, heights = packAtlas([size for _, size in images], page_size, padding)
+    pages = [np.zeros((h, page_size, 4), dtype=np.uint8) for h in heights]
+
+    for (data, (w, h)), placement in zip(images, placements):
+        if placement is None:
+            continue
+        page, x, y = placement
+        image = np.frombuffer(data, dtype=np.uint8).reshape(h, w, 4)
+        pages[page][y - padding: y + h + padding, x - padding: x + w + padding] = \
+            np.pad(image, ((padding, padding), (padding, padding), (0, 0)), mode='edge')
+
+    keys = [makeGLTexture(page.tobytes(), page_size, page.shape[0]) for page in pages]
+
+    rects = []
+    for (_, (w, h)), placement in zip(images, placements):
+        if placement is None:
+            rects.append(None)
+            continue
+        page, x, y = placement
+        ph = heights[page]
+        rects.append((keys[page], np.array([x / page_size, y / ph, w / page_size, h / ph], dtype=FLOAT32)))
+    return keys, rects
@@ -1,11 +1,15 @@
-from core.Constants import MAX_LIGHT_SOURCES, MAX_TEXTURES_BIND
+from core.Constants import MAX_LIGHT_SOURCES, LIGHT_POWER_UNIT, LIGHT_TILED, LIGHT_TILE_SIZE, \
+    LIGHT_GROUP_CAPACITY, LIGHT_BUFFER_RESOLUTION, SHADOWS_ENABLED
 from core.Typing import FLOAT32, INT64
-from core.math.linear import FullTransformMat
+from core.math.spatial import cullCircles, binCircles
+from core.physic.physics import MainPhysicSpace
 from core.rendering.PyOGL_utils import zFromLayer, bufferize, drawDataLightSource
 from core.rendering.Shaders import shaders
+from core.rendering.Shadows import ShadowCaster
 
-from dataclasses import dataclass, field
-from typing import Dict, List, Union
+from OpenGL.GL import glGenBuffers, glBindBufferBase, glBufferData, GL_SHADER_STORAGE_BUFFER, GL_STREAM_DRAW
+from typing import Dict, List, Tuple, Union
+from math import hypot, ceil
 import numpy as np
 from beartype import beartype
 
@@ -17,166 +21,427 @@ LIGHT_COLOR_PRESETS = {
 
 __all__ = [
     "__LightingManager",
+    "LightSource",
+    "LightGroup",
+    "lightParams",
+    "explosionParams",
+    "LightTileGrid",
 ]
 
 
-@dataclass
-class LightSource:
-    __slots__ = ("color", "size", "posXY", "posZ", "z_rotation", "visible")
-
-    color: field(default_factory=np.ndarray)
-    size: field(default_factory=FLOAT32)
-    posXY: field(default_factory=np.ndarray)
-    posZ: field(default_factory=FLOAT32)
+@beartype
+def lightParams(
+        pos: Union[List, tuple, np.ndarray],
+        size: Union[float, List, np.ndarray],
+        layer: int,
+        color: Union[str, List, np.ndarray, tuple],
+        brightness: float,
+        z_rotation: float = 0.0,
+        shadows: bool = True
+) -> dict:
+    """shadows:: level geometry casts shadows of source, see Shadows
+    :returns row values of static light source for LightGroup.add"""
+    if type(color) == str:
+        color = LIGHT_COLOR_PRESETS[color]
+    if type(size) == float:
+        size = (size, size)
+
+    return {"pos": pos, "z": zFromLayer(layer), "rotation": z_rotation, "base_size": size,
+            "color": (*color, brightness), "brightness": brightness, "shadows": shadows}
+
+
+@beartype
+def explosionParams(
+        pos: Union[List, tuple, np.ndarray],
+        power: Union[float, List, np.ndarray],
+        layer: int,
+        color: Union[str, List, np.ndarray, tuple],
+        brightness: float,
+        time: float,
+        peak: float,
+        shadows: bool = False
+) -> dict:
+    """:returns row values of light source, which brightness and size rise until <peak> and fade out until <time>"""
+    assert peak < time, "Max time must be greater or equal to peak time"
+    params = lightParams(pos, power, layer, color, brightness, shadows=shadows)
+    params.update(peak=peak, end=time)
+    return params
 
-    z_rotation: field(default_factory=FLOAT32)
-    shadow_mask_key: field(default_factory=INT64)
 
-    visible: field(default_factory=bool)
+class LightSource:
+    """Handle of light source, its data lives in row of LightGroup.
+    Row changes when other sources of group are deleted, so it is looked up by id.
+    Ids of removed sources are reused, so handle also keeps generation of its source"""
+    __slots__ = ("group", "idd", "generation")
 
-    @beartype
-    def __init__(
-            self,
-            pos: Union[List, tuple, np.ndarray],
-            size: Union[float, List, np.ndarray],
-            layer: int,
-            color: Union[str, List, np.ndarray, tuple],
-            brightness: float,
-            z_rotation: float = 0.0
-    ):
-        if type(color) == str:
-            self.color = np.array([*LIGHT_COLOR_PRESETS[color], brightness], dtype=FLOAT32)
-        else:
-            self.color = np.array([*color, brightness], dtype=FLOAT32)
-
-        if type(size) == float:
-            self.size = np.array([size, size], dtype=FLOAT32)
-        else:
-            self.size = np.array([*size], dtype=FLOAT32)
-
-        self.posXY = np.array(pos, dtype=FLOAT32)
-        self.posZ = FLOAT32(zFromLayer(layer))
-        self.z_rotation = FLOAT32(z_rotation)
-        self.visible = True
+    def __init__(self, group: "LightGroup", idd: int, generation: int):
+        self.group = group
+        self.idd = idd
+        self.generation = generation
 
     def __repr__(self):
         return f'LS {list(self.posXY)}'
 
-    def calculate_shadows(self):
-        pass
-
-    @beartype
-    def update(self, dt: float):
-        pass
-
-    def get_transform(self, camera):
-        return FullTransformMat(*self.posXY, camera.get_matrix(), self.z_rotation)
-
-
-class ExplosionLightSource(LightSource):
-    __slots__ = ('curr_time', 'end_time', 'peak_time', )
-
-    curr_time: field(default_factory=float)
-    end_time: field(default_factory=float)
-    peak_time: field(default_factory=float)
+    @property
+    def row(self) -> int:
+        return self.group.rows[self.idd]
+
+    @property
+    def alive(self) -> bool:
+        row = self.group.rows.get(self.idd)
+        return row is not None and self.group.generation[row] == self.generation
+
+    @property
+    def posXY(self) -> np.ndarray:
+        return self.group.pos[self.row]
+
+    @posXY.setter
+    def posXY(self, value):
+        self.group.pos[self.row] = value
+
+    @property
+    def posZ(self) -> FLOAT32:
+        return self.group.z[self.row]
+
+    @property
+    def z_rotation(self) -> FLOAT32:
+        return self.group.rotation[self.row]
+
+    @z_rotation.setter
+    def z_rotation(self, value: float):
+        self.group.rotation[self.row] = value
+
+    @property
+    def color(self) -> np.ndarray:
+        """rgb, brightness"""
+        return self.group.color[self.row]
+
+    @color.setter
+    def color(self, value):
+        row = self.row
+        self.group.color[row, :3] = value[:3]
+        if len(value) > 3:
+            self.group.brightness[row] = self.group.color[row, 3] = value[3]
+
+    @property
+    def size(self) -> np.ndarray:
+        return self.group.size[self.row]
+
+    @size.setter
+    def size(self, value):
+        row = self.row
+        self.group.base_size[row] = self.group.size[row] = value
+
+    @property
+    def radius(self) -> float:
+        """Bounding circle of light quad in any rotation, units"""
+        return LIGHT_POWER_UNIT * hypot(*self.size)
+
+
+class LightGroup:
+    __doc__ = """
+    Columnar storage of light sources of one texture.
+    Sources always occupy rows [0, count), so render data of group is one contiguous slice
+    kept between frames and updated in place. Fades, expiry and positions of sources bound to
+    physic bodies are batched NumPy operations over all rows.
+
+    ids:        np.ndarray[capacity]        -> id of source in row
+    pos:        np.ndarray[capacity, 2]
+    z:          np.ndarray[capacity]
+    rotation:   np.ndarray[capacity]        -> degrees
+    size:       np.ndarray[capacity, 2]     -> base_size faded by time
+    color:      np.ndarray[capacity, 4]     -> rgb, brightness faded by time
+    stencil:    np.ndarray[capacity]        -> row of shadow map + 1, 0 if source has no shadows this frame
+    shadows:    np.ndarray[capacity]        -> source casts shadows
+    base_size:  np.ndarray[capacity, 2]
+    brightness: np.ndarray[capacity]
+    time:       np.ndarray[capacity]        -> seconds since source was added
+    peak:       np.ndarray[capacity]        -> time of full brightness
+    end:        np.ndarray[capacity]        -> time of expiry, 0 for static sources
+    body_row:   np.ndarray[capacity]        -> row of body in World snapshot, -1 if source is not bound
+    generation: np.ndarray[capacity]        -> number of source among all sources, tells apart sources of reused id
+    """
+
+    __slots__ = (
+        "capacity", "count", "rows", "ids", "pos", "z", "rotation", "size", "color", "stencil", "shadows",
+        "base_size", "brightness", "time", "peak", "end", "body_row", "generation"
+    )
+    COLUMNS = (
+        "ids", "pos", "z", "rotation", "size", "color", "stencil", "shadows",
+        "base_size", "brightness", "time", "peak", "end", "body_row", "generation"
+    )
+
+    def __init__(self, capacity: int = LIGHT_GROUP_CAPACITY):
+        self.capacity = capacity
+        self.count = 0
+        self.rows: Dict[int, int] = {}  # id -> row
+
+        self.ids = np.zeros(capacity, dtype=INT64)
+        self.pos = np.zeros((capacity, 2), dtype=FLOAT32)
+        self.z = np.zeros(capacity, dtype=FLOAT32)
+        self.rotation = np.zeros(capacity, dtype=FLOAT32)
+        self.size = np.zeros((capacity, 2), dtype=FLOAT32)
+        self.color = np.zeros((capacity, 4), dtype=FLOAT32)
+        self.stencil = np.zeros(capacity, dtype=np.uint32)
+        self.shadows = np.zeros(capacity, dtype=bool)
+
+        self.base_size = np.zeros((capacity, 2), dtype=FLOAT32)
+        self.brightness = np.zeros(capacity, dtype=FLOAT32)
+        self.time = np.zeros(capacity, dtype=FLOAT32)
+        self.peak = np.zeros(capacity, dtype=FLOAT32)
+        self.end = np.zeros(capacity, dtype=FLOAT32)
+        self.body_row = np.full(capacity, -1, dtype=np.intp)
+        self.generation = np.zeros(capacity, dtype=INT64)
+
+    def __len__(self):
+        return self.count
 
-    def __init__(self, pos, power, layer, color, brightness, time, peak):
-        super().__init__(pos, power, layer, color, brightness)
-        assert peak < time, "Max time must be greater or equal to peak time"
-        self.curr_time = 0.0
-        self.end_time = time
-        self.peak_time = peak
-
-    @beartype
-    def update(self, dt: float):
-        self.curr_time += dt
-        if self.curr_time >= self.end_time:
-            return True
-
-    def get_data(self):
-        crt, ndt, pkt = self.curr_time, self.end_time, self.peak_time
-        if crt >= pkt:
-            kff = 1.0 - (crt - pkt) / (ndt - pkt)
-        else:
-            kff = crt / pkt
+    def __repr__(self):
+        return f'<LightGroup {self.count}/{self.capacity}>'
+
+    def _grow(self):
+        self.capacity *= 2
+        for name in self.COLUMNS:
+            old = getattr(self, name)
+            column = np.zeros((self.capacity, *old.shape[1:]), dtype=old.dtype)
+            column[:self.count] = old[:self.count]
+            setattr(self, name, column)
+
+    def add(self, idd: int, pos, z, rotation, base_size, color, brightness,
+            shadows=False, peak=0.0, end=0.0, body_row=-1, generation=0) -> int:
+        """:returns row of new source"""
+        if self.count == self.capacity:
+            self._grow()
+
+        row = self.count
+        self.count += 1
+        self.rows[idd] = row
+        self.ids[row] = idd
+        self.pos[row] = pos
+        self.z[row] = z
+        self.rotation[row] = rotation
+        self.base_size[row] = base_size
+        self.color[row] = color
+        self.brightness[row] = brightness
+        self.stencil[row] = 0
+        self.shadows[row] = shadows
+        self.time[row] = 0.0
+        self.peak[row] = peak
+        self.end[row] = end
+        self.body_row[row] = body_row
+        self.generation[row] = generation
+        self.__fade(np.array([row]))
+        return row
+
+    def remove(self, idd: int) -> bool:
+        """Fills row of source with the last one.
+        :returns False if group has no such source"""
+        row = self.rows.pop(idd, None)
+        if row is None:
+            return False
+
+        last = self.count - 1
+        if row != last:
+            for name in self.COLUMNS:
+                column = getattr(self, name)
+                column[row] = column[last]
+            self.rows[int(self.ids[row])] = row
+
+        self.count = last
+        return True
+
+    def compact(self, alive: np.ndarray) -> np.ndarray:
+        """Moves alive rows to the front of the group.
+        :returns ids of removed sources"""
+        n = self.count
+        removed = self.ids[:n][~alive]
+        keep = np.flatnonzero(alive)
+        m = len(keep)
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            column[:m] = column[keep]
+        self.count = m
+
+        for idd in removed.tolist():
+            del self.rows[idd]
+        first = int(np.argmin(alive))
+        for row, idd in enumerate(self.ids[first:m].tolist(), first):
+            self.rows[idd] = row
+        return removed
 
-        return np.array(
-            [*self.posXY, self.posZ, *self.color[:-1], self.color[-1] * kff, self.radius * kff]
-        ).flatten()
+    def clear(self):
+        self.count = 0
+        self.rows.clear()
+
+    def move(self, idd: int, pos, z_rotation: float = None):
+        row = self.rows[idd]
+        self.pos[row] = pos
+        if z_rotation is not None:
+            self.rotation[row] = z_rotation
+
+    def __fade(self, rows: np.ndarray):
+        """Brightness and size rise linearly until peak, then fall to zero at end"""
+        t, peak, end = self.time[rows], self.peak[rows], self.end[rows]
+        animated = end > 0.0
+        rise = t / np.maximum(peak, 1e-6)
+        fall = 1.0 - (t - peak) / np.maximum(end - peak, 1e-6)
+        kff = np.where(animated, np.clip(np.where(t >= peak, fall, rise), 0.0, 1.0), 1.0).astype(FLOAT32)
+
+        self.color[rows, 3] = self.brightness[rows] * kff
+        self.size[rows] = self.base_size[rows] * kff[:, None]
+
+    def update(self, dt: float, positions: np.ndarray) -> np.ndarray:
+        """Copies positions of bound sources from <positions> (World snapshot), fades and removes expired sources
+        :returns ids of removed sources"""
+        n = self.count
+        if not n:
+            return self.ids[:0]
+
+        body_row = self.body_row[:n]
+        bound = body_row >= 0
+        if bound.any():
+            self.pos[:n][bound] = positions[body_row[bound]]
+
+        animated = np.flatnonzero(self.end[:n] > 0.0)
+        if not len(animated):
+            return self.ids[:0]
+
+        self.time[animated] += dt
+        self.__fade(animated)
+
+        alive = self.time[:n] < self.end[:n]
+        alive |= self.end[:n] <= 0.0
+        if alive.all():
+            return self.ids[:0]
+        return self.compact(alive)
+
+    def cull(self, ortho_params) -> np.ndarray:
+        """:returns rows of sources, which quads intersect camera field"""
+        n = self.count
+        radii = LIGHT_POWER_UNIT * np.hypot(self.size[:n, 0], self.size[:n, 1])
+        return np.flatnonzero(cullCircles(self.pos[:n], radii, ortho_params))
 
 
 class __LightingManager:
-    sources: Dict[str, Dict] = {}
+    groups: Dict[str, LightGroup] = {}
 
     def __init__(self, shader="LightSourceShader"):
-        self.sources: Dict[ str, Dict[int, LightSource] ] = {}
+        self.groups: Dict[str, LightGroup] = {}
         self.vbo: int = bufferize( drawDataLightSource() )
         self.shader = shaders[shader]
         self.free_ids = set(range(MAX_LIGHT_SOURCES))
+        self.generation = 0  # of the last added source, never reset so stale handles stay stale
         self.do_render = True
 
-        self.changed = True
-        self.groups = []
+        self.tiles = LightTileGrid(LIGHT_BUFFER_RESOLUTION) if LIGHT_TILED else None
+        self.shadows = ShadowCaster() if SHADOWS_ENABLED else None
+        self.tiled_shader = shaders["LightTiledShader"]
 
     @beartype
-    def newSource(self, texture: str, s_type=0, **kwargs):
-        if s_type == 0:
-            source = LightSource(**kwargs)
-        else:
-            source = ExplosionLightSource(**kwargs)
+    def newSource(self, texture: str, s_type=0, body=None, **kwargs):
+        """s_type 0 - static source, kwargs of lightParams
+        s_type 1 - explosion, kwargs of explosionParams
+        body - pymunk Body tracked by MainPhysicSpace, source follows it
+        :returns id and LightSource handle"""
+        params = lightParams(**kwargs) if s_type == 0 else explosionParams(**kwargs)
+        if body is not None:
+            params["body_row"] = body.snapshot_index
 
         idd = self.new_id()
-        if texture in self.sources.keys():
-            self.sources[texture][idd] = source
-        else:
-            self.sources[texture] = {idd: source, }
-
-        self.changed = True
-        return idd, source
+        self.generation += 1
+        if texture not in self.groups:
+            self.groups[texture] = LightGroup()
+        group = self.groups[texture]
+        group.add(idd, generation=self.generation, **params)
+        return idd, LightSource(group, idd, self.generation)
 
     def new_id(self):
         return self.free_ids.pop()
 
-    def generate_groups(self) -> List[ Dict ]:
-        """If new LightSource is added"""
-
-        if self.changed:
-            self.changed = False
-            self.groups = []
-
-            sources_all = self.sources
-            group_n = 0
-            for tex, sources in sources_all.items():
-
-                while sources:
-                    self.groups.append({"texture": tex, "sources": []})
-                    limit = min(MAX_TEXTURES_BIND - 1, len(sources))
-
-                    for _ in range(limit):
-                        _, source = sources.popitem()
-                        self.groups[group_n]["sources"].append(source)
-                    group_n += 1
-
-        return self.groups
-
-    def delete_source(self, texture, idd):
-        self.free_ids.add(idd)
-        s = self.sources[texture]
-        if idd in s.keys():
-            del s[idd]
+    def move(self, texture: str, idd: int, pos, z_rotation: float = None):
+        self.groups[texture].move(idd, pos, z_rotation)
+
+    def visible(self, ortho_params) -> Dict[str, Tuple[LightGroup, np.ndarray]]:
+        """:returns texture name -> (its group, rows of sources in camera field)"""
+        visible = {}
+        for texture, group in self.groups.items():
+            if not group.count:
+                continue
+            rows = group.cull(ortho_params)
+            if len(rows):
+                visible[texture] = (group, rows)
+        return visible
+
+    def delete_source(self, texture, idd, source: LightSource = None):
+        """source - handle of deleted source, nothing is deleted if it has already expired
+        and its id belongs to another source now"""
+        if source is not None and not source.alive:
+            return
+        group = self.groups.get(texture)
+        if group is not None and group.remove(idd):
+            self.free_ids.add(idd)
 
     @beartype
     def update(self, dt: float):
-        for key in self.sources.keys():
-            to_delete = set()
-
-            for idd, source in self.sources[key].items():
-                if source.update(dt):
-                    self.free_ids.add(idd)
-                    to_delete.add(idd)
-
-            for _ in range(len(to_delete)):
-                del self.sources[key][to_delete.pop()]
+        positions = MainPhysicSpace.render_positions
+        for group in self.groups.values():
+            self.free_ids.update(group.update(dt, positions).tolist())
 
     def clear(self):
-        pass
+        """Deletes all sources. Rows of bound sources point to World snapshot, which is cleared with them"""
+        for group in self.groups.values():
+            group.clear()
+        self.free_ids = set(range(MAX_LIGHT_SOURCES))
+        if self.shadows is not None:
+            self.shadows.clear()
+
+
+# TILED LIGHTING
+LIGHT_DTYPE = np.dtype([
+    ('rect', np.float32, (4, )),   # center x, y and half width, height of light quad, units
+    ('rot', np.float32, (4, )),    # cos, sin of rotation, texture slot, stencil
+    ('color', np.float32, (4, )),  # rgb, brightness
+])
+
+
+class LightTileGrid:
+    """CPU side of tiled light accumulation (LIGHT_TILED).
+    Frame is split into LIGHT_TILE_SIZE px tiles, every light is assigned to tiles its bounding circle covers.
+    Lights, (offset, count) of every tile and light indices of tiles are uploaded to shader storage buffers
+    0, 1 and 2, then LightTiledShader sums lights of each pixel's tile in one full-screen pass,
+    so cost of lights depends on pixels they cover, not on their count"""
+
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.tiles_x = ceil(resolution[0] / LIGHT_TILE_SIZE)
+        self.tiles_y = ceil(resolution[1] / LIGHT_TILE_SIZE)
+        self.buffers = glGenBuffers(3)
+
+    @staticmethod
+    def pack(visible: List[Tuple[LightGroup, np.ndarray]]) -> np.ndarray:
+        """:returns LIGHT_DTYPE records of (group, rows) pairs, texture slot of group is its index"""
+        lights = np.empty(sum(len(rows) for _, rows in visible), dtype=LIGHT_DTYPE)
+        start = 0
+        for slot, (group, rows) in enumerate(visible):
+            part = lights[start: start + len(rows)]
+            a = np.radians(group.rotation[rows])
+            part['rect'][:, 0:2] = group.pos[rows]
+            part['rect'][:, 2:4] = group.size[rows] * LIGHT_POWER_UNIT
+            part['rot'][:, 0] = np.cos(a)
+            part['rot'][:, 1] = np.sin(a)
+            part['rot'][:, 2] = slot
+            part['rot'][:, 3] = group.stencil[rows]
+            part['color'] = group.color[rows]
+            start += len(rows)
+        return lights
+
+    def upload(self, lights: np.ndarray, ortho_params):
+        """Bins <lights> into tiles and binds buffers for LightTiledShader"""
+        radii = np.hypot(lights['rect'][:, 2], lights['rect'][:, 3])
+        tiles, indices = binCircles(lights['rect'][:, 0:2], radii, ortho_params, self.tiles_x, self.tiles_y)
+        if not len(indices):
+            indices = np.zeros(1, dtype=np.uint32)  # buffer can not be empty
+
+        for binding, data in enumerate((lights, tiles, indices)):
+            glBindBufferBase(GL_SHADER_STORAGE_BUFFER, binding, self.buffers[binding])
+            glBufferData(GL_SHADER_STORAGE_BUFFER, data.nbytes, data, GL_STREAM_DRAW)
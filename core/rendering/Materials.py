@@ -1,15 +1,20 @@
-from core.Constants import STN_MATERIAL_PACK, MAX_TEXTURE_3D_LAYERS, MATERIAL_SIZE
+from core.Constants import STN_MATERIAL_PACK, MATERIAL_SIZE, MATERIAL_MIN_LAYERS, MATERIAL_COMPRESSED
 from utils.debug import dprint
-from utils.files import get_full_path, load_material_texture, load_material_preset
+from utils.files import get_full_path, load_material_preset, ImageCache
+from utils.assets import AssetJob, MainAssetPipeline
 from core.Exceptions import MaterialRuntimeError
 
+from functools import partial
 from os import listdir
 from os.path import join
 
 from OpenGL.GL import *
+import numpy as np
 
 
-def loadMaterialPack(_name):
+def loadMaterialPack(_name, storage: "MaterialStorage") -> AssetJob:
+    """Presets and textures of pack are parsed and decoded in MainAssetPipeline workers,
+    when all of them are done, they are loaded into <storage>"""
     print(f'\n-- loading Material Pack: {_name}')
 
     path = get_full_path(_name, file_type='mat')
@@ -17,62 +22,113 @@ def loadMaterialPack(_name):
     textures = listdir( join( path, "textures" ) )
 
     data_presets = {}
-    data_textures = {}
+    images = {}
 
-    for p in presets:
-        data = load_material_preset(p, _name)
-        if data is None: continue
+    def upload_preset(p, data):
+        if data is None: return
         p_name = ''.join(p.split('.')[:-1])
         data_presets[p_name] = data
         dprint(p)
 
-    for p in textures:
-        data, size = load_material_texture(p, _name)
-        if data is None: continue
-        p_name = ''.join(p.split('.')[:-1])
-        data_textures[p_name] = ( data, size )
+    def upload_texture(p, image):
+        images[p] = image
         dprint(p)
 
-    dprint(f'-- Done.\n')
-    return data_presets, data_textures
+    # decoded images are kept in image cache of pack, see utils.files.ImageCache
+    cache = ImageCache(f'mat_{_name}')
+
+    def finish():
+        # completion order differs between runs, layers of material array are given in order of listdir
+        ordered = {p: images[p] for p in textures}
+        data_textures = {''.join(p.split('.')[:-1]): image for p, image in ordered.items()}
+        storage.load(data_presets, data_textures)
+        cache.save(ordered)
+        dprint(f'-- Done.\n')
+
+    tasks = [(partial(load_material_preset, p, _name), partial(upload_preset, p)) for p in presets]
+    tasks += [(partial(cache.get, p, join( path, "textures", p )), partial(upload_texture, p)) for p in textures]
+    return MainAssetPipeline.job('materials', tasks, finish)
 
 
 class MaterialStorage:
-    #  TODO: ALLOW SCALE BEYOND 2048 TEXTURES
+    """Material textures in one GL_TEXTURE_2D_ARRAY, one layer per texture.
+    Array is sized to loaded textures, when it is full, it is reallocated with doubled layers
+    and old ones are copied on GPU with glCopyImageSubData.
+    Every layer has full mip chain, so tiled surfaces are not undersampled when zoomed out.
+    If MATERIAL_COMPRESSED, layers are compressed by driver"""
 
     def __init__(self, size=( MATERIAL_SIZE, MATERIAL_SIZE )):
         self.__presets = {}  # name: preset
         self.__textures = {}  # name: depth
         self.__size = size
         self.__key = 0
-
-    def initialize(self):
-        self.__key = glGenTextures(1)
-        glBindTexture(GL_TEXTURE_2D_ARRAY, self.__key)
-        glTexImage3D(
-            GL_TEXTURE_2D_ARRAY, 0, GL_RGBA, self.__size[0], self.__size[1],
-            MAX_TEXTURE_3D_LAYERS, 0, GL_RGBA, GL_UNSIGNED_BYTE, None
-        )
+        self.__capacity = 0  # allocated layers
+        self.__levels = max(size).bit_length()  # mip levels down to 1x1
+
+    def __level_size(self, level):
+        return max(1, self.__size[0] >> level), max(1, self.__size[1] >> level)
+
+    def __allocate(self, capacity) -> int:
+        key = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, key)
+        internal_format = GL_COMPRESSED_RGBA if MATERIAL_COMPRESSED else GL_RGBA8
+        for level in range(self.__levels):
+            glTexImage3D(
+                GL_TEXTURE_2D_ARRAY, level, internal_format, *self.__level_size(level),
+                capacity, 0, GL_RGBA, GL_UNSIGNED_BYTE, None
+            )
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAX_LEVEL, self.__levels - 1)
         glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_S, GL_REPEAT)
         glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_T, GL_REPEAT)
         glTexParameterf(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-        glTexParameterf(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameterf(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
         glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+        return key
 
-    def load(self, presets, textures):
-        if self.__key == 0: self.initialize()
+    def reserve(self, layers: int):
+        """Grows array to hold at least <layers> textures, loaded ones are kept"""
+        if layers <= self.__capacity:
+            return
+
+        limit = int(glGetIntegerv(GL_MAX_ARRAY_TEXTURE_LAYERS))
+        if layers > limit:
+            raise MaterialRuntimeError(f"Too many material textures: {layers}, max: {limit}")
 
-        self.__presets = presets
+        capacity = min(limit, max(MATERIAL_MIN_LAYERS, 1 << (layers - 1).bit_length()))
+        key = self.__allocate(capacity)
+
+        if self.__key:
+            if self.__textures:
+                for level in range(self.__levels):
+                    glCopyImageSubData(
+                        self.__key, GL_TEXTURE_2D_ARRAY, level, 0, 0, 0,
+                        key, GL_TEXTURE_2D_ARRAY, level, 0, 0, 0, *self.__level_size(level), len(self.__textures)
+                    )
+            glDeleteTextures(1, [self.__key, ])
+
+        dprint(f'-- material array: {self.__capacity} -> {capacity} layers')
+        self.__key = key
+        self.__capacity = capacity
+
+    def load(self, presets, textures):
+        """Adds presets and textures, texture of the same name replaces layer of loaded one"""
+        self.__presets.update(presets)
+        self.reserve(len(self.__textures.keys() | textures.keys()))
 
         glActiveTexture(GL_TEXTURE0)
         glBindTexture(GL_TEXTURE_2D_ARRAY, self.__key)
 
-        for i, ( key, (data, size) ) in enumerate( textures.items() ):
-            self.__textures[key] = i
+        for key, (data, size) in textures.items():
+            if tuple(size) != tuple(self.__size):
+                raise MaterialRuntimeError(f"Material texture {key} is {size[0]}x{size[1]}, "
+                                           f"must be {self.__size[0]}x{self.__size[1]}")
 
-            glTexSubImage3D(
-                GL_TEXTURE_2D_ARRAY, 0, 0, 0, i, self.__size[0], self.__size[1], 1, GL_RGBA, GL_UNSIGNED_BYTE, data
-            )
+            layer = self.__textures.setdefault(key, len(self.__textures))
+            for level, image in enumerate(mipChain(data, size, self.__levels)):
+                glTexSubImage3D(
+                    GL_TEXTURE_2D_ARRAY, level, 0, 0, layer, *self.__level_size(level), 1,
+                    GL_RGBA, GL_UNSIGNED_BYTE, image
+                )
 
         glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
 
@@ -91,9 +147,28 @@ class MaterialStorage:
         glBindTexture(GL_TEXTURE_2D_ARRAY, self.__key)
 
 
+def mipChain(data, size, levels: int) -> list:
+    """RGBA images of mip levels, each is 2x2 box filter of previous one
+    :returns [(h, w, 4) uint8 arrays]"""
+    image = np.frombuffer(data, dtype=np.uint8).reshape(size[1], size[0], 4)
+    chain = [image]
+    for _ in range(1, levels):
+        f = image.astype(np.float32)
+        h, w = (f.shape[0] // 2) * 2, (f.shape[1] // 2) * 2
+        if h:
+            f = (f[0:h:2] + f[1:h:2]) * 0.5
+        if w:
+            f = (f[:, 0:w:2] + f[:, 1:w:2]) * 0.5
+        image = np.ascontiguousarray(f + 0.5, dtype=np.uint8)
+        chain.append(image)
+    return chain
+
+
 EssentialMaterialStorage = MaterialStorage()
 
 
-def loadMaterials():
-    preset, texture = loadMaterialPack(STN_MATERIAL_PACK)
-    EssentialMaterialStorage.load(preset, texture)
+def loadMaterials(wait=True):
+    """If not <wait>, materials are loaded while MainAssetPipeline is drained"""
+    job = loadMaterialPack(STN_MATERIAL_PACK, EssentialMaterialStorage)
+    if wait:
+        MainAssetPipeline.wait(job.name)
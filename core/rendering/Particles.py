@@ -1,33 +1,24 @@
-from core.rendering.PyOGL import bindEBO, LightingManager
+from core.rendering.PyOGL import LightingManager, StreamingBuffer
 from core.rendering.Shaders import shaders
 from core.Constants import MAX_PARTICLES
 from core.Typing import FLOAT32, ZERO_FLOAT32
 from core.math.linear import FullTransformMat
-from core.math.prandom import randf
-from pymunk import Body, Shape
 from core.physic.physics import MainPhysicSpace, makeBodyCircle, makeShapeCircle
 from core.objects.gObjectTools import shapeFilter, COLLISION_CATEGORIES
+from utils.profiler import profiled
 
-from math import sin, cos, radians
 from random import randint
 from beartype import beartype
 import numpy as np
 from typing import Dict, Tuple, Union
 from pymunk import Vec2d
-from dataclasses import dataclass, field
 
 
 from OpenGL.GL import \
-    glGenBuffers,\
     glDisable,\
     glEnable,\
-    glBindBuffer,\
-    glBufferData,\
-    glDrawElements,\
+    glDrawArrays,\
     GL_POINTS,\
-    GL_UNSIGNED_INT,\
-    GL_ARRAY_BUFFER,\
-    GL_STATIC_DRAW,\
     GL_DEPTH_TEST
 
 
@@ -36,138 +27,177 @@ __all__ = [
 ]
 
 
-@dataclass
-class Particle:
+class ParticlePool:
+    __doc__ = """
+    Preallocated structure-of-arrays storage for particles of one type.
+    Live particles always occupy rows [0, count), so rows [count, capacity)
+    are the free list and render data is one contiguous slice.
+
+    vertex:     np.ndarray[capacity, 9]  -> GPU layout (position[3], color[4], size[2])
+    velocity:   np.ndarray[capacity, 2]
+    gravity:    np.ndarray[capacity]
+    curr_time:  np.ndarray[capacity]
+    max_time:   np.ndarray[capacity]
+    alpha:      np.ndarray[capacity]     -> base alpha, faded by curr_time / max_time
+    """
+
     __slots__ = (
-        "position", "velocity", "gravity", "curr_time",
-        "max_time", "color", "size"
+        "capacity", "count", "vertex", "position", "color", "size",
+        "velocity", "gravity", "curr_time", "max_time", "alpha"
     )
 
-    position: field(default_factory=np.ndarray)
-    velocity: field(default_factory=np.ndarray)
-    gravity: field(default_factory=FLOAT32)
-    curr_time: field(default_factory=float)
-    max_time: field(default_factory=float)
-    color: field(default_factory=np.ndarray)
-    size: field(default_factory=np.ndarray)
-
-    def update(self, dt) -> bool:
-        self.position += self.velocity * dt
-        self.position[1] -= self.gravity * dt
-        self.curr_time -= dt
-        if self.curr_time <= 0.0:
-            return True
-        return False
+    def __init__(self, capacity: int = MAX_PARTICLES):
+        self.capacity = capacity
+        self.count = 0
 
-    def get_data(self):
-        c = self.color
-        return np.array(
-            [*self.position, 0.5, *c[:-1], c[-1] * (self.curr_time / self.max_time), *self.size]
-        ).flatten()
+        self.vertex = np.zeros((capacity, 9), dtype=FLOAT32)
+        self.position = self.vertex[:, 0:3]
+        self.color = self.vertex[:, 3:7]
+        self.size = self.vertex[:, 7:9]
 
-    def delete(self):
-        pass
+        self.velocity = np.zeros((capacity, 2), dtype=FLOAT32)
+        self.gravity = np.zeros(capacity, dtype=FLOAT32)
+        self.curr_time = np.zeros(capacity, dtype=FLOAT32)
+        self.max_time = np.ones(capacity, dtype=FLOAT32)
+        self.alpha = np.zeros(capacity, dtype=FLOAT32)
 
+    def __len__(self):
+        return self.count
 
-@dataclass
-class PhysicParticle:
-    __slots__ = (
-        "body", "shape", "curr_time", "start_time",
-        "color", "size", "delete_on_hit"
-    )
+    def _columns(self):
+        return self.vertex, self.velocity, self.gravity, self.curr_time, self.max_time, self.alpha
 
-    body: field(default_factory=Body)
-    shape: field(default_factory=Shape)
-    curr_time: field(default_factory=float)
-    start_time: field(default_factory=float)
-    color: field(default_factory=np.ndarray)
-    size: field(default_factory=np.ndarray)
-    delete_on_hit: field(default_factory=bool)
-
-    def __init__(self, idd, ptype, body, shape, curr_time,
-                 start_time, color, size, delete_on_hit):
-        self.body = body
-        self.shape = shape
-        self.curr_time = curr_time
-        self.start_time = start_time
-        self.color = color
-        self.size = size
-
-        self.shape.delete_on_hit = delete_on_hit
-        self.shape.idd = idd
-        self.shape.ptype = ptype
+    def reserve(self, amount: int) -> slice:
+        """Takes up to <amount> rows from the free list.
+        If pool is full, returned slice is shorter or empty"""
+        start = self.count
+        self.count = min(self.capacity, start + amount)
+        return slice(start, self.count)
 
-    @beartype
-    def update(self, dt: float) -> bool:
-        self.curr_time -= dt
-        if self.curr_time < 0.0:
-            self.delete()
-            return True
-        return False
+    def update(self, dt: float):
+        n = self.count
+        if not n:
+            return
+
+        pos = self.position[:n]
+        pos[:, :2] += self.velocity[:n] * dt
+        pos[:, 1] -= self.gravity[:n] * dt
+        self._fade(dt)
+
+    def _fade(self, dt: float):
+        n = self.count
+        t = self.curr_time[:n]
+        t -= dt
+        self.color[:n, 3] = self.alpha[:n] * np.maximum(t, 0.0) / self.max_time[:n]
+        self.compact(t > 0.0)
+
+    def compact(self, alive: np.ndarray) -> np.ndarray:
+        """Moves alive rows to the front of the pool.
+        :returns indices of removed rows (before compaction)"""
+        if alive.all():
+            return np.empty(0, dtype=np.intp)
+
+        keep = np.flatnonzero(alive)
+        m = len(keep)
+        for column in self._columns():
+            column[:m] = column[keep]
+
+        self.count = m
+        return np.flatnonzero(~alive)
+
+    def clear(self):
+        self.count = 0
+
+    @property
+    def data(self) -> np.ndarray:
+        """Contiguous render data of alive particles"""
+        return self.vertex[:self.count]
+
+
+class PhysicParticlePool(ParticlePool):
+    __doc__ = """
+    ParticlePool, which particles are driven by pymunk bodies.
+    Rows are still compacted, bodies, shapes and light sources are kept
+    in python lists in the same order. shape.idd always equals its row.
 
-    def get_data(self):
-        c = self.color
-        return np.array([
-            *self.body.pos, 0.5, *c[:-1], c[-1] * (self.curr_time / self.start_time), *self.size
-        ]).flatten()
+    body_row:   np.ndarray[capacity]     -> row of body in World snapshot
+    """
+
+    __slots__ = ("bodies", "shapes", "lights", "body_row")
+
+    def __init__(self, capacity: int = MAX_PARTICLES):
+        super().__init__(capacity)
+        self.bodies = []
+        self.shapes = []
+        self.lights = []
+        self.body_row = np.zeros(capacity, dtype=np.intp)
 
-    def delete(self) -> None:
-        MainPhysicSpace.delete(self.body, self.shape)
+    def _columns(self):
+        return (*super()._columns(), self.body_row)
+
+    def update(self, dt: float):
+        n = self.count
+        if not n:
+            return
 
+        self.position[:n, :2] = MainPhysicSpace.render_positions[self.body_row[:n]]
+        self._fade(dt)
 
-class PhysicLightedParticle(PhysicParticle):
-    __slots__ = ("light_source", "idd_source")
+    def compact(self, alive: np.ndarray) -> np.ndarray:
+        removed = super().compact(alive)
+        if not len(removed):
+            return removed
 
-    def __init__(self, idd, ptype, body, shape, curr_time,
-                 start_time, color, size, delete_on_hit, **light_params):
-        super().__init__(idd, ptype, body, shape, curr_time, start_time, color, size, delete_on_hit)
-        l_tex, l_type = light_params.pop("texture"), light_params.pop("s_type")
-        self.idd_source, self.light_source = LightingManager.newSource(l_tex, l_type, **light_params)
+        for i in removed:
+            body, shape, light = self.bodies[i], self.shapes[i], self.lights[i]
+            MainPhysicSpace.untrack(body)
+            MainPhysicSpace.delete(body, shape)
+            if light is not None:
+                LightingManager.delete_source(*light)
 
-    def update(self, dt: float) -> bool:
-        if not super().update(dt):
-            self.light_source.posXY = self.body.position
-            return False
-        LightingManager.delete_source(self.idd_source)
-        return True
+        keep = np.flatnonzero(alive)
+        self.bodies = [self.bodies[i] for i in keep]
+        self.shapes = [self.shapes[i] for i in keep]
+        self.lights = [self.lights[i] for i in keep]
+
+        for row in range(removed[0], self.count):
+            self.shapes[row].idd = row
+        return removed
+
+    def expire(self, row: int):
+        """Particle will be deleted on next update"""
+        self.curr_time[row] = 0.0
+
+    def clear(self):
+        self.compact(np.zeros(self.count, dtype=bool))
 
 
 class __ParticleManager:
     __doc__ = """
-    Particle: [
-        position:   np.ndarray[3],
-        velocity:   np.ndarray[2],   
-        gravity:    FLOAT32, 
-        curr time:  float,  
-        start time: float,
-        base color: np.ndarray[4],
-        size:       np.ndarray[2]
-    ]
-    
-    Physic Particle: [
-        body:       pymunk.Body,
-        shape:      pymunk.Shape (Circle),
-        curr_time:  float,
-        start_time: float,
-        base_color: np.ndarray[4],
-        size:       np.ndarray[2],
-    ]
+    Each particle type (ptype) has two pools: simple and physic.
+    Simple particles are moved by vectorized operations over ParticlePool columns.
+    Physic particles take positions from their pymunk bodies.
+
+    Physic particle's shape has:
+        idd:            int  -> row in PhysicParticlePool
+        ptype:          int
+        delete_on_hit:  bool
     """
 
-    particles: Dict[int, Dict] = {}
-    free_ids = set(range(MAX_PARTICLES))
-
-    vbo_id: int
+    simple: Dict[int, ParticlePool] = {}
+    physic: Dict[int, PhysicParticlePool] = {}
 
     shaders = {
         0: "ParticlePolyShader",
     }
 
     def __init__(self):
-        self.particles = {
-            i: dict() for i in self.__class__.shaders.keys()
+        self.simple = {
+            i: ParticlePool() for i in self.__class__.shaders.keys()
+        }
+        self.physic = {
+            i: PhysicParticlePool() for i in self.__class__.shaders.keys()
         }
-        self.vbo_id = glGenBuffers(1)
         self.__setup_collision_handler()
 
     @staticmethod
@@ -181,7 +211,7 @@ class __ParticleManager:
                 elasticity = shape.elasticity
 
                 if shape.delete_on_hit:
-                    ParticleManager.delete_physic_particle(shape, space)
+                    ParticleManager.expire_physic(shape)
                     return False
                 elif elasticity > 0.0:
                     shape.body.velocity = \
@@ -191,22 +221,46 @@ class __ParticleManager:
 
         handler2.begin = particleCollisionHandlerPost
 
+    @profiled("particles.update")
     @beartype
     def update(self, dt: float):
-        for key in self.particles.keys():
-            particles = self.particles[key]
-            to_delete = set()
-
-            for k, p in particles.items():
-                if p.update(dt):
-                    self.free_ids.add(k)
-                    to_delete.add(k)
-
-            for _ in range(len(to_delete)):
-                del self.particles[key][to_delete.pop()]
+        for pool in self.simple.values():
+            pool.update(dt)
+        for pool in self.physic.values():
+            pool.update(dt)
 
     _T = Tuple[int, int]
 
+    @staticmethod
+    def __random_params(pool, amount, speed, time, color, size_x, size_y, angles):
+        """Fills common columns of reserved rows.
+        :returns (slice of new rows, velocities of new particles)"""
+        rows = pool.reserve(randint(*amount))
+        k = rows.stop - rows.start
+        if not k:
+            return rows, None
+
+        rand = np.random.randint
+        pairs = np.array(angles).reshape(-1, 2)
+        low, high = pairs[rand(0, len(pairs), k)].T
+        a = np.radians(rand(low, high + 1))
+        vel = np.stack([np.cos(a), np.sin(a)], axis=1) * rand(speed[0], speed[1] + 1, k)[:, None]
+
+        t = np.random.uniform(*time, k)
+        pool.curr_time[rows] = t
+        pool.max_time[rows] = t
+
+        pool.color[rows] = color
+        pool.alpha[rows] = color[3]
+        pool.size[rows, 0] = rand(size_x[0], size_x[1] + 1, k)
+        if size_y:
+            pool.size[rows, 1] = rand(size_y[0], size_y[1] + 1, k)
+        else:
+            pool.size[rows, 1] = pool.size[rows, 0]
+
+        pool.position[rows, 2] = 0.5
+        return rows, vel
+
     @beartype
     def create_simple(self,
                       ptype: int,
@@ -220,31 +274,14 @@ class __ParticleManager:
                       angles: Tuple = (0, 360),
                       gravity: float = 0.0):
 
-        rd = randint
-        rf = randf
-        base_color = np.array(color)
-        angles_lenn = len(angles) // 2 - 1
-
-        for _ in range(rd(*amount)):
-            a = rd(0, angles_lenn)
-            a = radians(rd(*angles[a * 2: a * 2 + 2]))
-
-            vel = np.array(
-                [v * rd(*speed) for v in (cos(a), sin(a))], dtype=FLOAT32
-            )
-            t = rf(*time)
-            idd = self.new_id(ptype)
-            sx = rd(*size_x)
-            sy = rd(*size_y) if size_y else sx
-            self.particles[ptype][idd] = Particle(
-                np.array(pos, dtype=FLOAT32),
-                vel,
-                gravity,
-                t,
-                t,
-                base_color,
-                np.array([sx, sy], dtype=FLOAT32)
-            )
+        pool = self.simple[ptype]
+        rows, vel = self.__random_params(pool, amount, speed, time, color, size_x, size_y, angles)
+        if vel is None:
+            return
+
+        pool.position[rows, :2] = pos
+        pool.velocity[rows] = vel
+        pool.gravity[rows] = gravity
 
     @beartype
     def create_physic(self,
@@ -259,44 +296,40 @@ class __ParticleManager:
                       angles: Tuple = (0, 360),
                       collide_with=('level', ),
                       delete_on_hit=False,
-                      elasticity: float = 0.0):
-
-        rd = randint
-        rf = randf
-        base_color = np.array(color)
-        angles_lenn = len(angles) // 2 - 1
+                      elasticity: float = 0.0,
+                      light_params: Union[Dict, None] = None):
 
-        for _ in range(rd(*amount)):
-            a = rd(0, angles_lenn)
-            a = radians(rd(*angles[a * 2: a * 2 + 2]))
+        pool = self.physic[ptype]
+        rows, vel = self.__random_params(pool, amount, speed, time, color, size_x, size_y, angles)
+        if vel is None:
+            return
 
-            vel = Vec2d(
-                cos(a), sin(a)
-            ) * rd(*speed)
-
-            t = rf(*time)
-            idd = self.new_id(ptype)
-            sx = rd(*size_x)
-            sy = rd(*size_y) if size_y else sx
+        pool.position[rows, :2] = pos
+        shape_filter = shapeFilter('particle', collide_with=collide_with)
 
+        for row, v in zip(range(rows.start, rows.stop), vel):
             body = makeBodyCircle(pos, 2, 'dynamic', mass=1.0)
-            shape = makeShapeCircle(body, 4, friction=0,
-                                    shape_filter=shapeFilter('particle', collide_with=collide_with))
-            body.velocity = vel
+            shape = makeShapeCircle(body, 4, friction=0, shape_filter=shape_filter)
+            body.velocity = Vec2d(*v)
             shape.elasticity = elasticity
             MainPhysicSpace.add(body, shape)
+            MainPhysicSpace.track(body)
+            pool.body_row[row] = body.snapshot_index
+
+            shape.idd = row
+            shape.ptype = ptype
+            shape.delete_on_hit = delete_on_hit
 
-            self.particles[ptype][idd] = PhysicParticle(
-                idd,
-                ptype,
-                body,
-                shape,
-                t,
-                t,
-                base_color,
-                np.array([sx, sy], dtype=FLOAT32),
-                delete_on_hit
-            )
+            light = None
+            if light_params is not None:
+                params = dict(light_params)
+                l_tex, l_type = params.pop("texture"), params.pop("s_type")
+                params.setdefault("pos", pos)
+                light = (l_tex, *LightingManager.newSource(l_tex, l_type, body=body, **params))
+
+            pool.bodies.append(body)
+            pool.shapes.append(shape)
+            pool.lights.append(light)
 
     @beartype
     def create_physic_light(self,
@@ -308,91 +341,52 @@ class __ParticleManager:
                             color: Tuple[float, float, float, float],
                             size_x: _T,
                             size_y: Union[_T, None],
-                            light_params: Tuple,
+                            light_params: Dict,
                             angles: Tuple = (0, 360),
                             collide_with=('level',),
                             delete_on_hit=False,
                             elasticity: float = 0.0):
+        """light_params:: kwargs of LightingManager.newSource with "texture" and "s_type" keys.
+        Light source follows its particle and is deleted with it"""
+        self.create_physic(ptype, pos, amount, speed, time, color, size_x, size_y,
+                           angles, collide_with, delete_on_hit, elasticity, light_params)
 
-        rd = randint
-        rf = randf
-        base_color = np.array(color)
-        angles_lenn = len(angles) // 2 - 1
-
-        for _ in range(rd(*amount)):
-            a = rd(0, angles_lenn)
-            a = radians(rd(*angles[a * 2: a * 2 + 2]))
-
-            vel = Vec2d(cos(a), sin(a)) * rd(*speed)
+    def expire_physic(self, shape):
+        self.physic[shape.ptype].expire(shape.idd)
 
-            t = rf(*time)
-            idd = self.new_id(ptype)
-            sx = rd(*size_x)
-            sy = rd(*size_y) if size_y else sx
-
-            body = makeBodyCircle(pos, 2, 'dynamic', mass=1.0)
-            shape = makeShapeCircle(body, 4, friction=0,
-                                    shape_filter=shapeFilter('particle', collide_with=collide_with))
-            body.velocity = vel
-            shape.elasticity = elasticity
-            MainPhysicSpace.add(body, shape)
-
-            self.particles[ptype][idd] = PhysicLightedParticle(
-                idd,
-                ptype,
-                body,
-                shape,
-                t,
-                t,
-                base_color,
-                np.array([sx, sy], dtype=FLOAT32),
-                delete_on_hit,
-                *light_params
-            )
-
-    def new_id(self, shape):
-        """If the is no free ids for Particle,
-        then it returns last added Particle's id"""
-        if self.free_ids:
-            return self.free_ids.pop()
-        return self.particles[shape].popitem()[0]
-
-    def delete_physic_particle(self, shape, space):
-        key = shape.idd
-        ptype = shape.ptype
-
-        if key in self.particles[ptype].keys():
-            del self.particles[ptype][key]
-            self.free_ids.add(key)
-            space.remove(shape, shape.body)
+    def clear(self):
+        for pool in self.simple.values():
+            pool.clear()
+        for pool in self.physic.values():
+            pool.clear()
 
+    @profiled("particles.render")
     def render(self, camera):
-        bindEBO(2)
         glDisable(GL_DEPTH_TEST)
+        mat = None
 
-        for key in self.particles.keys():
-            particles = self.particles[key]
-            if not particles:
-                continue
-            Shader = shaders[self.shaders[key]]
-            Shader.use()
+        for key in self.shaders.keys():
+            for pool in (self.simple[key], self.physic[key]):
+                if not pool.count:
+                    continue
 
-            data = np.array(
-                [p.get_data() for p in particles.values()], dtype=FLOAT32
-            ).flatten()
-            self.__drawGL_from_data(data, camera, len(particles), Shader)
+                Shader = shaders[self.shaders[key]]
+                Shader.use()
+                if mat is None:
+                    mat = FullTransformMat(ZERO_FLOAT32, ZERO_FLOAT32, camera.get_matrix(), ZERO_FLOAT32)
+                self.__drawGL_from_data(pool.data, mat, pool.count, Shader)
 
-        bindEBO()
         glEnable(GL_DEPTH_TEST)
 
-    def __drawGL_from_data(self, data, camera_, elements, shader):
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbo_id)
-        glBufferData(GL_ARRAY_BUFFER, data.nbytes, data, GL_STATIC_DRAW)
+    @staticmethod
+    def __drawGL_from_data(data, mat, elements, shader):
+        stride = data.strides[0]
+        offset = StreamingBuffer.push(data, stride)
 
-        mat = FullTransformMat(ZERO_FLOAT32, ZERO_FLOAT32, camera_.get_matrix(), ZERO_FLOAT32)
+        shader.bindVertexArray(StreamingBuffer.vbo)
         shader.prepareDraw(transform=mat)
 
-        glDrawElements(GL_POINTS, elements, GL_UNSIGNED_INT, None)
+        glDrawArrays(GL_POINTS, offset // stride, elements)
 
 
 ParticleManager = __ParticleManager()
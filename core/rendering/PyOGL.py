@@ -14,8 +14,13 @@ from core.rendering.Textures import GlTexture
 from core.rendering.Textures import EssentialTextureStorage as Ets
 from core.rendering.Materials import EssentialMaterialStorage as Ems
 import core.math.linear as lin
+from utils.profiler import profiled
+from core.math.spatial import SpatialHash, cullCircles
 
 from collections import namedtuple
+from functools import partial
+from operator import itemgetter
+from math import degrees, hypot
 from beartype import beartype
 import numpy as np
 import warnings
@@ -27,11 +32,12 @@ import pygame
     
     render pipeline after initDisplay:
         preRender() -> prepare to render
+            StreamingBuffer.next_frame()
             clearDisplay()
         
         [MAIN PHASE, RENDERING ALL IN-GAME OBJECTS]
         drawGroupsFinally()
-            drawTexture()
+            RenderUpdateGroup.collect() -> MainRenderQueue.flush()
         drawAllLines()
             drawLineBackend()
         renderLights()
@@ -46,6 +52,8 @@ import pygame
 clear_color = (0.0, 0.0, 0.0, 0.0)
 
 FIRST_EBO: uintc
+UNIT_QUAD: int
+"""VBO of drawDataUnitQuad, shared by all instanced objects"""
 T_RENDER_OBJECT = Union["RenderObject", "RenderObjectComposite"]
 
 
@@ -127,7 +135,7 @@ camera: Camera
 # RENDER GROUP
 class RenderUpdateGroup:
     __slots__ = (
-        '_visible', 'objects', 'updatable', 'frame_buffer', 'shader', 'depth_write'
+        '_visible', 'objects', 'updatable', 'frame_buffer', 'shader', 'depth_write', '_transform_caches'
     )
     """Container for in-game Objects"""
 
@@ -140,6 +148,7 @@ class RenderUpdateGroup:
         if self.shader is None:
             raise Error(f"There is no shader with name: {shader}")
         self._visible = visible
+        self._transform_caches = {}
 
     def __repr__(self):
         return f'<RenderUpdateGroup({len(self.objects)})>'
@@ -151,6 +160,18 @@ class RenderUpdateGroup:
             key = self._get_object_key(obj)
             uid = self._add_one(obj, key)
             if hasattr(obj, "update"): self.updatable[uid] = obj
+        self.changed()
+
+    def changed(self):
+        """Called when objects are added, removed or change their orientation or scale"""
+        self._transform_caches.clear()
+
+    def transform_cache(self, key, objects) -> "TransformCache":
+        cache = self._transform_caches.get(key)
+        if cache is None:
+            cache = TransformCache(objects)
+            self._transform_caches[key] = cache
+        return cache
 
     @staticmethod
     def _get_object_key(obj):
@@ -175,39 +196,64 @@ class RenderUpdateGroup:
 
     """drawing all of this group objects"""
     def draw_all(self, object_ids=None):
-        """
-        to_draw:: Set of Physic Objects body hash, that should be rendered
-        If None, all object will be rendered"""
-
-        if not self.pre_draw(): return
-        glActiveTexture(GL_TEXTURE0)
-
-        for texture_key, objects in self.objects.items():
-            glBindTexture(GL_TEXTURE_2D, texture_key)
-            for obj in objects.values():
-                obj.draw_single(self.shader)
-
-    def pre_draw(self):
-        if not self._visible:
-            return False
-
-        self.shader.use()
-        return True
+        """Draws only this group.
+        drawGroupsFinally should be used to draw many groups, it sorts draw items of all of them together"""
+        queue = RenderQueue()
+        self.collect(queue)
+        queue.flush()
+
+    def collect(self, queue: "RenderQueue"):
+        """Submits draw items of this group to <queue>, no GL calls.
+        If group uses DefaultShader, objects that differ only in transform and texture
+        are drawn as instances of UNIT_QUAD, others are drawn one by one with their own VBO"""
+        if not self._visible: return
+
+        quad_shader = Shaders.shaders['DefaultInstancedShader'] \
+            if type(self.shader) is Shaders.DefaultShader else None
+        quads = []
+
+        for obj in self.iter_objects():
+            if quad_shader is not None and obj.quad_compatible:
+                quads.append(obj)
+            elif obj.visible:
+                queue.submit_draw(self.shader, partial(obj.draw_single, self.shader),
+                                  obj.vbo, (self._get_object_key(obj), ), obj.layer)
+
+        if not quads: return
+        visible, transforms = batchTransform(quads, self.transform_cache('quad', quads))
+        shown = np.fromiter((quads[i].visible for i in visible), dtype=bool, count=len(visible))
+        if not shown.any(): return
+
+        visible = visible[shown]
+        instances = np.empty(len(visible), dtype=quad_shader.INSTANCE_DTYPE)
+        instances['transform'] = transforms[shown]
+        instances['tex'] = [self._get_object_key(quads[i]) for i in visible]
+        instances['uv'] = [objectUV(quads[i]) for i in visible]
+        queue.submit(quad_shader, UNIT_QUAD, instances)
+
+    def iter_objects(self):
+        for objs in self.objects.values():
+            yield from objs.values()
 
     """Deleting all of group.sprites()"""
     def delete_all(self):
-        for objs in self.objects.values():
-            for obj in objs.values():
-                obj.delete()
+        for obj in list(self.iter_objects()):
+            obj.group = None
+            obj.delete()
         self.objects = {}
+        self.updatable = {}
+        self.changed()
 
     def remove(self, obj):
-        if hasattr(obj, "curr_image"):
-            key = obj.curr_image().key
-        else:
-            key = "noTex"
-        ind = self.objects[key].index(obj)
-        del self.objects[key][ind]
+        # key of object could change since it was added (e.g. animation frame), so all keys are checked
+        uid = obj.UID
+        for key, objs in self.objects.items():
+            if objs.pop(uid, None) is not None:
+                if not objs:
+                    del self.objects[key]
+                break
+        self.updatable.pop(uid, None)
+        self.changed()
 
 
 class RenderUpdateGroup_Instanced(RenderUpdateGroup):
@@ -231,38 +277,68 @@ class RenderUpdateGroup_Instanced(RenderUpdateGroup):
         self.objects[key][second_key].append( obj )
         return uid
 
-    def draw_all(self, object_ids=()):
-        """
-        to_draw:: Set of Physic Objects body hash, that should be rendered
-        If None, all object will be rendered"""
-        if not self.pre_draw(): return
+    def iter_objects(self):
+        for objs_by_tex in self.objects.values():
+            for objs in objs_by_tex.values():
+                yield from objs
 
+    def remove(self, obj):
+        objs_by_tex = self.objects.get(obj.vbo, {})
+        for tex, objs in objs_by_tex.items():
+            if obj in objs:
+                objs.remove(obj)
+                if not objs:
+                    del objs_by_tex[tex]
+                break
+        self.updatable.pop(obj.UID, None)
+        self.changed()
+
+    def collect(self, queue: "RenderQueue"):
+        if not self._visible: return
+        for vbo, instances in self.batches():
+            queue.submit(self.shader, vbo, instances)
+
+    def batches(self):
+        """CPU side of drawing, no GL calls
+        :yields (vbo, shader.INSTANCE_DTYPE instances of visible objects), 'tex' of instances is GL texture key"""
         for vbo, objects_by_tex in self.objects.items():
-            tex_slot = 0
-            objects_added = 0
-
-            for tex, objects in objects_by_tex.items():
-                glActiveTexture(GL_TEXTURE0 + tex_slot)
-                glBindTexture(GL_TEXTURE_2D, tex)
-                self.shader.passTexture(f"Textures[{tex_slot}]", tex_slot)
+            objects = [obj for objs in objects_by_tex.values() for obj in objs]
+            if not objects: continue
 
-                Transform = np.asfortranarray( [obj.get_transform() for obj in objects], dtype=FLOAT32)
-                self.shader.passMat4V(f"Transform[{objects_added}]", Transform)
-                InstanceTex = np.asfortranarray( [tex_slot for _ in range(len(objects))], dtype=UINT )
-                self.shader.passUIntV(f"InstanceTex[{objects_added}]", InstanceTex)
+            cache = self.transform_cache(vbo, objects)
+            visible, transforms = batchTransform(objects, cache)
+            if not len(visible): continue
 
-                tex_slot += 1
-                objects_added += len(objects)
-
-            glBindBuffer(GL_ARRAY_BUFFER, vbo)
-            self.shader.prepareDraw()
-            glDrawElementsInstanced(GL_TRIANGLES, 6, GL_UNSIGNED_INT, None, objects_added)
+            instances = np.empty(len(visible), dtype=self.shader.INSTANCE_DTYPE)
+            instances['transform'] = transforms
+            instances['tex'] = np.repeat(
+                np.fromiter(objects_by_tex.keys(), dtype=np.uint32, count=len(objects_by_tex)),
+                [len(objs) for objs in objects_by_tex.values()]
+            )[visible]
+            instances['uv'] = cache.uv[visible]
+            yield vbo, instances
 
 
 class RenderUpdateGroup_Materials(RenderUpdateGroup):
+    """Level geometry. Objects with static bodies are indexed in SpatialHash once,
+    only the ones near camera are drawn. Other objects are culled every frame"""
     def __init__(self, shader="DefaultMaterialShader", visible=True, depth_write=True):
+        self._static = None
         super().__init__(shader, visible, depth_write)
 
+    def changed(self):
+        super().changed()
+        self._static = None
+
+    def iter_objects(self):
+        yield from self.objects.values()
+
+    def remove(self, obj):
+        uid = obj.UID
+        self.objects.pop(uid, None)
+        self.updatable.pop(uid, None)
+        self.changed()
+
     def add(self, *objs: [T_RENDER_OBJECT, ]):
         """You can redefine how objects are added and how they are sorted
         by changing _get_object_key and _add_one of child classes"""
@@ -270,36 +346,307 @@ class RenderUpdateGroup_Materials(RenderUpdateGroup):
             uid = obj.UID
             self.objects[uid] = obj
             if hasattr(obj, "update"): self.updatable[uid] = obj
+        self.changed()
+
+    def collect(self, queue: "RenderQueue"):
+        if not self._visible: return
+        for vbo, instances in self.batches():
+            queue.submit(self.shader, vbo, instances, Ems.bind)
+
+    def batches(self):
+        """CPU side of drawing, no GL calls
+        :yields (vbo, shader.INSTANCE_DTYPE instances of visible objects)"""
+        # index is built on first draw, objects get their bodies after being added to group
+        if self._static is None:
+            self._static = StaticIndex(self.objects.values())
+        static = self._static
+
+        l_, r, b, t = camera.ortho_params
+        rows = static.grid.query(l_, b, r, t)
+        if len(rows):
+            vbos = static.vbo[rows]
+            for vbo in np.unique(vbos):
+                sub = rows[vbos == vbo]
+                instances = np.empty(len(sub), dtype=self.shader.INSTANCE_DTYPE)
+                instances['transform'] = lin.BatchTransformFromParams(
+                    camera.get_matrix(), static.params[sub], static.quad[sub]
+                )
+                instances['scale'] = static.scale[sub]
+                instances['layer'] = static.layer[sub]
+                yield int(vbo), instances
+
+        for vbo, objects in static.dynamic.items():
+            visible, transforms = batchTransform(objects, self.transform_cache(vbo, objects))
+            if not len(visible): continue
+
+            instances = np.empty(len(visible), dtype=self.shader.INSTANCE_DTYPE)
+            instances['transform'] = transforms
+            instances['scale'] = [objects[i].scale for i in visible]
+            instances['layer'] = [objects[i].tex_layer for i in visible]
+            yield vbo, instances
+
+
+class RenderUpdateGroup_Baked(RenderUpdateGroup):
+    """Level geometry baked into RenderObjectBaked meshes, one draw call per mesh near camera"""
+    def __init__(self, shader="StaticMaterialShader", visible=True, depth_write=True):
+        super().__init__(shader, visible, depth_write)
 
-    def draw_all(self, object_ids=None):
-        if not self.pre_draw(): return
-        Ems.bind()
+    def add(self, *objs: ["RenderObjectBaked", ]):
+        for obj in objs:
+            self.objects[obj.UID] = obj
+        self.changed()
+
+    def iter_objects(self):
+        yield from self.objects.values()
+
+    def remove(self, obj):
+        self.objects.pop(obj.UID, None)
+        self.changed()
+
+    def collect(self, queue: "RenderQueue"):
+        if not self._visible: return
+
+        l_, r, b, t = camera.ortho_params
+        for obj in self.objects.values():
+            ol, or_, ob, ot = obj.bounds
+            if or_ < l_ or ol > r or ot < b or ob > t:
+                continue
+            queue.submit_draw(self.shader, partial(obj.draw_single, self.shader), obj.vbo, Ems.bind)
+
+
+class StaticIndex:
+    """Draw data of static objects of RenderUpdateGroup_Materials, indexed by rows in SpatialHash.
+    Objects without static body are only sorted by vbo in dynamic"""
+    __slots__ = ('grid', 'params', 'quad', 'scale', 'layer', 'vbo', 'dynamic')
+
+    def __init__(self, objects):
+        static = []
+        self.dynamic = {}
+        for obj in objects:
+            if obj.is_static:
+                static.append(obj)
+            else:
+                self.dynamic.setdefault(obj.vbo, []).append(obj)
+
+        self.params = np.array([obj.transform_params() for obj in static], dtype=FLOAT32).reshape(-1, 6)
+        self.quad = np.array([obj.quad_params for obj in static], dtype=FLOAT32).reshape(-1, 3)
+        self.scale = np.array([obj.scale for obj in static], dtype=FLOAT32).reshape(-1, 2)
+        self.layer = np.array([obj.tex_layer for obj in static], dtype=FLOAT32)
+        self.vbo = np.array([obj.vbo for obj in static], dtype=INT64)
+
+        self.grid = SpatialHash()
+        for row, obj in enumerate(static):
+            # bounds of rotated rectangle
+            x_, y_, z_rotation = self.params[row, 0:3]
+            s, c = lin.sincos(float(z_rotation))
+            hw, hh = obj.half_size
+            w, h = abs(c) * hw + abs(s) * hh, abs(s) * hw + abs(c) * hh
+            self.grid.insert(row, x_ - w, y_ - h, x_ + w, y_ + h)
+
+
+class TransformCache:
+    """Inputs of batchTransform for one list of RenderObjects drawn with UNIT_QUAD.
+    Reflections, scales, quad params and bounding radii are stored once, positions and angles of physic objects
+    are gathered from World snapshot by their rows.
+    Group drops its caches when objects are added, removed, reoriented or rescaled"""
+    __slots__ = ('params', 'quad', 'uv', 'physic_idx', 'rows', 'placed_idx', 'radii')
+
+    def __init__(self, objects):
+        self.params = np.array([obj.transform_params() for obj in objects], dtype=FLOAT32)
+        self.quad = np.array([obj.quad_params for obj in objects], dtype=FLOAT32)
+        self.uv = np.array([objectUV(obj) for obj in objects], dtype=FLOAT32).reshape(-1, 4)
+        self.radii = np.array([obj.bounding_radius for obj in objects], dtype=FLOAT32)
+        rows = np.array([obj.snapshot_row for obj in objects], dtype=INT64)
+
+        self.physic_idx = np.flatnonzero(rows >= 0)
+        self.rows = rows[self.physic_idx]
+        self.placed_idx = np.flatnonzero(rows < 0).tolist()
+
+
+def physicWorld():
+    # Imported here, because physics module depends on this one
+    from core.physic.physics import MainPhysicSpace
+    return MainPhysicSpace
+
+
+def objectUV(obj) -> np.ndarray:
+    """uv rect of current texture of object on its atlas page, whole texture if object has no GlTexture"""
+    try:
+        return obj.curr_image().uv
+    except AttributeError as _:
+        return FULL_UV
+
+
+def batchTransform(objects, cache: TransformCache) -> tuple:
+    """Transforms of given RenderObjects that are in camera field, computed in one vectorized pass
+    :returns (indices of visible objects, (N, 4, 4) transforms of them)"""
+    params = cache.params
+
+    if len(cache.rows):
+        world = physicWorld()
+        params[cache.physic_idx, 0:2] = world.render_positions[cache.rows]
+        params[cache.physic_idx, 2] = np.degrees(world.render_angles[cache.rows])
+
+    for i in cache.placed_idx:
+        params[i] = objects[i].transform_params()
+
+    visible = np.flatnonzero(cullCircles(params, cache.radii, camera.ortho_params))
+    return visible, lin.BatchTransformFromParams(camera.get_matrix(), params[visible], cache.quad[visible])
+
+
+def drawInstanced(shader, vbo, instances: np.ndarray, elements=6, prepared=False):
+    """Draws <vbo> once per instance.
+    Per-instance data (shader.INSTANCE_DTYPE) is streamed through StreamingBuffer,
+    batches bigger than MAX_INSTANCES are split into several draw calls
+    prepared:: VAO of <shader> with <vbo> is already bound by previous drawInstanced call"""
+    stride = instances.dtype.itemsize
+
+    if not prepared:
+        shader.bindVertexArray(vbo, FIRST_EBO, StreamingBuffer.vbo)
+        shader.prepareDraw()
+
+    for first in range(0, len(instances), MAX_INSTANCES):
+        batch = instances[first: first + MAX_INSTANCES]
+        base_instance = StreamingBuffer.push(batch, stride) // stride
+        glDrawElementsInstancedBaseInstance(
+            GL_TRIANGLES, elements, GL_UNSIGNED_INT, None, len(batch), base_instance
+        )
 
-        Transform = []
-        Scales = []
-        Layers = []
 
-        obj = None
-        for uid, obj in self.objects.items():
-            Transform.append( obj.get_transform() )
-            Scales.append( obj.scale )
-            Layers.append( obj.tex_layer )
+# RENDER QUEUE
+DrawItem = namedtuple('DrawItem', ('key', 'shader', 'vbo', 'textures', 'instances', 'draw'))
+"""key:: packed sort key, see RenderQueue.sort_key
+textures:: GL_TEXTURE_2D keys bound to slots 0..n, function that binds textures (e.g. Ems.bind)
+    or None, if 'tex' of instances are GL texture keys (shader.INSTANCE_TEXTURES)
+instances:: shader.INSTANCE_DTYPE array, drawn with drawInstanced
+draw:: function that draws item by itself, if item is not instanced"""
 
-        if not obj: return
-        obj_count = len(Transform)
 
-        Transform = np.asfortranarray(Transform, dtype=FLOAT32)
-        self.shader.passMat4V(f"Transform[0]", Transform)
+class RenderQueue:
+    __doc__ = """
+    Draw items of all RenderUpdateGroups of a frame.
+    
+    Groups submit items in collect(), build() sorts them by packed key
+        shader | texture | VBO | layer
+    and merges neighbouring instanced items with the same shader, textures and VBO into one draw.
+    Items with per-instance textures are merged regardless of their textures,
+    then split by MAX_TEXTURES_BIND textures per draw.
+    execute() binds shader, textures and vertex array only when they change.
+    
+    build() makes no GL calls, so CPU side of drawing can be measured without window
+    """
+
+    def __init__(self):
+        self.items: List[DrawItem] = []
 
-        Scales = np.asfortranarray(Scales, dtype=FLOAT32)
-        self.shader.passVec2fV(f"Scale[0]", Scales)
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+
+    @staticmethod
+    def sort_key(shader, textures, vbo, layer) -> int:
+        if textures is None:
+            tex = 0
+        elif callable(textures):
+            tex = 0xFFFF
+        else:
+            tex = textures[0] & 0xFFFF if textures else 0
+        return shader.sort_id << 48 | tex << 32 | (int(vbo) & 0xFFFF) << 16 | (int(layer) & 0xFFFF)
+
+    def submit(self, shader, vbo, instances: np.ndarray, textures=None, layer=0):
+        """Instanced item, drawn with drawInstanced"""
+        self.items.append(DrawItem(self.sort_key(shader, textures, vbo, layer), shader, vbo, textures, instances, None))
+
+    def submit_draw(self, shader, draw, vbo=0, textures=(), layer=0):
+        """Item that draws itself by calling draw(), after shader and textures are bound"""
+        self.items.append(DrawItem(self.sort_key(shader, textures, vbo, layer), shader, vbo, textures, None, draw))
+
+    def build(self) -> list:
+        """Sorts and merges items
+        :returns commands for execute(): (shader, vbo, textures, instances, draw)"""
+        items = sorted(self.items, key=itemgetter(0))
+        commands = []
+        i, n = 0, len(items)
+
+        while i < n:
+            _, shader, vbo, textures, instances, draw = items[i]
+            if draw is not None:
+                commands.append((shader, vbo, textures, None, draw))
+                i += 1
+                continue
+
+            j = i + 1
+            while j < n and items[j].draw is None and items[j].shader is shader \
+                    and items[j].vbo == vbo and items[j].textures == textures:
+                j += 1
+            if j - i > 1:
+                instances = np.concatenate([item.instances for item in items[i:j]])
+            i = j
+
+            if not shader.INSTANCE_TEXTURES:
+                commands.append((shader, vbo, textures, instances, None))
+                continue
+
+            # GL texture keys -> slots of Textures[MAX_TEXTURES_BIND]
+            keys, slots = np.unique(instances['tex'], return_inverse=True)
+            if len(keys) <= MAX_TEXTURES_BIND:
+                instances['tex'] = slots
+                commands.append((shader, vbo, tuple(keys.tolist()), instances, None))
+                continue
+
+            for first in range(0, len(keys), MAX_TEXTURES_BIND):
+                mask = (slots >= first) & (slots < first + MAX_TEXTURES_BIND)
+                batch = instances[mask]
+                batch['tex'] = slots[mask] - first
+                commands.append((shader, vbo, tuple(keys[first: first + MAX_TEXTURES_BIND].tolist()), batch, None))
+
+        return commands
+
+    @staticmethod
+    def execute(commands: list):
+        active_shader = None
+        prepared_vbo = None
+        bound = [None] * MAX_TEXTURES_BIND  # GL_TEXTURE_2D of slots
+        bound_by = None                       # last function that bound textures
+
+        for shader, vbo, textures, instances, draw in commands:
+            if shader is not active_shader:
+                active_shader = shader
+                prepared_vbo = None
+                shader.use()
+                if shader.INSTANCE_TEXTURES:
+                    for slot in range(MAX_TEXTURES_BIND):
+                        shader.passTexture(f"Textures[{slot}]", slot)
+
+            if callable(textures):
+                if textures != bound_by:
+                    bound_by = textures
+                    textures()
+            else:
+                Ets.touch(textures)
+                for slot, tex in enumerate(textures):
+                    if bound[slot] != tex:
+                        bound[slot] = tex
+                        glActiveTexture(GL_TEXTURE0 + slot)
+                        glBindTexture(GL_TEXTURE_2D, tex)
 
-        Layers = np.asfortranarray(Layers, dtype=FLOAT32)
-        self.shader.passUIntV(f"Layer[0]", Layers)
+            if draw is not None:
+                draw()
+                prepared_vbo = None
+                continue
 
-        glBindBuffer(GL_ARRAY_BUFFER, obj.vbo)
-        self.shader.prepareDraw()
-        glDrawElementsInstanced(GL_TRIANGLES, 6, GL_UNSIGNED_INT, None, obj_count)
+            drawInstanced(shader, vbo, instances, prepared=vbo == prepared_vbo)
+            prepared_vbo = vbo
+
+    def flush(self):
+        """Draws all items and clears queue"""
+        self.execute(self.build())
+        self.clear()
+
+
+MainRenderQueue = RenderQueue()
 
 
 # ANIMATION
@@ -344,7 +691,7 @@ class RenderObject:
 
     # public
     visible = True
-    group: Union["RenderUpdateGroup", "RenderUpdateGroup_Instanced"]
+    group: Union["RenderUpdateGroup", "RenderUpdateGroup_Instanced"] = None
 
     _size: tuple = None
     _colors: np.array = [ np.array([1.0, 1.0, 1.0, 1.0], dtype=np.float32) for _ in range(4) ]
@@ -363,17 +710,18 @@ class RenderObject:
 
         #  -1 for left   1 for right
         self._y_rotation = INT64( orientation )
-        if drawdata != "auto" and instanced:
+
+        # Objects with default draw data differ only in transform and texture, they can be drawn with UNIT_QUAD
+        self._quad = drawdata == "auto" and self._colors is RenderObject._colors
+        if instanced and not self._quad:
             instanced = False
-            warnings.warn("You can not use instanced rending with given drawdata")
+            warnings.warn("You can not use instanced rending with given drawdata or colors")
         self._instanced = instanced
         self._size = size if size else self.__class__._size
         self._layer = layer
 
-        if instanced:  # Instanced rendering
-            if not self.__class__._vbo:  # If there is VBO for this type of objects, this instance will use ready VBO
-                self.__class__._vbo = self.bufferize()
-            self._vbo = self.__class__._vbo
+        if instanced:  # Instanced rendering, all instanced objects share one VBO
+            self._vbo = UNIT_QUAD
 
         else:
             if drawdata == "auto":
@@ -412,22 +760,65 @@ class RenderObject:
 
     # DELETE
     def delete(self):
-        glBindBuffer(GL_ARRAY_BUFFER, self._vbo)
-        glBufferData(GL_ARRAY_BUFFER, 0, None, GL_STATIC_DRAW)
-        glDeleteBuffers(1, np.array(self._vbo, ))
+        # VBO of instanced objects is shared by all of them
+        if not self._instanced:
+            Shaders.releaseVertexArrays(self._vbo)
+            glBindBuffer(GL_ARRAY_BUFFER, self._vbo)
+            glBufferData(GL_ARRAY_BUFFER, 0, None, GL_STATIC_DRAW)
+            glDeleteBuffers(1, np.array(self._vbo, ))
         if self.group is not None:
             self.group.remove(self)
+            self.group = None
 
     def get_transform(self) -> TYPE_MAT:
         """Redefined in child classes"""
         pass
 
+    def transform_params(self) -> tuple:
+        """Redefined in child classes
+        :returns (x, y, z_rotation, y_reflect, scale_x, scale_y) for lin.BatchTransformMat"""
+        pass
+
+    @property
+    def snapshot_row(self) -> int:
+        """Row in World snapshot arrays. -1 if object is not driven by physic body"""
+        return -1
+
+    @property
+    def is_static(self) -> bool:
+        """True if object never moves, such objects are culled with SpatialHash"""
+        return False
+
+    @property
+    def half_size(self) -> tuple:
+        """Half of scaled width and height of object"""
+        return abs(self._size[0] * self._scaleX) / 2, abs(self._size[1] * self._scaleY) / 2
+
+    @property
+    def bounding_radius(self) -> float:
+        """Radius of circle that contains object in any rotation. Used for culling"""
+        return hypot(*self.half_size)
+
+    @property
+    def quad_compatible(self) -> bool:
+        """True if object can be drawn as instance of UNIT_QUAD"""
+        return self._quad
+
+    @property
+    def quad_params(self) -> tuple:
+        """(width, height, z) applied to UNIT_QUAD by per-instance transform"""
+        return self._size[0], self._size[1], zFromLayer(self._layer)
+
+    @property
+    def layer(self) -> int:
+        return self._layer
+
     def draw_single(self, shader):
         """Draws only this object to screen, using one draw call"""
         if not self.visible: return
 
-        glBindBuffer(GL_ARRAY_BUFFER, self._vbo)
-        shader.prepareDraw(camera=camera, transform=self.get_transform(), fbuffer=FB_Geometry)
+        shader.bindVertexArray(self._vbo, FIRST_EBO)
+        shader.prepareDraw(camera=camera, transform=self.get_transform(), fbuffer=FB_Geometry, uv=objectUV(self))
         glDrawElements(GL_TRIANGLES, 6, GL_UNSIGNED_INT, None)
 
     @property
@@ -442,6 +833,8 @@ class RenderObject:
     def scale(self, value: Union[TYPE_VEC, list, tuple]):
         self._scaleX = FLOAT32( value[0] )
         self._scaleY = FLOAT32( value[1] )
+        if self.group is not None:
+            self.group.changed()
 
     def set_color(self, new_color, vertex=None):
         """
@@ -458,6 +851,8 @@ class RenderObject:
         assert abs(new_rotation) == 1
         if self._y_rotation == new_rotation: return
         self._y_rotation = INT64(new_rotation)
+        if self.group is not None:
+            self.group.changed()
 
 
 class RenderObjectPlaced(RenderObject):
@@ -497,6 +892,10 @@ class RenderObjectPlaced(RenderObject):
             x_, y_, camera.get_matrix(), FLOAT32(0), self._y_rotation, self._scaleX, self._scaleY
         )
 
+    def transform_params(self):
+        x_, y_ = self.rect.pos
+        return x_, y_, 0.0, self._y_rotation, self._scaleX, self._scaleY
+
 
 class RenderObjectPhysic(RenderObject):
     """Alternative for RenderObjectPlaced
@@ -514,11 +913,85 @@ class RenderObjectPhysic(RenderObject):
         return lin.degreesFromNormal(self.body.rotation_vector)
 
     def get_transform(self):
-        x_, y_ = self.body.pos_FLOAT32
+        row = self.body.snapshot_index
+        if row == -1:
+            x_, y_ = self.body.pos_FLOAT32
+            z_rotation = FLOAT32(-self.z_rotation)
+        else:
+            world = physicWorld()
+            x_, y_ = world.render_positions[row]
+            z_rotation = FLOAT32(degrees(world.render_angles[row]))
+
         return lin.FullTransformMat(
-            x_, y_, camera.get_matrix(), FLOAT32(-self.z_rotation), self._y_rotation, self._scaleX, self._scaleY
+            x_, y_, camera.get_matrix(), z_rotation, self._y_rotation, self._scaleX, self._scaleY
         )
 
+    def transform_params(self):
+        # -z_rotation == body.angle in degrees
+        x_, y_ = self.body.pos
+        return x_, y_, degrees(self.body.angle), self._y_rotation, self._scaleX, self._scaleY
+
+    @property
+    def snapshot_row(self):
+        return self.body.snapshot_index
+
+    @property
+    def is_static(self):
+        return self.body.body_type == self.body.STATIC
+
+
+class RenderObjectBaked:
+    """Many static axis aligned rectangles of materials in one VBO.
+    Vertexes are transformed to world space once, so there is no per-object transform when drawing.
+    Vertex: position (x, y, z), texture coords and layer of material array (u, v, layer)"""
+
+    group = None
+
+    # two triangles of rectangle: (l, b) (r, b) (r, t) (r, t) (l, t) (l, b)
+    __CORNERS_X = np.array([0, 1, 1, 1, 0, 0], dtype=FLOAT32)
+    __CORNERS_Y = np.array([0, 0, 1, 1, 1, 0], dtype=FLOAT32)
+
+    def __init__(self, group, pos: np.ndarray, size: np.ndarray, tex_layer: np.ndarray, z: np.ndarray):
+        """pos, size:: (N, 2) centers and sizes of rectangles
+        tex_layer, z:: (N, ) layers of material array and depth of rectangles"""
+        cx, cy = RenderObjectBaked.__CORNERS_X, RenderObjectBaked.__CORNERS_Y
+        w, h = size[:, 0:1], size[:, 1:2]
+        left, bottom = pos[:, 0:1] - w / 2, pos[:, 1:2] - h / 2
+
+        data = np.empty((len(pos), 6, 6), dtype=FLOAT32)
+        data[..., 0] = left + w * cx
+        data[..., 1] = bottom + h * cy
+        data[..., 2] = z[:, None]
+        # same texture coords as material.vert: (InTexCoords * Scale), Scale = size / MATERIAL_SIZE
+        data[..., 3] = w * cx / MATERIAL_SIZE
+        data[..., 4] = h * (1 - cy) / MATERIAL_SIZE
+        data[..., 5] = tex_layer[:, None]
+
+        self.vertex_count = len(pos) * 6
+        self._vbo = bufferize(data)
+        self.bounds = (float(left.min()), float((left + w).max()), float(bottom.min()), float((bottom + h).max()))
+        """(left, right, bottom, top)"""
+
+        if group is not None:
+            group.add(self)
+        self.group = group
+
+    @property
+    def vbo(self):
+        return self._vbo
+
+    def draw_single(self, shader):
+        shader.bindVertexArray(self._vbo)
+        shader.prepareDraw(transform=camera.get_matrix())
+        glDrawArrays(GL_TRIANGLES, 0, self.vertex_count)
+
+    def delete(self):
+        Shaders.releaseVertexArrays(self._vbo)
+        glDeleteBuffers(1, np.array(self._vbo, ))
+        if self.group is not None:
+            self.group.remove(self)
+            self.group = None
+
 
 # RENDER COMPONENT
 class AnimatedRenderComponent:
@@ -646,11 +1119,13 @@ class RenderObjectComposite:
 
 # FRAME BUFFER
 class FrameBuffer:
+    """size:: px, viewport is set to it when buffer is bound
+    hdr:: color texture is RGBA16F, values are not clipped at 1.0"""
     vbo: int
     shader: Shaders.Shader
 
-    def __init__(self):
-        size = STN_WINDOW_RESOLUTION
+    def __init__(self, size=STN_WINDOW_RESOLUTION, hdr=False):
+        self.size = size
 
         self.key = glGenFramebuffers(1)
         glBindFramebuffer(GL_FRAMEBUFFER, self.key)
@@ -658,9 +1133,14 @@ class FrameBuffer:
         # TEXTURE FOR IMAGE BUFFER
         self.tex = glGenTextures(1)
         glBindTexture(GL_TEXTURE_2D, self.tex)
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, *size, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        if hdr:
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA16F, *size, 0, GL_RGBA, GL_HALF_FLOAT, None)
+        else:
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, *size, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
         glBindTexture(GL_TEXTURE_2D, 0)
         glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.tex, 0)
 
@@ -678,6 +1158,7 @@ class FrameBuffer:
 
     def bind(self):
         glBindFramebuffer(GL_FRAMEBUFFER, self.key)
+        glViewport(0, 0, *self.size)
         clearDisplay()
 
     def bind_texture(self, slot):
@@ -696,6 +1177,7 @@ class FrameBuffer:
     @staticmethod
     def unbind():
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glViewport(0, 0, *STN_WINDOW_RESOLUTION)
 
 
 class FrameBufferDepth(FrameBuffer):
@@ -720,18 +1202,24 @@ class FrameBufferDepth(FrameBuffer):
         glBindTexture(GL_TEXTURE_2D, self.rbo)
 
 
+SHADOW_MAP_SLOT = MAX_TEXTURES_BIND - 1  # texture unit of shadow map in light shaders
+
 FB_Geometry: FrameBufferDepth
 FB_Lighting: FrameBuffer
 LightingManager: __LightingManager
+StreamingBuffer: StreamBuffer
+GpuTimers: GpuTimer
 
 
 # DISPLAY
-def initDisplay(size=STN_WINDOW_RESOLUTION):
-    global camera, FB_Geometry, FB_Lighting, FIRST_EBO, LightingManager
+def initDisplay(size=STN_WINDOW_RESOLUTION, hidden=False):
+    """hidden:: window is never shown, only its GL context is used (benchmarks, tools)"""
+    global camera, FB_Geometry, FB_Lighting, FIRST_EBO, UNIT_QUAD, LightingManager, StreamingBuffer, GpuTimers
 
     #  Display flags
     flags = pygame.OPENGL | pygame.DOUBLEBUF | pygame.HWSURFACE | pygame.SRCALPHA
-    flags = flags | pygame.FULLSCREEN if FULL_SCREEN else flags
+    flags = flags | pygame.FULLSCREEN if FULL_SCREEN and not hidden else flags
+    flags = flags | pygame.HIDDEN if hidden else flags
     pygame.display.set_mode(size, flags=flags)
     
     #  OpenGL Version requirement
@@ -742,10 +1230,13 @@ def initDisplay(size=STN_WINDOW_RESOLUTION):
     #  Initialize render engine modules
     Shaders.init()
     LightingManager = __LightingManager()
+    StreamingBuffer = StreamBuffer()
+    GpuTimers = GpuTimer()
+    UNIT_QUAD = bufferize(drawDataUnitQuad())
 
     #  Preparing frame buffers
     FB_Geometry = FrameBufferDepth()
-    FB_Lighting = FrameBuffer()
+    FB_Lighting = FrameBuffer(LIGHT_BUFFER_RESOLUTION, hdr=LIGHT_BUFFER_HDR)
     clearDisplay()
 
     #  Initializing camera
@@ -775,79 +1266,129 @@ def setupIndices():
     ]
     first_ebo = None
     for i in indices:
+        # uploaded through GL_ARRAY_BUFFER, element buffer binding belongs to VAO
         ebo = glGenBuffers(1)
         if first_ebo is None:
             first_ebo = ebo
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ebo)
-        glBufferData(GL_ELEMENT_ARRAY_BUFFER, i, GL_STATIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, ebo)
+        glBufferData(GL_ARRAY_BUFFER, i, GL_STATIC_DRAW)
     FIRST_EBO = first_ebo
-    bindEBO()
 
 
-def bindEBO(offset=0):
-    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, FIRST_EBO + offset)
+def elementBuffer(offset=0) -> int:
+    """EBO of setupIndices: 0 - quad, 1 - line strip as lines, 2 - sequence.
+    Element buffer is bound with VAO, see Shader.bindVertexArray"""
+    return FIRST_EBO + offset
 
 
 def preRender(do_depth_test=True):
     # MY FRAME BUFFER
     camera.prepare_matrix()
+    StreamingBuffer.next_frame()
+    GpuTimers.next_frame()
+    GpuTimers.begin("geometry")
     FB_Geometry.bind()
 
     if do_depth_test:
         glEnable(GL_DEPTH_TEST)
 
 
+@profiled("render.groups")
 def drawGroupsFinally(object_ids, *groups):
     # THE ONLY WAY TO DRAW ON SCREEN
-    # Drawing each object in each group
+    # Draw items of all groups are sorted together by MainRenderQueue
 
     for group in groups:
-        group.draw_all(object_ids)
+        group.collect(MainRenderQueue)
+    MainRenderQueue.flush()
 
 
+@profiled("render.lights")
 def renderLights(camera_, ):
     lm = LightingManager
     if not lm.do_render:
         return
 
-    shader = lm.shader
+    GpuTimers.begin("lights")
     glBlendFunc(GL_ONE, GL_ONE)
     glDisable(GL_DEPTH_TEST)
 
+    visible = lm.visible(camera_.ortho_params)
+    if lm.shadows is not None:
+        lm.shadows.update(visible)
+        lm.shadows.bind(SHADOW_MAP_SLOT)
+
     FB_Lighting.bind()
-    shader.use()
 
-    light_groups = lm.generate_groups()
-    previous_tex = -1
-    for group in light_groups:
-        tex = Ets[ group["texture"] ].key
-        if tex != previous_tex:
-            previous_tex = tex
-            glActiveTexture(GL_TEXTURE0)
-            glBindTexture(GL_TEXTURE_2D, tex)
-
-        colors = []
-        scales = []
-        stencils = []
-        transforms = []
-
-        for i, source in enumerate( group["sources"] ):
-            transforms.append(source.get_transform(camera_))
-            colors.append(source.color)
-            scales.append(source.size)
-            stencils.append(0)
-
-        shader.passMat4V(f"sTransform[0]", np.asfortranarray(transforms, dtype=FLOAT32))
-        shader.passVec4fV(f"sColor[0]", np.asfortranarray(colors, dtype=FLOAT32))
-        shader.passVec2fV(f"sScale[0]", np.asfortranarray(scales, dtype=FLOAT32))
-        shader.passUIntV(f"sStencil[0]", np.asfortranarray(stencils, dtype=UINT))
-
-        glBindBuffer(GL_ARRAY_BUFFER, lm.vbo)
-        shader.prepareDraw()
-        glDrawElementsInstanced(GL_TRIANGLES, 6, GL_UNSIGNED_INT, None, len(group["sources"]))
+    if lm.tiles is not None:
+        renderLightsTiled(camera_, visible)
+    else:
+        renderLightsInstanced(camera_, visible)
 
     FrameBuffer.unbind()
     setDefaultBlendFunc()
+    GpuTimers.end()
+
+
+def renderLightsInstanced(camera_, visible):
+    """Every light in camera field is drawn as its own quad, one draw per MAX_TEXTURES_BIND lights of one texture,
+    length of sTransform, sColor, sScale and sStencil uniform arrays
+    visible:: texture -> (LightGroup, rows) of LightingManager.visible"""
+    lm = LightingManager
+    shader = lm.shader
+    shader.use()
+    shader.bindVertexArray(lm.vbo, FIRST_EBO)
+    shader.prepareDraw(shadow_slot=SHADOW_MAP_SLOT)
+    glActiveTexture(GL_TEXTURE0)
+
+    matrix = camera_.get_matrix()
+    for texture, (group, rows) in visible.items():
+        glBindTexture(GL_TEXTURE_2D, Ets[texture].key)
+
+        n = len(rows)
+        transforms = lin.BatchTransformMat(
+            matrix, group.pos[rows], group.rotation[rows], np.ones(n, dtype=FLOAT32), np.ones((n, 2), dtype=FLOAT32)
+        )
+        colors, scales, stencils = group.color[rows], group.size[rows], group.stencil[rows]
+
+        for first in range(0, n, MAX_TEXTURES_BIND):
+            chunk = slice(first, min(n, first + MAX_TEXTURES_BIND))
+            shader.passMat4V("sTransform[0]", transforms[chunk])
+            shader.passVec4fV("sColor[0]", colors[chunk])
+            shader.passVec2fV("sScale[0]", scales[chunk])
+            shader.passUIntV("sStencil[0]", stencils[chunk])
+            glDrawElementsInstanced(GL_TRIANGLES, 6, GL_UNSIGNED_INT, None, chunk.stop - first)
+
+
+def renderLightsTiled(camera_, visible):
+    """Lights in camera field are binned into screen tiles by LightTileGrid and summed
+    in one full-screen pass per MAX_TEXTURES_BIND - 1 light textures, the last unit is taken by shadow map
+    visible:: texture -> (LightGroup, rows) of LightingManager.visible"""
+    lm = LightingManager
+    ortho = camera_.ortho_params
+    visible = list(visible.items())
+    if not visible:
+        return
+
+    shader = lm.tiled_shader
+    shader.use()
+    shader.bindVertexArray(FB_Lighting.vbo, FIRST_EBO)
+    camera_rect = np.array((ortho[0], ortho[2], ortho[1] - ortho[0], ortho[3] - ortho[2]), dtype=FLOAT32)
+    shader.prepareDraw(camera_rect=camera_rect, viewport=FB_Lighting.size, tiles_x=lm.tiles.tiles_x,
+                       shadow_slot=SHADOW_MAP_SLOT)
+
+    step = MAX_TEXTURES_BIND - 1
+    for first in range(0, len(visible), step):
+        shown = []
+        for slot, (texture, group_rows) in enumerate(visible[first: first + step]):
+            glActiveTexture(GL_TEXTURE0 + slot)
+            glBindTexture(GL_TEXTURE_2D, Ets[texture].key)
+            shown.append(group_rows)
+
+        lm.tiles.upload(lm.tiles.pack(shown), ortho)
+        glDrawElements(GL_TRIANGLES, 6, GL_UNSIGNED_INT, None)
+
+    glActiveTexture(GL_TEXTURE0)
 
 
 def postRender(screen_shader):
@@ -859,11 +1400,13 @@ def postRender(screen_shader):
     lbuff = FB_Lighting
 
     # DEFAULT FRAME BUFFER
+    GpuTimers.end()
     renderLights(camera)
+    GpuTimers.begin("composite")
     clearDisplay()
 
     screen_shader.use()
-    glBindBuffer(GL_ARRAY_BUFFER, fbuff.vbo)
+    screen_shader.bindVertexArray(fbuff.vbo, FIRST_EBO)
     glDisable(GL_DEPTH_TEST)
     screen_shader.prepareDraw()
 
@@ -872,6 +1415,7 @@ def postRender(screen_shader):
     lbuff.bind_texture(1)        # bind light texture
     fbuff.bind_depth_texture(2)  # bind depth texture
     glDrawElements(GL_TRIANGLES, 6, GL_UNSIGNED_INT, None)
+    GpuTimers.end()
 
 
 def clearDisplay():
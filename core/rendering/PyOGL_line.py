@@ -3,9 +3,9 @@ from OpenGL.GL import *
 from typing import Dict, Union
 from beartype import beartype
 
-from core.Typing import FLOAT32, ZERO_FLOAT32, TYPE_VEC, TYPE_NUM
-from core.rendering.PyOGL_utils import zFromLayer, bufferize
-from core.rendering.PyOGL import FB_Geometry, camera, bindEBO
+from core.Typing import FLOAT32, ZERO_FLOAT32, TYPE_VEC
+from core.rendering.PyOGL_utils import zFromLayer
+from core.rendering.PyOGL import FB_Geometry, camera, elementBuffer, StreamingBuffer
 from core.rendering.Shaders import shaders, StraightLineShader
 from core.math.linear import FullTransformMat
 
@@ -18,6 +18,11 @@ __all__ = [
 
 Shader: StraightLineShader = shaders['StraightLineShader']
 lines: Dict = {}
+"""::keys       source
+::values     (vertex data, pos, color, width, indices amount)
+Vertex data is streamed to GPU every frame in renderAllLines()"""
+
+LINE_STRIDE = 12  # vec3 position
 
 
 @beartype
@@ -27,24 +32,17 @@ def drawLine(points: Union[list, TYPE_VEC], layer: int, color: list, source, wid
     dpos = np.array([*points[0], 0], dtype=FLOAT32)
 
     lenn = len(points) * 2 - 1
-    points = [x for x in ( np.array([[*x, z] for x in points]) - dpos ).flatten()]
-    data = np.array(points, dtype=FLOAT32)
-
-    if source in lines.keys():
-        key = bufferize(data, lines[source][0])
-    else:
-        key = bufferize(data)
-    lines[source] = (key, pos, np.array(color, dtype=FLOAT32), width, lenn)
+    data = (np.array([[*x, z] for x in points], dtype=FLOAT32) - dpos).flatten()
 
+    lines[source] = (data, pos, np.array(color, dtype=FLOAT32), width, lenn)
 
-def drawLineBackend(vbo_key: TYPE_NUM, pos: TYPE_VEC, color: np.ndarray, width, amount):
-    glBindBuffer(GL_ARRAY_BUFFER, vbo_key)
 
+def drawLineBackend(base_vertex: int, pos: TYPE_VEC, color: np.ndarray, width, amount):
     x_, y_ = pos
     mat = FullTransformMat(x_, y_, camera.get_matrix(), ZERO_FLOAT32)
-    Shader.prepareDraw(pos, transform=mat, fbuffer=FB_Geometry, color=color, width=width)
+    Shader.prepareDraw(transform=mat, fbuffer=FB_Geometry, color=color, width=width)
 
-    glDrawElements(GL_LINES, amount, GL_UNSIGNED_INT, None)
+    glDrawElementsBaseVertex(GL_LINES, amount, GL_UNSIGNED_INT, None, base_vertex)
 
 
 @beartype
@@ -52,13 +50,12 @@ def renderAllLines():
     if not lines:
         return
     Shader.use()
-    bindEBO(1)
-    for line in lines.values():
-        drawLineBackend(*line)
-    bindEBO()
 
+    # all lines are uploaded with one push, each one is drawn from its base vertex
+    data = np.concatenate([line[0] for line in lines.values()])
+    base_vertex = StreamingBuffer.push(data, LINE_STRIDE) // LINE_STRIDE
+    Shader.bindVertexArray(StreamingBuffer.vbo, elementBuffer(1))
 
-def reBufferize(vbo, data):
-    glBindBuffer(GL_ARRAY_BUFFER, vbo)
-    glBufferSubData(GL_ARRAY_BUFFER, 0, data.nbytes, data)
-    return vbo
+    for data, *params in lines.values():
+        drawLineBackend(base_vertex, *params)
+        base_vertex += len(data) // 3
@@ -1,21 +1,33 @@
-from core.Constants import LIGHT_POWER_UNIT
+from core.Constants import LIGHT_POWER_UNIT, \
+    STREAM_BUFFER_SIZE, STREAM_BUFFER_SEGMENTS, STREAM_BUFFER_PERSISTENT, PROFILER_GPU_FRAMES
 from core.Typing import FLOAT32
+from utils.profiler import FrameProfiler
 from typing import Union, List, Tuple
 
 from OpenGL.GL import *
 import numpy as np
+import ctypes
 
 __all__ = [
+    "FULL_UV",
     "makeGLTexture",
+    "uploadGLTexture",
     "bufferize",
     "drawDataFullScreen",
     "drawData",
+    "drawDataUnitQuad",
     "splitDrawData",
     "zFromLayer",
-    "drawDataLightSource"
+    "drawDataLightSource",
+    "StreamBuffer",
+    "GpuTimer"
 ]
 
 
+FULL_UV = np.array((0.0, 0.0, 1.0, 1.0), dtype=FLOAT32)
+"""uv rect (u, v, width, height) of whole texture, atlas textures have their own"""
+
+
 def makeGLTexture(image_data: bytes, w: int, h: int) -> int:
     """Loading pygame.Surface as OpenGL texture
     :return New Texture key"""
@@ -43,6 +55,15 @@ def makeGLTexture(image_data: bytes, w: int, h: int) -> int:
     return key
 
 
+def uploadGLTexture(key: int, image_data, w: int, h: int):
+    """Replaces image of existing texture, its key and parameters are kept"""
+    glBindTexture(GL_TEXTURE_2D, key)
+    glTexImage2D(
+        GL_TEXTURE_2D, GL_ZERO, GL_RGBA, w, h, GL_ZERO, GL_RGBA, GL_UNSIGNED_BYTE, image_data
+    )
+    glBindTexture(GL_TEXTURE_2D, 0)
+
+
 def bufferize(data: np.ndarray, vbo=None) -> int:
     """Generating Buffer to store this object's vertex data,
     necessary for drawing"""
@@ -55,6 +76,166 @@ def bufferize(data: np.ndarray, vbo=None) -> int:
     return vbo
 
 
+class StreamBuffer:
+    __doc__ = """
+    Ring of vertex memory for data, that is rebuilt every frame
+    (particles, lines, per-instance data).
+    Buffer is split into <segments> parts, one frame writes into one part,
+    so CPU never writes memory, that GPU may still read.
+
+    With GL 4.4 buffer is persistently mapped and each segment is guarded by a fence.
+    Otherwise storage is orphaned every time ring wraps around and
+    sub-allocations are written with glBufferSubData.
+
+    push() returns byte offset of written data inside .vbo.
+    Offset is aligned to given stride, so it can be used as
+    first vertex / base vertex / base instance: offset // stride
+    """
+
+    def __init__(self,
+                 size: int = STREAM_BUFFER_SIZE,
+                 segments: int = STREAM_BUFFER_SEGMENTS,
+                 persistent: bool = STREAM_BUFFER_PERSISTENT):
+        self.segment_size = size
+        self.segments = segments
+        self.capacity = size * segments
+
+        self.segment = 0
+        self.offset = 0  # inside current segment
+        self.fences = [None, ] * segments
+
+        self.vbo = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+
+        self.persistent = persistent and bool(glBufferStorage)
+        if self.persistent:
+            flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+            glBufferStorage(GL_ARRAY_BUFFER, self.capacity, None, flags)
+            pointer = glMapBufferRange(GL_ARRAY_BUFFER, 0, self.capacity, flags)
+            self.pointer = getattr(pointer, "value", pointer)
+        else:
+            glBufferData(GL_ARRAY_BUFFER, self.capacity, None, GL_STREAM_DRAW)
+            self.pointer = None
+
+    def __repr__(self):
+        mode = "persistent" if self.persistent else "orphaning"
+        return f'<StreamBuffer[{self.vbo}] {mode}. segment: {self.segment}/{self.segments}>'
+
+    def next_frame(self):
+        """Must be called once per frame, before any push()"""
+        self.advance()
+
+    def advance(self):
+        """Closes current segment and starts writing into the next one"""
+        if self.persistent:
+            self.fences[self.segment] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+        self.segment = (self.segment + 1) % self.segments
+        self.offset = 0
+
+        if self.persistent:
+            self.wait(self.segment)
+        elif self.segment == 0:
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+            glBufferData(GL_ARRAY_BUFFER, self.capacity, None, GL_STREAM_DRAW)
+
+    def wait(self, segment):
+        fence = self.fences[segment]
+        if fence is None:
+            return
+
+        while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 1_000_000) == GL_TIMEOUT_EXPIRED:
+            pass
+        glDeleteSync(fence)
+        self.fences[segment] = None
+
+    def push(self, data: np.ndarray, stride: int = 4) -> int:
+        """Copies data into the ring.
+        :return byte offset of the data inside self.vbo, multiple of <stride>,
+            so offset // stride is index of its first vertex or instance"""
+        nbytes = data.nbytes
+        if nbytes + stride > self.segment_size:
+            raise ValueError(f'Data of {nbytes} bytes does not fit StreamBuffer segment '
+                             f'of {self.segment_size} bytes')
+
+        # segment bases are not multiples of every stride, absolute offset is aligned
+        base = self.segment * self.segment_size
+        offset = -(-(base + self.offset) // stride) * stride - base
+        if offset + nbytes > self.segment_size:
+            self.advance()
+            base = self.segment * self.segment_size
+            offset = -(-base // stride) * stride - base
+        self.offset = offset + nbytes
+
+        offset += base
+        data = np.ascontiguousarray(data)
+        if self.persistent:
+            ctypes.memmove(self.pointer + offset, data.ctypes.data, nbytes)
+        else:
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+            glBufferSubData(GL_ARRAY_BUFFER, offset, nbytes, data)
+        return offset
+
+    def bind(self):
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+
+
+class GpuTimer:
+    __doc__ = """
+    GL_TIME_ELAPSED queries around render passes, used only while FrameProfiler is enabled.
+    Queries of PROFILER_GPU_FRAMES frames are kept, so result of a pass is read
+    when its frame comes around again. Results that are still not available are dropped,
+    reading never waits for GPU.
+    Results are added to FrameProfiler as "gpu.<pass>" stages of the frame they are read in.
+    
+    Passes must not overlap, begin() ends previous pass"""
+
+    def __init__(self, frames=PROFILER_GPU_FRAMES):
+        self.frames = [{} for _ in range(frames)]
+        """::keys       pass name
+        ::values     [query, issued]"""
+        self.frame = 0
+        self.active = None
+
+        self.__result = np.zeros(1, dtype=np.uint64)
+        self.__available = np.zeros(1, dtype=np.int32)
+
+    def next_frame(self):
+        self.end()
+        self.frame = (self.frame + 1) % len(self.frames)
+
+        for name, query in self.frames[self.frame].items():
+            if not query[1]:
+                continue
+            query[1] = False
+
+            glGetQueryObjectiv(query[0], GL_QUERY_RESULT_AVAILABLE, self.__available)
+            if not self.__available[0]:
+                continue
+            glGetQueryObjectui64v(query[0], GL_QUERY_RESULT, self.__result)
+            FrameProfiler.add_sample(f"gpu.{name}", int(self.__result[0]))
+
+    def begin(self, name: str):
+        self.end()
+        if not FrameProfiler.enabled:
+            return
+
+        query = self.frames[self.frame].get(name)
+        if query is None:
+            query = [int(glGenQueries(1)[0]), False]
+            self.frames[self.frame][name] = query
+
+        glBeginQuery(GL_TIME_ELAPSED, query[0])
+        self.active = query
+
+    def end(self):
+        if self.active is None:
+            return
+        glEndQuery(GL_TIME_ELAPSED)
+        self.active[1] = True
+        self.active = None
+
+
 def drawData(size: tuple, colors: Union[List, Tuple, np.ndarray], rotation=1, layer=5) -> np.ndarray:
     # ::arg layer - value from 0 to 10
     # lower it is, nearer object to a camera
@@ -88,6 +269,12 @@ def drawData(size: tuple, colors: Union[List, Tuple, np.ndarray], rotation=1, la
     return data
 
 
+def drawDataUnitQuad() -> np.ndarray:
+    """1x1 white quad at z = 0 (layer 5), shared by instanced objects.
+    Size and depth of objects are applied by their per-instance transforms"""
+    return drawData((1.0, 1.0), [np.ones(4, dtype=FLOAT32)] * 4, layer=5)
+
+
 def drawDataLightSource():
     w_t, h_t = 1, 1
     w_o, h_o = LIGHT_POWER_UNIT, LIGHT_POWER_UNIT
@@ -3,7 +3,9 @@ from utils.files import get_full_path
 from utils.debug import dprint
 import core.Constants as Const
 from core.Exceptions import ShaderError
+from core.rendering.PyOGL_utils import FULL_UV
 from core.Typing import TYPE_VEC, TYPE_FLOAT, TYPE_INT, Dict
+from typing import NamedTuple
 from beartype import beartype
 
 import numpy as np
@@ -13,6 +15,81 @@ shaders: Dict[str, "Shader"] = {}
 ActiveShader = None
 
 
+# VERTEX ARRAYS
+class VertexLayout(NamedTuple):
+    """Attributes read from one buffer
+    attributes:: (location, components, byte offset, integer) of every attribute
+    divisor:: 0 for per-vertex attributes, 1 for per-instance ones"""
+    stride: int
+    attributes: tuple
+    divisor: int = 0
+
+
+def mat4Attributes(location, offset) -> tuple:
+    """mat4 attribute takes 4 locations, one per column.
+    Each column is read from one row of C-ordered matrix,
+    so in shader [vec4 * Transform] gives the same result as [Transform @ vec4] in numpy"""
+    return tuple((location + i, 4, offset + 16 * i, False) for i in range(4))
+
+
+LAYOUT_DEFAULT = VertexLayout(36, ((0, 3, 0, False), (1, 4, 12, False), (2, 2, 28, False)))
+"""position, color, texture coords of drawData"""
+
+vertex_arrays: Dict[tuple, int] = {}
+"""::keys       (vertex layout, vbo, ebo, instance layout, instance vbo)
+::values     VAO"""
+
+BoundVertexArray = 0
+
+
+def _specifyLayout(layout: VertexLayout, vbo):
+    glBindBuffer(GL_ARRAY_BUFFER, vbo)
+    for location, components, offset, integer in layout.attributes:
+        if integer:
+            glVertexAttribIPointer(location, components, GL_UNSIGNED_INT, layout.stride, ctypes.c_void_p(offset))
+        else:
+            glVertexAttribPointer(location, components, GL_FLOAT, GL_FALSE, layout.stride, ctypes.c_void_p(offset))
+        glVertexAttribDivisor(location, layout.divisor)
+        glEnableVertexAttribArray(location)
+
+
+def bindVertexArray(layout: VertexLayout, vbo, ebo=0, instance_layout: VertexLayout = None, instance_vbo=0):
+    """Binds VAO with given layouts of given buffers. VAO is created on first use and cached
+    ebo:: element buffer, 0 for glDrawArrays"""
+    global BoundVertexArray
+
+    key = (layout, vbo, ebo, instance_layout, instance_vbo)
+    vao = vertex_arrays.get(key)
+    if vao is None:
+        vao = glGenVertexArrays(1)
+        glBindVertexArray(vao)
+        _specifyLayout(layout, vbo)
+        if instance_layout is not None:
+            _specifyLayout(instance_layout, instance_vbo)
+        if ebo:
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ebo)
+        vertex_arrays[key] = vao
+
+    elif vao == BoundVertexArray:
+        return
+    else:
+        glBindVertexArray(vao)
+    BoundVertexArray = vao
+
+
+def releaseVertexArrays(vbo):
+    """Deletes VAOs that read given buffer. Must be called before buffer is deleted,
+    otherwise cached VAO would be used with a new buffer of the same name"""
+    global BoundVertexArray
+
+    for key in [key for key in vertex_arrays if key[1] == vbo or key[4] == vbo]:
+        vao = vertex_arrays.pop(key)
+        if vao == BoundVertexArray:
+            glBindVertexArray(0)
+            BoundVertexArray = 0
+        glDeleteVertexArrays(1, np.array([vao], dtype=np.uint32))
+
+
 class Shader:
     __doc__ = """
     Abstraction of compiled and linked .glsl files
@@ -20,6 +97,10 @@ class Shader:
     To start rendering using this Shader call .use()
     Shader is a meta-class
     
+    Vertex attributes are described by VERTEX_LAYOUT (and INSTANCE_LAYOUT), not specified per draw:
+    bindVertexArray(vbo) binds cached VAO of these layouts and given buffers,
+    prepareDraw(**kw) only passes uniforms
+    
     In .glsl shader files you can write after version define:
     #constant <constant type> <constant name>
     This line, while compiling, will be replaced with:
@@ -31,6 +112,22 @@ class Shader:
 
     __instance = None
 
+    VERTEX_LAYOUT: VertexLayout = LAYOUT_DEFAULT
+    """Per-vertex attributes"""
+
+    INSTANCE_LAYOUT: VertexLayout = None
+    """Per-instance attributes, read from StreamingBuffer, if shader supports instancing"""
+
+    INSTANCE_DTYPE: np.dtype = None
+    """Layout of per-instance data, matches INSTANCE_LAYOUT"""
+
+    INSTANCE_TEXTURES = False
+    """If True, 'tex' of INSTANCE_DTYPE is slot of Textures[MAX_TEXTURES_BIND] uniform.
+    Draw items are submitted to RenderQueue with GL texture keys there, queue binds them and remaps to slots"""
+
+    sort_id = 0
+    """Index of shader in initialization order, most significant part of RenderQueue sort key"""
+
     def __init__(self, vertex_path: str, fragment_path: str, geometry_path: str = ''):
         #  Reading shader code
         vertx_code = loadGLSL(vertex_path)
@@ -66,7 +163,6 @@ class Shader:
         glDeleteShader(geometry)
 
         self.cached_uniform_locations = {}
-        self.attrib_array_count = 0
 
     @staticmethod
     def compile_shader(gl_shader, code: str, path: str):
@@ -84,25 +180,24 @@ class Shader:
         cls.__instance = super(Shader, cls).__new__(cls)
         return cls.__instance
 
-    def close(self):
-        for y in range(self.attrib_array_count):
-            glDisableVertexAttribArray(y)
-
     def use(self):
         global ActiveShader
 
         if ActiveShader == self:
             return
 
-        if ActiveShader:
-            ActiveShader.close()
         glUseProgram(self.program)
         ActiveShader = self
 
-        for y in range(self.attrib_array_count):
-            glEnableVertexAttribArray(y)
+    def bindVertexArray(self, vbo, ebo=0, instance_vbo=0):
+        """Binds VAO of VERTEX_LAYOUT with <vbo> and, if <instance_vbo> is given, INSTANCE_LAYOUT with it"""
+        if instance_vbo:
+            bindVertexArray(self.VERTEX_LAYOUT, vbo, ebo, self.INSTANCE_LAYOUT, instance_vbo)
+        else:
+            bindVertexArray(self.VERTEX_LAYOUT, vbo, ebo)
 
     def prepareDraw(self, **kw):
+        """Passes uniforms of one draw"""
         pass
 
     # PASS UNIFORMS TO SHADER
@@ -184,38 +279,70 @@ class DefaultShader(Shader):
     __instance = None
 
     def __init__(self, vertex_path='default.vert', fragment_path='default.frag', geometry_path: str = ''):
-        self.attrib_array_count = 3
         super().__init__(vertex_path, fragment_path, geometry_path)
 
     def prepareDraw(self, **kw):
         self.passMat4('Transform', kw['transform'])
-
-        stride = 36
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(0))
-        glVertexAttribPointer(1, 4, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(12))
-        glVertexAttribPointer(2, 2, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(28))
+        self.passVec4f('UVRect', kw.get('uv', FULL_UV))
 
 
 class DefaultInstancedShader(Shader):
+    """Per-instance data: Transform (mat4, locations 3-6),
+    texture slot (uint, location 7) from Textures[MAX_TEXTURES_BIND]
+    and uv rect of texture on its atlas page (vec4, location 8)"""
+
     __instance = None
 
-    def __init__(self, vert='default.vert', frag='default.frag'):
+    INSTANCE_DTYPE = np.dtype([
+        ('transform', np.float32, (4, 4)),
+        ('tex', np.uint32),
+        ('uv', np.float32, (4, )),
+    ])
+    INSTANCE_LAYOUT = VertexLayout(
+        INSTANCE_DTYPE.itemsize, mat4Attributes(3, 0) + ((7, 1, 64, True), (8, 4, 68, False)), divisor=1
+    )
+    INSTANCE_TEXTURES = True
+
+    def __init__(self, vert='default_instanced.vert', frag='default_instanced.frag'):
         super().__init__(vert, frag)
 
-    def prepareDraw(self, **kw):
-        stride = 36
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(0))
-        glVertexAttribPointer(1, 4, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(12))
-        glVertexAttribPointer(2, 2, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(28))
-
 
 class DefaultMaterialShader(DefaultInstancedShader):
+    """Per-instance data: Transform (mat4, locations 3-6),
+    texture Scale (vec2, location 7) and Layer of material array (float, location 8)"""
+
     __instance = None
 
+    INSTANCE_DTYPE = np.dtype([
+        ('transform', np.float32, (4, 4)),
+        ('scale', np.float32, (2, )),
+        ('layer', np.float32),
+    ])
+    INSTANCE_LAYOUT = VertexLayout(
+        INSTANCE_DTYPE.itemsize, mat4Attributes(3, 0) + ((7, 2, 64, False), (8, 1, 72, False)), divisor=1
+    )
+    INSTANCE_TEXTURES = False
+
     def __init__(self):
         super().__init__('material.vert', 'material.frag')
 
 
+class StaticMaterialShader(Shader):
+    """Level geometry baked in world space (RenderObjectBaked).
+    Vertex: position (vec3, location 0), texture coords and layer of material array (vec3, location 1)"""
+
+    __instance = None
+
+    VERTEX_LAYOUT = VertexLayout(24, ((0, 3, 0, False), (1, 3, 12, False)))
+
+    def __init__(self):
+        super().__init__('static_material.vert', 'static_material.frag')
+
+    def prepareDraw(self, **kw):
+        if 'transform' in kw:
+            self.passMat4('Transform', kw['transform'])
+
+
 class BackgroundShader(DefaultShader):
     """Shader for fancy :) gradient background drawing"""
 
@@ -231,15 +358,28 @@ class BackgroundShader(DefaultShader):
 
 # LIGHTING
 class LightSourceShader(Shader):
+    VERTEX_LAYOUT = VertexLayout(20, ((0, 3, 0, False), (1, 2, 12, False)))
+
     def __init__(self):
-        self.attrib_array_count = 2
         super().__init__('light_source.vert', 'light_source.frag')
 
     def prepareDraw(self, **kw):
-        stride = 20
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(0))
-        glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(12))
-        return self.program
+        self.passTexture("shadowMap", kw['shadow_slot'])
+
+
+class LightTiledShader(Shader):
+    """Full-screen pass of tiled lighting, lights and tiles are read from buffers of LightTileGrid"""
+
+    def __init__(self):
+        super().__init__('screen.vert', 'light_tiled.frag')
+
+    def prepareDraw(self, **kw):
+        for slot in range(Const.MAX_TEXTURES_BIND - 1):
+            self.passTexture(f"textures[{slot}]", slot)
+        self.passTexture("shadowMap", kw['shadow_slot'])
+        self.passVec4f('CameraRect', kw['camera_rect'])
+        self.passVec2f('Viewport', kw['viewport'])
+        self.passUInt('TilesX', kw['tiles_x'])
 
 
 # SCREENS AND GUIS
@@ -249,15 +389,9 @@ class ScreenShaderGame(Shader):
     __instance = None
 
     def __init__(self):
-        self.attrib_array_count = 3
         super().__init__('screen.vert', 'screen.frag')
 
     def prepareDraw(self, **kw):
-        stride = 36
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(0))
-        glVertexAttribPointer(1, 4, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(12))
-        glVertexAttribPointer(2, 2, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(28))
-
         self.passTexture("lightMap", 1)
         self.passTexture("depthMap", 2)
         self.passFloat('brightness', Const.STN_BRIGHTNESS)
@@ -265,7 +399,6 @@ class ScreenShaderGame(Shader):
 
 class ScreenShaderMenu(Shader):
     def __init__(self):
-        self.attrib_array_count = 3
         super().__init__('screen.vert', 'screen_nolight.frag')
 
     def prepareDraw(self, **kw):
@@ -280,22 +413,19 @@ class GUIShader(Shader):
     def prepareDraw(self, **kw):
         super().prepareDraw(**kw)
         self.passMat4('Transform', kw['transform'])
+        self.passVec4f('UVRect', kw.get('uv', FULL_UV))
 
 
 # PARTICLES AND EFFECTS
 class StraightLineShader(Shader):
+    VERTEX_LAYOUT = VertexLayout(12, ((0, 3, 0, False), ))
+
     def __init__(self):
         super().__init__('straight_line.vert',
                          'straight_line.frag',
                          'straight_line.geom')
 
     def prepareDraw(self, **kw):
-        shader = self.program
-
-        # ATTRIBUTES POINTERS
-        glGetAttribLocation(shader, "position")
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 12, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(0)
         self.passMat4('Transform', kw['transform'])
         self.passVec4f('LineColor', kw['color'])
         self.passInteger('Thickness', kw['width'])
@@ -308,28 +438,14 @@ class ParticlePolyShader(Shader):
                          'particle_poly.geom')
 
     def prepareDraw(self, **kw):
-        shader = self.program
-        stride = 36
-
-        # ATTRIBUTES POINTERS
-        glGetAttribLocation(shader, "position")
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(0)
-
-        glGetAttribLocation(shader, "color")
-        glVertexAttribPointer(1, 4, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(12))
-        glEnableVertexAttribArray(1)
-
-        glGetAttribLocation(shader, "size")
-        glVertexAttribPointer(2, 2, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(28))
-        glEnableVertexAttribArray(2)
-
         self.passMat4('Transform', kw['transform'])
 
 
 def init():
     def checkRecursive(clss):
-        shaders[clss.__name__] = clss()
+        shader = clss()
+        shader.sort_id = len(shaders)
+        shaders[clss.__name__] = shader
         dprint(f'Inited: {clss.__name__}')
         for clsR in clss.__subclasses__():
             checkRecursive(clsR)
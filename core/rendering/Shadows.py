@@ -0,0 +1,190 @@
+"""
+2D shadows
+
+Edges of static level rectangles are extracted once per chunk, when chunk is loaded
+(gObjects.occluderSegments), and kept in MainOccluders until chunk is unloaded.
+
+Every light with shadows in camera field gets a row of shadow map texture: 1D shadow map of
+SHADOW_MAP_RESOLUTION rays, distance to the far edge of the nearest occluder in light space (spatial.shadowMap1D),
+so faces of level rectangles turned to light are lit. Rectangles containing light do not cast its shadows.
+Row + 1 is written to stencil of light, 0 means no shadow.
+Light shaders compare distance of fragment to light with the distance stored for its angle.
+
+Shadow map of light is reused while its position, rotation and radius are the same
+and no occluders changed in its radius, so static lights are computed once.
+"""
+
+from core.Constants import SHADOW_MAP_RESOLUTION, SHADOW_MAX_LIGHTS, SHADOW_CHANGES_KEPT, LIGHT_POWER_UNIT
+from core.Typing import FLOAT32
+from core.math.spatial import segmentsInRect, rectsContaining, shadowMap1D
+
+from OpenGL.GL import glGenTextures, glBindTexture, glTexImage2D, glTexSubImage2D, glTexParameteri, \
+    glActiveTexture, GL_TEXTURE_2D, GL_TEXTURE0, GL_R32F, GL_RED, GL_FLOAT, GL_TEXTURE_MIN_FILTER, \
+    GL_TEXTURE_MAG_FILTER, GL_LINEAR, GL_TEXTURE_WRAP_S, GL_TEXTURE_WRAP_T, GL_REPEAT, GL_CLAMP_TO_EDGE
+from collections import deque
+from typing import Dict, Optional
+import numpy as np
+
+
+__all__ = [
+    'OccluderStore',
+    'ShadowCaster',
+    'MainOccluders'
+]
+
+
+class OccluderStore:
+    """Occluder segments of loaded chunks, 4 edges per rectangle in spatial.rectSegments order.
+    Every change is stamped with its bounds, so cached shadow maps are recomputed
+    only for lights which radius intersects newer changes"""
+
+    def __init__(self):
+        self.chunks: Dict[str, np.ndarray] = {}
+        self.stamp = 0
+        self.changes = deque(maxlen=SHADOW_CHANGES_KEPT)  # (stamp, l, b, r, t)
+        self.__segments = None
+
+    def __repr__(self):
+        return f'<OccluderStore {len(self.chunks)} chunks, {len(self.segments)} segments>'
+
+    def add(self, key: str, segments: np.ndarray):
+        """Segments of chunk replace its previous ones"""
+        self.remove(key)
+        if len(segments):
+            self.chunks[key] = segments
+            self.__changed(segments)
+
+    def remove(self, key: str):
+        segments = self.chunks.pop(key, None)
+        if segments is not None:
+            self.__changed(segments)
+
+    def clear(self):
+        for key in list(self.chunks):
+            self.remove(key)
+
+    def __changed(self, segments: np.ndarray):
+        self.stamp += 1
+        xs, ys = segments[:, 0::2], segments[:, 1::2]
+        self.changes.append((self.stamp, float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max())))
+        self.__segments = None
+
+    @property
+    def segments(self) -> np.ndarray:
+        """Segments of all chunks in one buffer, rebuilt after change"""
+        if self.__segments is None:
+            chunks = list(self.chunks.values())
+            self.__segments = np.concatenate(chunks) if chunks else np.empty((0, 4), dtype=FLOAT32)
+        return self.__segments
+
+    def query(self, l_, b, r, t) -> np.ndarray:
+        """:returns all 4 edges of rectangles which edges intersect bounds"""
+        segments = self.segments
+        found = segmentsInRect(segments, l_, b, r, t).reshape(-1, 4).any(axis=1)
+        return segments[np.repeat(found, 4)]
+
+    def changed_since(self, stamp: int, l_, b, r, t) -> bool:
+        """:returns True if occluders in bounds could change after <stamp>"""
+        if stamp == self.stamp:
+            return False
+
+        changes = self.changes
+        if len(changes) == changes.maxlen and stamp < changes[0][0] - 1:
+            return True  # older changes are forgotten
+        return any(s > stamp and cl <= r and cr >= l_ and cb <= t and ct >= b for s, cl, cb, cr, ct in changes)
+
+
+class ShadowCaster:
+    """Shadow map texture of SHADOW_MAX_LIGHTS rows and cache of rows of lights"""
+
+    def __init__(self, occluders: OccluderStore = None):
+        self.occluders = MainOccluders if occluders is None else occluders
+
+        self.tex = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.tex)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_R32F, SHADOW_MAP_RESOLUTION, SHADOW_MAX_LIGHTS, 0, GL_RED, GL_FLOAT, None)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+        self.cache = {}
+        """::keys       light id
+        ::values     [row, (x, y, rotation, radius), occluders stamp, last frame]"""
+        self.free_rows = list(range(SHADOW_MAX_LIGHTS - 1, -1, -1))
+        self.frame = 0
+
+    def __repr__(self):
+        return f'<ShadowCaster {len(self.cache)}/{SHADOW_MAX_LIGHTS}>'
+
+    def update(self, visible: dict):
+        """Finds shadow maps of visible lights, recomputes changed ones and writes their rows to stencils
+        ::arg visible   texture -> (LightGroup, rows) of LightingManager.visible"""
+        self.frame += 1
+        glBindTexture(GL_TEXTURE_2D, self.tex)
+
+        for group, rows in visible.values():
+            group.stencil[rows] = 0
+            rows = rows[group.shadows[rows]]
+            if not len(rows):
+                continue
+
+            radii = LIGHT_POWER_UNIT * np.hypot(group.base_size[rows, 0], group.base_size[rows, 1])
+            for row, idd, (x, y), rotation, radius in zip(
+                    rows.tolist(), group.ids[rows].tolist(), group.pos[rows].tolist(),
+                    group.rotation[rows].tolist(), radii.tolist()
+            ):
+                shadow_row = self.shadow(idd, x, y, rotation, radius)
+                if shadow_row is not None:
+                    group.stencil[row] = shadow_row + 1
+
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+    def shadow(self, idd: int, x, y, rotation, radius) -> Optional[int]:
+        """Shadow map texture must be bound
+        :returns row of light, None if all rows are taken by lights of this frame"""
+        occluders = self.occluders
+        params = (x, y, rotation, radius)
+        bounds = (x - radius, y - radius, x + radius, y + radius)
+
+        entry = self.cache.get(idd)
+        if entry is None:
+            row = self.__free_row()
+            if row is None:
+                return None
+            entry = self.cache[idd] = [row, None, 0, self.frame]
+        else:
+            entry[3] = self.frame
+            if entry[1] == params and not occluders.changed_since(entry[2], *bounds):
+                return entry[0]
+
+        segments = occluders.query(*bounds)
+        segments = segments[~rectsContaining(segments, (x, y))]
+        distances = shadowMap1D(segments, (x, y), rotation, radius, SHADOW_MAP_RESOLUTION)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, entry[0], SHADOW_MAP_RESOLUTION, 1, GL_RED, GL_FLOAT, distances)
+        entry[1], entry[2] = params, occluders.stamp
+        return entry[0]
+
+    def __free_row(self) -> Optional[int]:
+        if self.free_rows:
+            return self.free_rows.pop()
+
+        # least recently used light, which is not in this frame
+        idd, entry = min(self.cache.items(), key=lambda item: item[1][3])
+        if entry[3] == self.frame:
+            return None
+        del self.cache[idd]
+        return entry[0]
+
+    def clear(self):
+        """Forgets shadow maps of all lights"""
+        self.cache.clear()
+        self.free_rows = list(range(SHADOW_MAX_LIGHTS - 1, -1, -1))
+
+    def bind(self, slot: int):
+        glActiveTexture(GL_TEXTURE0 + slot)
+        glBindTexture(GL_TEXTURE_2D, self.tex)
+
+
+MainOccluders = OccluderStore()
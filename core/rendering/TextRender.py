@@ -2,6 +2,7 @@ from utils.files import load_font, load_text_localization
 from core.Constants import FONT_SETTINGS, STN_LANGUAGE
 from core.rendering.PyOGL import StaticRenderComponent, bufferize, drawData
 from core.rendering.Textures import GlTexture, EssentialTextureStorage
+from utils.assets import MainAssetPipeline
 
 from PIL import Image, ImageDraw
 from typing import Union
@@ -52,26 +53,35 @@ MenuFont = newFont(FONT_SETTINGS[0], 64)
 LocalizedTextsStorage = {}
 
 
-def loadText():
-    global LocalizedTextsStorage
-    lts = load_text_localization(key=STN_LANGUAGE)
-    LocalizedTextsStorage = {f'txt_{key}': lts[key] for key in lts.keys()}
+MENU_TEXTS = (
+    'txt_menu_newgame', 'txt_menu_loadgame', 'txt_menu_savegame', 'txt_menu_settings', 'txt_menu_exit',
+    'txt_menu_settings_brightness', 'txt_menu_settings_resolution', 'txt_menu_settings_volume',
+    'txt_menu_settings_language', 'txt_menu_settings_menu',
+)
 
-    buttons_text = [
-        GlText(LocalizedText('txt_menu_newgame'), font=MenuFont),
-        GlText(LocalizedText('txt_menu_loadgame'), font=MenuFont),
-        GlText(LocalizedText('txt_menu_savegame'), font=MenuFont),
-        GlText(LocalizedText('txt_menu_settings'), font=MenuFont),
-        GlText(LocalizedText('txt_menu_exit'), font=MenuFont),
 
-        GlText(LocalizedText('txt_menu_settings_brightness'), font=MenuFont),
-        GlText(LocalizedText('txt_menu_settings_resolution'), font=MenuFont),
-        GlText(LocalizedText('txt_menu_settings_volume'), font=MenuFont),
-        GlText(LocalizedText('txt_menu_settings_language'), font=MenuFont),
-        GlText(LocalizedText('txt_menu_settings_menu'), font=MenuFont),
-    ]
+def loadText(wait=True):
+    """Localization is parsed and menu texts are rasterized in MainAssetPipeline workers.
+    If not <wait>, they are loaded while MainAssetPipeline is drained"""
+    def parse():
+        lts = load_text_localization(key=STN_LANGUAGE)
+        return {f'txt_{key}': lts[key] for key in lts.keys()}
 
-    EssentialTextureStorage.load(buttons_text)
+    def upload_texts(texts):
+        global LocalizedTextsStorage
+        LocalizedTextsStorage = texts
+        job.add(rasterize_menu, upload_menu)
+
+    def rasterize_menu():
+        # one task for all of them, FreeType font of MenuFont should not be used by many threads at once
+        return [GlText.rasterize(LocalizedText(token), MenuFont) for token in MENU_TEXTS]
+
+    def upload_menu(rasters):
+        EssentialTextureStorage.load([GlText.uploaded(*raster) for raster in rasters])
+
+    job = MainAssetPipeline.job('text', [(parse, upload_texts)])
+    if wait:
+        MainAssetPipeline.wait(job.name)
 
 
 class LocalizedText:
@@ -88,6 +98,19 @@ class GlText(GlTexture):
     __slots__ = ()
 
     def __init__(self, text: Union[str, LocalizedText] = '', font=DefaultFont):
+        super().__init__(*self.rasterize(text, font))
+
+    @classmethod
+    def uploaded(cls, data, size, name) -> "GlText":
+        """GlText of data given by rasterize, must be called on main thread"""
+        text = cls.__new__(cls)
+        GlTexture.__init__(text, data, size, name)
+        return text
+
+    @staticmethod
+    def rasterize(text: Union[str, LocalizedText], font=DefaultFont):
+        """No GL calls, can be called from worker thread
+        :returns (RGBA data, size, name) of text"""
         if isinstance(text, LocalizedText):
             name = text.token
             text = text()
@@ -117,7 +140,7 @@ class GlText(GlTexture):
         draw.text((0, 0), text, fill=(0, 0, 0, 255), font=font)
         image = image.crop(image.getbbox())
         data = np.fromstring(image.tobytes(), np.uint8)
-        super().__init__(data, image.size, tex_name=name)
+        return data, image.size, name
 
 
 TextTextures = {}
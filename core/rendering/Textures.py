@@ -1,74 +1,190 @@
 from OpenGL.GL import *
 
-from core.rendering.PyOGL_utils import makeGLTexture, drawData
+from core.rendering.PyOGL_utils import makeGLTexture, uploadGLTexture, drawData, FULL_UV
+from core.rendering.Atlas import buildAtlas
 from core.Constants import *
 
-from utils.files import get_full_path, load_image
+from utils.files import get_full_path, load_image, image_size, ImageCache
+from utils.assets import AssetJob, MainAssetPipeline
 from utils.debug import dprint
 
+from functools import partial
 from os import listdir
 import numpy as np
 
 
-def loadTexturePack(_name):
+def loadTexturePack(_name, storage: "TextureStorage") -> AssetJob:
+    """Images of pack are decoded (or read from its ImageCache) in MainAssetPipeline workers,
+    when all of them are done, they are packed into atlas pages and loaded into <storage>.
+    Textures of ATLAS_EXCLUDE directories and ones bigger than page are only registered, see LazyGlTexture"""
     print(f'\n-- loading Texture Pack: {_name}')
 
     path = get_full_path(_name, file_type='tex')
     directories = listdir(path)
 
-    pack = []
+    sources = {}
+    lazy = []
     for dr in directories:
         textures = listdir(f'data/Textures/{_name}/{dr}')
 
         for tex in textures:
             if not tex.endswith(".png"): continue
-            t = GlTexture.load_file(f'{dr}/{tex}')
-            pack.append(t)
+            full_path = get_full_path(_name, dr, tex, file_type='tex')
+            if dr in ATLAS_EXCLUDE:
+                lazy.append(LazyGlTexture(image_size(full_path), f'{dr}/{tex}'))
+            else:
+                sources[f'{dr}/{tex}'] = full_path
+
+    cache = ImageCache(f'tex_{_name}')
+    images = {}
+
+    def finish():
+        # completion order differs between runs, atlas is packed in order of sources
+        ordered = {name: images[name] for name in sources}
+        pack, pages = packTextures(ordered)
+        storage.load(lazy + pack, pages)
+        cache.save(ordered)
+        dprint(f'-- Done.\n')
+
+    return MainAssetPipeline.job(
+        'textures', [(partial(cache.get, name, path_), partial(images.__setitem__, name))
+                     for name, path_ in sources.items()], finish
+    )
+
+
+def packTextures(images: dict):
+    """Must be called on main thread, images bigger than atlas page are loaded on demand
+    ::arg images    texture name -> (RGBA data, size)
+    :returns (textures, GL keys of atlas pages)"""
+    pack = []
+    pages, rects = buildAtlas(list(images.values()))
+    for (name, (data, size)), rect in zip(images.items(), rects):
+        if rect is None:
+            pack.append(LazyGlTexture(size, name))
+        else:
+            pack.append(GlTexture(None, size, name, *rect))
 
-    dprint(f'-- Done.\n')
-    return pack
+    dprint(f'-- {len(pack)} textures packed into {len(pages)} atlas pages')
+    return pack, pages
 
 
 class TextureStorage:
+    """Textures by name.
+    Textures out of atlas (LazyGlTexture) are uploaded when they are requested first, by __getitem__
+    or by touch() of draw, placeholder is drawn while they are loading in MainAssetPipeline.
+    While loaded ones exceed TEXTURE_VRAM_BUDGET, the ones unused for TEXTURE_EVICT_FRAMES are evicted,
+    least recently used first. Key of texture is kept, so groups sorted by it do not change"""
+
     def __init__(self):
         self.textures = {}
+        self.pages = []
         self.error_tex = None
 
+        self.lazy = {}  # GL key -> LazyGlTexture
+        self.resident_bytes = 0
+        self.frame = 0
+
     def __getitem__(self, item):
         if item in self.textures.keys():
-            return self.textures[item]
+            tex = self.textures[item]
+            if tex.__class__ is LazyGlTexture:
+                self.request(tex)
+            return tex
 
         if not self.error_tex:
             self.error_tex = GlTexture.load_file('Devs/r_error.png')
         return self.error_tex
 
     def __repr__(self):
-        return f'<TextureStorage. Size: {len(self.textures)}\n{self.textures}>'
+        return f'<TextureStorage. Size: {len(self.textures)}, ' \
+               f'on demand: {self.resident_bytes / 2 ** 20:.1f} MB\n{self.textures}>'
 
-    def load(self, pack):
+    def load(self, pack, pages=()):
+        """:arg pages GL keys of atlas pages, textures of <pack> are placed on"""
         for tex in pack:
             self.textures[tex.name] = tex
+            if tex.__class__ is LazyGlTexture:
+                self.lazy[tex.key] = tex
+        self.pages.extend(pages)
 
     def empty(self):
         for t in self.textures.keys():
-            self.textures[t].delete_from_physic()
+            self.textures[t].delete()
         self.textures.clear()
+        self.lazy.clear()
+        self.resident_bytes = 0
+
+        if self.pages:
+            glDeleteTextures(len(self.pages), self.pages)
+            self.pages.clear()
 
     def keys(self):
         return self.textures.keys()
 
+    # RESIDENCY
+    def touch(self, keys):
+        """Marks textures of given GL keys as used in this frame"""
+        for key in keys:
+            tex = self.lazy.get(key)
+            if tex is not None:
+                self.request(tex)
+
+    def request(self, tex: "LazyGlTexture"):
+        tex.last_used = self.frame
+        if tex.state == TEX_EVICTED:
+            tex.state = TEX_LOADING
+            MainAssetPipeline.job(f'texture {tex.name}', [(
+                partial(load_image, tex.source, STN_TEXTURE_PACK), partial(self.upload, tex)
+            )])
+
+    def upload(self, tex: "LazyGlTexture", image):
+        data, size = image
+        # texture could be deleted while loading
+        if tex.state != TEX_LOADING or self.lazy.get(tex.key) is not tex:
+            return
+        if data is None:
+            print(f'texture: {tex.source} error. Not loaded')
+            return
+
+        uploadGLTexture(tex.key, data, *size)
+        tex.state = TEX_RESIDENT
+        self.resident_bytes += tex.bytes
+
+    def evict(self, tex: "LazyGlTexture"):
+        uploadGLTexture(tex.key, TEXTURE_PLACEHOLDER_DATA, 1, 1)
+        tex.state = TEX_EVICTED
+        self.resident_bytes -= tex.bytes
+
+    def end_frame(self):
+        self.frame += 1
+        if self.resident_bytes <= TEXTURE_VRAM_BUDGET:
+            return
+
+        unused = [tex for tex in self.lazy.values()
+                  if tex.state == TEX_RESIDENT and self.frame - tex.last_used > TEXTURE_EVICT_FRAMES]
+        unused.sort(key=lambda tex: tex.last_used)
+        for tex in unused:
+            if self.resident_bytes <= TEXTURE_VRAM_BUDGET:
+                break
+            self.evict(tex)
+
 
 class GlTexture:
-    __slots__ = ('size', 'key', 'name', 'normals')
+    """Texture of its own or part of atlas page.
+    Atlas texture is given <key> of page and <uv> rect (u, v, width, height) on it, <data> is not used"""
+    __slots__ = ('size', 'key', 'name', 'normals', 'uv', 'atlas')
 
-    def __init__(self, data: np.ndarray, size, tex_name):
+    def __init__(self, data: np.ndarray, size, tex_name, key=None, uv=FULL_UV):
         self.size = size  # units
-        self.key = makeGLTexture(data, *self.size)
+        self.atlas = key is not None
+        self.key = key if self.atlas else makeGLTexture(data, *self.size)
+        self.uv = uv
         self.name = tex_name.replace('.png', '')
         dprint( self )
 
     def __repr__(self):
-        return f'<GLTexture[{self.key}] \t size: {self.size[0]}x{self.size[1]}px. \t name: "{self.name}">'
+        atlas = ' atlas' if self.atlas else ''
+        return f'<GLTexture[{self.key}]{atlas} \t size: {self.size[0]}x{self.size[1]}px. \t name: "{self.name}">'
 
     @classmethod
     def load_file(cls, image_name):
@@ -94,16 +210,48 @@ class GlTexture:
         drawData(self.size, colors, layer=layer)
         return drawData(self.size, colors, layer=layer)
 
-    """Deleting texture from memory"""
+    """Deleting texture from memory, atlas pages are deleted by their TextureStorage"""
     def delete(self):
-        glDeleteTextures(1, [self.key, ])
+        if not self.atlas:
+            glDeleteTextures(1, [self.key, ])
         del self
 
 
+# STATES OF LazyGlTexture
+TEX_EVICTED = 0  # placeholder is drawn
+TEX_LOADING = 1  # placeholder is drawn, image is decoded in MainAssetPipeline
+TEX_RESIDENT = 2
+
+TEXTURE_PLACEHOLDER_DATA = bytes(TEXTURE_PLACEHOLDER)
+
+
+class LazyGlTexture(GlTexture):
+    """Texture registered with its size only, image is uploaded by TextureStorage when it is requested.
+    GL texture is made at once with 1x1 placeholder image, so key never changes"""
+    __slots__ = ('source', 'state', 'last_used')
+
+    def __init__(self, size, tex_name):
+        self.source = tex_name
+        self.state = TEX_EVICTED
+        self.last_used = -1
+        super().__init__(TEXTURE_PLACEHOLDER_DATA, (1, 1), tex_name)
+        self.size = tuple(size)
+
+    def __repr__(self):
+        return f'<LazyGLTexture[{self.key}] state: {self.state} \t ' \
+               f'size: {self.size[0]}x{self.size[1]}px. \t name: "{self.name}">'
+
+    @property
+    def bytes(self) -> int:
+        return self.size[0] * self.size[1] * 4
+
+
 EssentialTextureStorage = TextureStorage()
 DynamicTextureStorage = TextureStorage()
 
 
-def loadTextures():
-    pack = loadTexturePack(STN_TEXTURE_PACK)
-    EssentialTextureStorage.load(pack)
+def loadTextures(wait=True):
+    """If not <wait>, textures are loaded while MainAssetPipeline is drained"""
+    job = loadTexturePack(STN_TEXTURE_PACK, EssentialTextureStorage)
+    if wait:
+        MainAssetPipeline.wait(job.name)
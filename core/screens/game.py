@@ -3,11 +3,13 @@ from user.KeyMapping import *
 from core.objects.gObjects import *
 from core.rendering.PyOGL import camera, preRender, postRender,\
     Shaders, drawGroupsFinally, LightingManager,\
-    RenderUpdateGroup_Instanced, RenderUpdateGroup_Materials, RenderUpdateGroup
+    RenderUpdateGroup_Instanced, RenderUpdateGroup_Materials, RenderUpdateGroup_Baked, RenderUpdateGroup
 from core.rendering.PyOGL_line import renderAllLines
 from core.rendering.Particles import ParticleManager
 # from core.rendering.TextRender import TextObject, DefaultFont
 from core.audio.PyOAL import AudioManagerSingleton
+from core.logic.game_logic import loadMap, LevelStreamer
+from utils.profiler import FrameProfiler
 
 import pygame
 from beartype import beartype
@@ -18,6 +20,7 @@ background_gr = RenderUpdateGroup(shader="BackgroundShader")    # BACKGROUND COL
 background_near_gr = RenderUpdateGroup()                        # BACKGROUND OBJECTS
 obstacles_gr = RenderUpdateGroup_Instanced()                    # DYNAMIC OBJECTS
 world_gr = RenderUpdateGroup_Materials()                        # WORLD GEOMETRY
+world_baked_gr = RenderUpdateGroup_Baked()                      # STATIC WORLD GEOMETRY OF LEVEL
 character_gr = RenderUpdateGroup()                              # ANIMATED CHARACTERS
 gui_gr = RenderUpdateGroup()                                    # GUI
 
@@ -25,6 +28,7 @@ gui_gr = RenderUpdateGroup()                                    # GUI
 hero_inited = False
 hero: MainHero  # MainHero object
 render_zone: Trigger
+level: LevelStreamer
 
 
 #  Keys that player is holding
@@ -54,6 +58,7 @@ def drawGroups(object_ids: tuple = ()):
         object_ids,
         character_gr,
         obstacles_gr,
+        world_baked_gr,
         world_gr,
         background_near_gr,
         background_gr,
@@ -67,18 +72,18 @@ def update(dt):
     if exit_code:
         return exit_code
 
-    # PHYSIC AND UPDATE [!!! PHYSICS UPDATE FIXED AND NOT BASED ON FPS !!!]
-    # TODO: JUST WARNING ^
-    dt = MainPhysicSpace.step(dt)
+    # PHYSIC AND UPDATE
+    # objects are updated with fixed physic step, effects with frame time
+    MainPhysicSpace.step(dt, updateGroups)
 
     LightingManager.update(dt)
-    updateGroups(dt)
     ParticleManager.update(dt)
+    level.update(camera)
 
     MainPhysicSpace.post_step()
 
     # SOUND
-    AudioManagerSingleton.update_listener(hero.pos, hero.body.velocity)
+    AudioManagerSingleton.update_listener(*MainPhysicSpace.state(hero.body))
 
 
 def userInput():
@@ -110,6 +115,12 @@ def userInput():
                 close()
                 return 'menu'
 
+            elif key == K_PROFILER:
+                FrameProfiler.toggle()
+
+            elif key == K_PROFILER_DUMP:
+                FrameProfiler.dump()
+
         elif event.type == pygame.KEYUP:
             key = event.key
 
@@ -144,18 +155,20 @@ def updateGroups(dt: float):
 
 
 def initScreen(hero_life=False, first_load=False):
-    global hero, hero_inited, render_zone
+    global hero, hero_inited, render_zone, level
     BackgroundColor(background_gr)
 
     #
     # #
     # # #
 
-    WorldRectangleRigid(world_gr, pos=[0, 500], size=[8192, 64], material=("r_pebble_grass_1", None))
-    WorldRectangleRigid(world_gr, pos=[850, 500], size=[200, 200], material=("r_magma_1", None))
-
-    # """This VVV is a way to the bright future"""
-    WorldRectangleRigidTrue(world_gr, pos=[-400, 660], size=[512, 256], material=("r_devs_1", None))
+    # World geometry is streamed by chunks, start chunk is loaded right now
+    # Level rectangles are baked into world_baked_gr
+    level = loadMap("test_map.json", {
+        "background_near_gr": background_near_gr,
+        "obstacles_gr": obstacles_gr,
+        "world_gr": world_gr,
+    }, world_baked_gr)
 
     for r in range(4):
         WoodenCrate(obstacles_gr, pos=[700, 800 + r*20])
@@ -207,11 +220,19 @@ def close():
     background_gr.delete_all()
     background_near_gr.delete_all()
     obstacles_gr.delete_all()
+    world_gr.delete_all()
+    world_baked_gr.delete_all()
     character_gr.delete_all()
     gui_gr.delete_all()
 
     # Delete physic bodies
     MainPhysicSpace.clear()
 
+    # Stop level streaming
+    level.close()
+
     # Delete light sources
     LightingManager.clear()
+
+    # Delete particles
+    ParticleManager.clear()
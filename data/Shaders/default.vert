@@ -1,21 +1,18 @@
 #version 460
-#constant uint MAX_INSTANCES
 
 layout(location = 0) in vec3 position;
 layout(location = 1) in vec4 color;
 layout(location = 2) in vec2 InTexCoords;
 
-uniform mat4 Scale;
-uniform mat4[MAX_INSTANCES] Transform;
+uniform mat4 Transform;
+uniform vec4 UVRect;  // u, v, width, height of texture on atlas page
 
 out vec4 Color;
 out vec2 TexCoords;
-flat out uint InstanceID;
 
 
 void main() {
-    gl_Position = vec4(position, 1.0) * Transform[gl_InstanceID];
+    gl_Position = vec4(position, 1.0) * Transform;
     Color = color;
-    TexCoords = InTexCoords;
-    InstanceID = gl_InstanceID;
+    TexCoords = UVRect.xy + InTexCoords * UVRect.zw;
 }
@@ -0,0 +1,16 @@
+#version 460
+#constant uint MAX_TEXTURES_BIND
+
+in vec4 Color;
+in vec2 TexCoords;
+flat in uint InstanceTex;
+
+out vec4 FragColor;
+
+uniform sampler2D Textures[MAX_TEXTURES_BIND];
+
+
+void main() {
+   vec4 base_color = texture( Textures[InstanceTex], TexCoords);
+   FragColor = base_color * Color;
+}
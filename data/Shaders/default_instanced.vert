@@ -0,0 +1,22 @@
+#version 460
+
+layout(location = 0) in vec3 position;
+layout(location = 1) in vec4 color;
+layout(location = 2) in vec2 InTexCoords;
+
+// per instance
+layout(location = 3) in mat4 Transform;  // locations 3 - 6
+layout(location = 7) in uint TexSlot;
+layout(location = 8) in vec4 UVRect;  // u, v, width, height of texture on atlas page
+
+out vec4 Color;
+out vec2 TexCoords;
+flat out uint InstanceTex;
+
+
+void main() {
+    gl_Position = vec4(position, 1.0) * Transform;
+    Color = color;
+    TexCoords = UVRect.xy + InTexCoords * UVRect.zw;
+    InstanceTex = TexSlot;
+}
@@ -6,6 +6,7 @@ layout(location = 2) in vec2 InTexCoords;
 
 uniform mat4 Scale;
 uniform mat4 Transform;
+uniform vec4 UVRect;  // u, v, width, height of texture on atlas page
 
 out vec4 Color;
 out vec2 TexCoords;
@@ -14,5 +15,5 @@ out vec2 TexCoords;
 void main() {
     gl_Position = vec4(position, 1.0) * Transform;
     Color = color;
-    TexCoords = InTexCoords;
+    TexCoords = UVRect.xy + InTexCoords * UVRect.zw;
 }
@@ -1,16 +1,35 @@
 #version 460
 #constant uint MAX_TEXTURES_BIND
+#constant uint SHADOW_MAX_LIGHTS
+#constant float SHADOW_SOFTNESS
 
 in vec2 TexCoords;
+in vec2 LocalPos;
 flat in vec4 Color;
 flat in uint StencilId;
 
 out vec4 diffuseColor;
 
 uniform sampler2D textures[MAX_TEXTURES_BIND];
-//  0 = light texture    1:MAX = stencil textures
+uniform sampler2D shadowMap;
+//  textures[0] = light texture
+//  shadowMap row StencilId - 1 = distances to occluders of this light, 0 = no shadow
+
+const float PI = 3.14159265;
+
+
+float shadow() {
+   if (StencilId == 0u) {
+      return 1.0;
+   }
+   float u = atan(LocalPos.y, LocalPos.x) / (2.0 * PI) + 0.5;
+   float v = (float(StencilId - 1u) + 0.5) / float(SHADOW_MAX_LIGHTS);
+   float occluder = texture(shadowMap, vec2(u, v)).r;
+   return 1.0 - smoothstep(occluder, occluder + SHADOW_SOFTNESS, length(LocalPos));
+}
+
 
 void main() {
    vec4 color = texture( textures[0], TexCoords ).a * Color;
-   diffuseColor = color;
+   diffuseColor = color * shadow();
 }
@@ -14,11 +14,13 @@ uniform uint sStencil[MAX_TEXTURES_BIND];
 flat out vec4 Color;
 flat out uint StencilId;
 out vec2 TexCoords;
+out vec2 LocalPos;  // units from light center, light rotation
 
 
 void main() {
     vec4 full_scale = vec4( sScale[gl_InstanceID], 1.0, 1.0 );
     gl_Position = vec4(position, 1.0) * full_scale * sTransform[gl_InstanceID];
+    LocalPos = position.xy * sScale[gl_InstanceID];
 
     Color = sColor[gl_InstanceID];
     TexCoords = InTexCoords;
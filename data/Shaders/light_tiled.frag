@@ -0,0 +1,59 @@
+#version 460
+#constant uint MAX_TEXTURES_BIND
+#constant uint LIGHT_TILE_SIZE
+#constant uint SHADOW_MAX_LIGHTS
+#constant float SHADOW_SOFTNESS
+
+struct Light {
+    vec4 rect;   // center x, y and half width, height, units
+    vec4 rot;    // cos, sin of rotation, texture slot, stencil
+    vec4 color;  // rgb, brightness
+};
+
+layout(std430, binding = 0) readonly buffer Lights { Light lights[]; };
+layout(std430, binding = 1) readonly buffer Tiles { uvec2 tiles[]; };  // offset and count in tileLights
+layout(std430, binding = 2) readonly buffer TileLights { uint tileLights[]; };
+
+uniform sampler2D textures[MAX_TEXTURES_BIND - 1u];
+uniform sampler2D shadowMap;  // row stencil - 1 = distances to occluders of light, 0 = no shadow
+uniform vec4 CameraRect;  // left, bottom, width, height of camera field, units
+uniform vec2 Viewport;    // px
+uniform uint TilesX;
+
+out vec4 diffuseColor;
+
+const float PI = 3.14159265;
+
+
+float shadow(uint stencil, vec2 local) {
+    if (stencil == 0u) {
+        return 1.0;
+    }
+    float u = atan(local.y, local.x) / (2.0 * PI) + 0.5;
+    float v = (float(stencil - 1u) + 0.5) / float(SHADOW_MAX_LIGHTS);
+    float occluder = texture(shadowMap, vec2(u, v)).r;
+    return 1.0 - smoothstep(occluder, occluder + SHADOW_SOFTNESS, length(local));
+}
+
+
+void main() {
+    uvec2 tile = uvec2(gl_FragCoord.xy) / LIGHT_TILE_SIZE;
+    uvec2 range = tiles[tile.y * TilesX + tile.x];
+    vec2 world = CameraRect.xy + gl_FragCoord.xy / Viewport * CameraRect.zw;
+
+    vec4 color = vec4(0.0);
+    for (uint i = range.x; i < range.x + range.y; i++) {
+        Light light = lights[tileLights[i]];
+
+        // into light quad space, rotated back, -1..1
+        vec2 d = world - light.rect.xy;
+        vec2 local = vec2(d.x * light.rot.x + d.y * light.rot.y, d.y * light.rot.x - d.x * light.rot.y) / light.rect.zw;
+        if (any(greaterThan(abs(local), vec2(1.0)))) continue;
+
+        // same texture coords as drawDataLightSource
+        vec2 uv = vec2(0.5 + 0.5 * local.x, 0.5 - 0.5 * local.y);
+        color += texture( textures[uint(light.rot.z)], uv ).a * light.color
+                 * shadow(uint(light.rot.w), local * light.rect.zw);
+    }
+    diffuseColor = color;
+}
@@ -1,6 +1,4 @@
 #version 460
-#constant uint MAX_TEXTURES_BIND
-#constant uint MAX_INSTANCES
 
 in vec4 Color;
 in vec3 TexCoords;
@@ -1,20 +1,20 @@
 #version 460
-#constant uint MAX_INSTANCES
 
 layout(location = 0) in vec3 position;
 layout(location = 1) in vec4 color;
 layout(location = 2) in vec2 InTexCoords;
 
-uniform mat4[MAX_INSTANCES] Transform;
-uniform vec2[MAX_INSTANCES] Scale;
-uniform uint[MAX_INSTANCES] Layer;
+// per instance
+layout(location = 3) in mat4 Transform;  // locations 3 - 6
+layout(location = 7) in vec2 Scale;
+layout(location = 8) in float Layer;
 
 out vec4 Color;
 out vec3 TexCoords;
 
 
 void main() {
-    gl_Position = vec4(position, 1.0) * Transform[gl_InstanceID];
+    gl_Position = vec4(position, 1.0) * Transform;
     Color = color;
-    TexCoords = vec3( InTexCoords * Scale[gl_InstanceID], Layer[gl_InstanceID]);
+    TexCoords = vec3( InTexCoords * Scale, Layer );
 }
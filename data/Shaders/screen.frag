@@ -1,5 +1,7 @@
 #version 410
 #constant float AMBIENT_LIGHT
+#constant uint LIGHT_BUFFER_SCALE
+#constant float LIGHT_UPSAMPLE_DEPTH
 
 in vec4 Color;
 in vec2 TexCoords;
@@ -12,13 +14,42 @@ uniform float brightness;
 out vec4 FragColor;
 
 
+// light buffer is smaller than screen, 4 nearest light texels are blended bilinearly,
+// texels which depth differs from depth of this pixel are weighted down, so light does not bleed over edges
+vec4 upsampleLight(float depth) {
+   if (LIGHT_BUFFER_SCALE == 1u) {
+      return texture(lightMap, TexCoords);
+   }
+
+   vec2 lightSize = vec2(textureSize(lightMap, 0));
+   vec2 texel = TexCoords * lightSize - 0.5;
+   vec2 base = floor(texel);
+   vec2 f = texel - base;
+
+   vec4 sum = vec4(0.0);
+   float weights = 0.0;
+   for (int i = 0; i < 4; i++) {
+      vec2 offset = vec2(i & 1, i >> 1);
+      vec2 uv = (base + offset + 0.5) / lightSize;
+      vec2 bilinear = mix(1.0 - f, f, offset);
+      float w = bilinear.x * bilinear.y * LIGHT_UPSAMPLE_DEPTH
+                / (LIGHT_UPSAMPLE_DEPTH + abs(texture(depthMap, uv).x - depth));
+
+      sum += texture(lightMap, uv) * w;
+      weights += w;
+   }
+   return weights > 0.0 ? sum / weights : texture(lightMap, TexCoords);
+}
+
+
 void main() {
-   vec4 lightColor = texture(lightMap, TexCoords);
+   float depth = texture(depthMap, TexCoords).x;
+
+   vec4 lightColor = upsampleLight(depth);
    float power = lightColor.a;
    lightColor = vec4(lightColor.xyz, 0);
 
    vec4 color = texture(samplerTex, TexCoords) * Color;
-   float depth = texture(depthMap, TexCoords).x;
 
    float intence = (power + AMBIENT_LIGHT) * depth;
 
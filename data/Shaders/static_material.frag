@@ -0,0 +1,12 @@
+#version 460
+
+in vec3 TexCoords;
+
+out vec4 FragColor;
+
+uniform sampler2DArray STexture;
+
+
+void main() {
+   FragColor = texture( STexture, TexCoords );
+}
@@ -0,0 +1,14 @@
+#version 460
+
+layout(location = 0) in vec3 position;      // world space
+layout(location = 1) in vec3 InTexCoords;   // u, v, layer of material array
+
+out vec3 TexCoords;
+
+uniform mat4 Transform;  // camera
+
+
+void main() {
+    gl_Position = vec4(position, 1.0) * Transform;
+    TexCoords = InTexCoords;
+}
@@ -1,13 +1,12 @@
 from core.Constants import FPS_LOCK, TITLE, FPS_SHOW, STN_WINDOW_RESOLUTION
 import pygame as pg
 from core.rendering.PyOGL import initDisplay
-from core.audio.PyOAL import AudioManagerSingleton
+from core.audio.PyOAL import AudioManagerSingleton, loadSounds
 from core.rendering.TextRender import loadText
-from core.rendering.Textures import loadTextures
+from core.rendering.Textures import loadTextures, EssentialTextureStorage
 from core.rendering.Materials import loadMaterials
-
-from cProfile import Profile
-Profile = Profile()
+from utils.profiler import FrameProfiler, profiled
+from utils.assets import MainAssetPipeline
 
 
 clock: pg.time.Clock
@@ -15,9 +14,15 @@ clock: pg.time.Clock
 
 def _main():
     initDisplay(STN_WINDOW_RESOLUTION)
-    loadText()
-    loadTextures()
-    loadMaterials()
+
+    # all packs are decoded at once, screen waits only for packs it needs (SCREEN_ASSETS),
+    # the rest is uploaded while it is shown
+    loadText(wait=False)
+    loadTextures(wait=False)
+    loadMaterials(wait=False)
+    loadSounds(wait=False)
+    # screen modules look up their textures when imported
+    MainAssetPipeline.wait('text', 'textures')
 
     global clock
 
@@ -28,64 +33,77 @@ def _main():
     clock = pg.time.Clock()
 
 
+def showLoadingProgress():
+    if MainAssetPipeline.finished():
+        pg.display.set_caption(TITLE)
+    else:
+        pg.display.set_caption(f'{TITLE} - loading {MainAssetPipeline.progress:.0%}')
+
+
 running = True
 screen_type = 'game'
-start_time = 0.0
-seconds = 0.0
 
+# jobs of MainAssetPipeline that must be finished before screen is initialized
+SCREEN_ASSETS = {'menu': ('text', 'textures'), 'game': ('text', 'textures', 'materials')}
 
+
+@profiled("frame")
 def gameLoop():
-    global running, screen_type, start_time, seconds
+    global running, screen_type
 
     #  Focus selected screen
     scr = screens[screen_type]
 
     # Visualization
-    scr.render()
+    with FrameProfiler.scope("render"):
+        scr.render()
 
     # Update screen
     dt = clock.tick(FPS_LOCK) / 1000
-    exit_code = scr.update(dt)
+    with FrameProfiler.scope("update"):
+        exit_code = scr.update(dt)
 
-    seconds += dt
     AudioManagerSingleton.clear_empty_sources()
-    if seconds >= 100:
-        seconds = 0.0
-        Profile.disable()
-        Profile.print_stats('cumtime', )
-        running = False
-
     AudioManagerSingleton.update_streams(dt)
 
+    if not MainAssetPipeline.finished():
+        with FrameProfiler.scope("assets"):
+            MainAssetPipeline.drain()
+        showLoadingProgress()
+
     # Screen feedback
     if exit_code in {'menu', 'game', 'Quit'}:
-        if exit_code == 'game':
-            seconds = 0.0
-
         if exit_code == 'Quit':
             running = False
 
         elif exit_code != screen_type:
             screen_type = exit_code
+            MainAssetPipeline.wait(*SCREEN_ASSETS[exit_code])
+            showLoadingProgress()
             screens[exit_code].initScreen()
 
     # End phase
-    pg.display.flip()
+    with FrameProfiler.scope("flip"):
+        pg.display.flip()
     if FPS_SHOW:
         print(f'\rFPS: {clock.get_fps() // 1}', end='')
 
 
 if __name__ == '__main__':
     _main()
-    Profile.enable()
 
     import core.screens.menu as rmenu
     import core.screens.game as rgame
     screens = {'menu': rmenu, 'game': rgame}
+    MainAssetPipeline.wait(*SCREEN_ASSETS[screen_type])
+    showLoadingProgress()
     screens[screen_type].initScreen(first_load=True)
 
     while running:
         gameLoop()
+        EssentialTextureStorage.end_frame()
+        FrameProfiler.frame_end()
 
     # finally
+    MainAssetPipeline.shutdown()
     AudioManagerSingleton.destroy()
@@ -16,3 +16,7 @@ K_MOVE_JUMP = pg.K_SPACE
 K_GRAB = pg.K_e
 K_ACTION1 = 1
 K_ACTION2 = 3
+
+# debug
+K_PROFILER = pg.K_F3  # enable / disable profiler
+K_PROFILER_DUMP = pg.K_F4  # print and save profile
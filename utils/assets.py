@@ -0,0 +1,129 @@
+"""
+Asset pipeline
+
+Loaders split their work into tasks of (decode, upload):
+    decode()        runs in worker pool: file reading, PNG and Vorbis decoding, glyph rasterization, JSON parsing
+    upload(result)  runs on main thread, which owns GL and AL contexts
+
+Finished decodes are put into completion queue, drain() uploads them on main thread
+within ASSET_UPLOAD_BUDGET per frame, wait() blocks until given jobs are done.
+Job calls its finish() on main thread after its last upload.
+
+    job = MainAssetPipeline.job("sounds", [(partial(decodeSound, path), partial(upload, name)) ...], finish)
+    MainAssetPipeline.drain()       # every frame
+    MainAssetPipeline.progress      # 0.0 - 1.0 of all jobs
+"""
+
+from core.Constants import ASSET_WORKERS, ASSET_UPLOAD_BUDGET
+from utils.debug import dprint
+
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from time import perf_counter
+from typing import Callable, Iterable, Tuple, Optional
+
+
+__all__ = [
+    'AssetJob',
+    'AssetPipeline',
+    'MainAssetPipeline'
+]
+
+
+class AssetJob:
+    """Tasks of one loader. New tasks can be added from upload of previous ones,
+    e.g. rasterization of texts after localization is parsed"""
+    __slots__ = ('name', 'total', 'done', 'finish', '_pipeline')
+
+    def __init__(self, pipeline: "AssetPipeline", name: str, finish: Optional[Callable] = None):
+        self.name = name
+        self.total = 0
+        self.done = 0
+        self.finish = finish
+        self._pipeline = pipeline
+
+    def __repr__(self):
+        return f'<AssetJob({self.name}) {self.done}/{self.total}>'
+
+    def add(self, decode: Callable, upload: Optional[Callable] = None):
+        """Must be called on main thread"""
+        self.total += 1
+        self._pipeline.submit(self, decode, upload)
+
+    @property
+    def finished(self) -> bool:
+        return self.done == self.total
+
+
+class AssetPipeline:
+    def __init__(self, workers: int = ASSET_WORKERS):
+        self.jobs = {}
+        self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="AssetPipeline")
+        self.__completed = Queue()
+
+    def __repr__(self):
+        return f'<AssetPipeline {list(self.jobs.values())}>'
+
+    def job(self, name: str, tasks: Iterable[Tuple[Callable, Optional[Callable]]] = (),
+            finish: Optional[Callable] = None) -> AssetJob:
+        """Starts job, job without tasks is finished at once"""
+        job = AssetJob(self, name, finish)
+        self.jobs[name] = job
+        for decode, upload in tasks:
+            job.add(decode, upload)
+
+        if job.finished:
+            self.__finish(job)
+        return job
+
+    def submit(self, job: AssetJob, decode: Callable, upload: Optional[Callable]):
+        future = self.__pool.submit(decode)
+        future.add_done_callback(lambda f: self.__completed.put((job, upload, f)))
+
+    def __process(self, job: AssetJob, upload, future):
+        # main thread
+        error = future.exception()
+        if error is not None:
+            raise error
+
+        if upload is not None:
+            upload(future.result())
+        job.done += 1
+        if job.finished:
+            self.__finish(job)
+
+    @staticmethod
+    def __finish(job: AssetJob):
+        if job.finish is not None:
+            job.finish()
+        dprint(f'-- {job.name} loaded')
+
+    def drain(self, budget: float = ASSET_UPLOAD_BUDGET):
+        """Uploads finished decodes on main thread, until <budget> seconds are spent"""
+        end = perf_counter() + budget
+        while perf_counter() < end:
+            try:
+                completed = self.__completed.get_nowait()
+            except Empty:
+                return
+            self.__process(*completed)
+
+    def wait(self, *names: str):
+        """Blocks until given jobs (all if none given) are finished, uploading on main thread meanwhile"""
+        while not self.finished(*names):
+            self.__process(*self.__completed.get())
+
+    def finished(self, *names: str) -> bool:
+        jobs = [self.jobs[name] for name in names] if names else self.jobs.values()
+        return all(job.finished for job in jobs)
+
+    @property
+    def progress(self) -> float:
+        total = sum(job.total for job in self.jobs.values())
+        return sum(job.done for job in self.jobs.values()) / total if total else 1.0
+
+    def shutdown(self):
+        self.__pool.shutdown(wait=False, cancel_futures=True)
+
+
+MainAssetPipeline = AssetPipeline()
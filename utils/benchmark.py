@@ -0,0 +1,193 @@
+"""
+Headless benchmark
+
+Builds seeded scene of WoodenCrates, light sources and particle bursts in hidden window
+and drives CPU side of a frame for fixed amount of frames with fixed frame time:
+
+    physics     World.step + group updates, World.post_step
+    lights      LightingManager.update
+    particles   ParticleManager.update
+    batching    RenderUpdateGroup.collect() and RenderQueue.build(), instance data of every draw call,
+                nothing is drawn
+
+Report is JSON: scene, throughput and per-stage timings in milliseconds.
+Final positions of bodies are summed into checksum, same seed must give same checksum.
+
+    python -m utils.benchmark --crates 500 --lights 64 --bursts 32 --frames 600 --out bench.json
+"""
+
+from core.Constants import PHYSIC_UPDATE_FREQUENCY, STN_WINDOW_RESOLUTION
+
+from time import perf_counter_ns
+import numpy as np
+import argparse
+import random
+import json
+import sys
+
+
+__all__ = [
+    'STAGES',
+    'runBenchmark'
+]
+
+
+STAGES = ('physics', 'lights', 'particles', 'batching')
+
+GROUND_WIDTH = 8192
+CRATE_SPACING = 80
+BURST_PARTICLES = 64
+
+
+def _init():
+    import pygame
+    from core.rendering.PyOGL import initDisplay
+    from core.rendering.Textures import loadTextures
+    from core.rendering.Materials import loadMaterials
+
+    pygame.init()
+    initDisplay(STN_WINDOW_RESOLUTION, hidden=True)
+    loadTextures()
+    loadMaterials()
+
+
+def _buildScene(crates: int, lights: int):
+    """:returns (groups, crates) of scene. Uses global random state, must be seeded before"""
+    from core.rendering.PyOGL import RenderUpdateGroup_Instanced, RenderUpdateGroup_Materials, LightingManager
+    from core.objects.gObjects import WorldRectangleRigid, WoodenCrate
+
+    obstacles_gr = RenderUpdateGroup_Instanced()
+    world_gr = RenderUpdateGroup_Materials()
+
+    WorldRectangleRigid(world_gr, pos=[0, 0], size=[GROUND_WIDTH, 64], material=["r_pebble_grass_1", None])
+
+    # crates are stacked in columns over the ground, jitter makes piles collapse differently
+    columns = max(1, int(crates ** 0.5))
+    width = GROUND_WIDTH / 2 - CRATE_SPACING
+    textures = ('LevelOne/crate', 'LevelOne/crate_metal')
+    objs = []
+    for i in range(crates):
+        column, row = i % columns, i // columns
+        x = -width + 2 * width * (column + 0.5) / columns + random.uniform(-8, 8)
+        y = 100 + row * CRATE_SPACING
+        objs.append(WoodenCrate(obstacles_gr, pos=[x, y], texture=textures[i % 2]))
+
+    for _ in range(lights):
+        pos = (random.uniform(-GROUND_WIDTH / 2, GROUND_WIDTH / 2), random.uniform(64, 1024))
+        LightingManager.newSource("Light/light_round", 0, pos=pos, size=random.uniform(10.0, 40.0), layer=1,
+                                  color="default", brightness=0.6)
+
+    return (obstacles_gr, world_gr), objs
+
+
+def _burst(x, y):
+    from core.rendering.PyOGL import LightingManager
+    from core.rendering.Particles import ParticleManager
+
+    ParticleManager.create_simple(0, (x, y), (BURST_PARTICLES, BURST_PARTICLES), (16, 96), (0.5, 1.0),
+                                  (0.8, 0.4, 0.1, 1.0), (4, 4), None, gravity=1.0)
+    LightingManager.newSource("Light/light_round", 1, pos=(x, y), power=30.0, layer=1,
+                              color="fire", brightness=1.0, time=1.0, peak=0.2)
+
+
+def _stats(ms: np.ndarray) -> dict:
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"mean": float(ms.mean()), "p50": float(p50), "p95": float(p95), "p99": float(p99),
+            "max": float(ms.max()), "total": float(ms.sum())}
+
+
+def runBenchmark(crates=200, lights=32, bursts=16, frames=600, warmup=60, seed=0) -> dict:
+    """Runs benchmark in current process, it must not have window opened before
+    :returns report"""
+    _init()
+
+    from core.rendering.PyOGL import camera, LightingManager, MainRenderQueue
+    from core.rendering.Particles import ParticleManager
+    from core.physic.physics import MainPhysicSpace
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    groups, objs = _buildScene(crates, lights)
+    MainPhysicSpace.post_step()
+
+    camera.focus_to(0.0, 512.0, soft=0.0)
+    camera.prepare_matrix()
+
+    def substep(step_dt):
+        for gr in groups:
+            gr.update(step_dt)
+
+    # bursts are spread evenly over measured frames
+    burst_frames = {warmup + i * frames // bursts for i in range(bursts)} if bursts else set()
+    dt = PHYSIC_UPDATE_FREQUENCY
+    times = np.zeros((frames, len(STAGES)), dtype=np.int64)
+    steps = particles = 0
+
+    for frame in range(warmup + frames):
+        if frame in burst_frames:
+            _burst(random.uniform(-GROUND_WIDTH / 4, GROUND_WIDTH / 4), random.uniform(128, 768))
+
+        t0 = perf_counter_ns()
+        made = MainPhysicSpace.step(dt, substep)
+        MainPhysicSpace.post_step()
+        t1 = perf_counter_ns()
+        LightingManager.update(dt)
+        t2 = perf_counter_ns()
+        ParticleManager.update(dt)
+        t3 = perf_counter_ns()
+        for gr in groups:
+            gr.collect(MainRenderQueue)
+        MainRenderQueue.build()
+        MainRenderQueue.clear()
+        t4 = perf_counter_ns()
+
+        if frame >= warmup:
+            times[frame - warmup] = (t1 - t0, t2 - t1, t3 - t2, t4 - t3)
+            steps += made
+            particles += sum(len(pool) for pools in (ParticleManager.simple, ParticleManager.physic)
+                             for pool in pools.values())
+
+    ms = times / 1e6
+    frame_ms = ms.sum(axis=1)
+    seconds = frame_ms.sum() / 1e3
+    alive = [obj for obj in objs if obj.body.snapshot_index != -1]
+    checksum = float(np.sum([tuple(obj.body.position) for obj in alive])) if alive else 0.0
+
+    return {
+        "scene": {"crates": crates, "lights": lights, "bursts": bursts, "frames": frames,
+                  "warmup": warmup, "seed": seed, "dt": dt},
+        "throughput": {
+            "frames_per_second": frames / seconds if seconds else 0.0,
+            "physic_steps_per_second": steps / seconds if seconds else 0.0,
+            "body_steps_per_second": steps * len(alive) / seconds if seconds else 0.0,
+            "particle_updates_per_second": particles / seconds if seconds else 0.0,
+        },
+        "frame": _stats(frame_ms),
+        "stages": {name: _stats(ms[:, i]) for i, name in enumerate(STAGES)},
+        "checksum": checksum,
+    }
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless CPU benchmark of physics, lights, particles and batching")
+    parser.add_argument('--crates', type=int, default=200)
+    parser.add_argument('--lights', type=int, default=32)
+    parser.add_argument('--bursts', type=int, default=16)
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--warmup', type=int, default=60)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help="JSON file, stdout if not given")
+    args = parser.parse_args(argv)
+
+    report = runBenchmark(args.crates, args.lights, args.bursts, args.frames, args.warmup, args.seed)
+    if args.out is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.out, mode='w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    _main()
@@ -8,7 +8,12 @@ from typing import Union
 
 from PIL import ImageFont
 import pygame as pg
+import numpy as np
+import hashlib
+import struct
 import json
+import zlib
+import mmap
 
 import os
 import shutil
@@ -25,6 +30,10 @@ SOUNDS_DIRECTORY = join(MAIN_DIRECTORY, 'data/Sounds')
 SETTINGS_FILE = join(MAIN_DIRECTORY, 'data/settings.json')
 MAPS_DIRECTORY = join(MAIN_DIRECTORY, 'data/Maps')
 MATERIALS_DIRECTORY = join(MAIN_DIRECTORY, 'data/Materials')
+PROFILES_DIRECTORY = join(MAIN_DIRECTORY, 'data/Profiles')
+CACHE_DIRECTORY = join(MAIN_DIRECTORY, 'data/Cache')
+
+IMAGE_CACHE_VERSION = 1  # increase when layout of image cache changes
 
 
 DIRECTORIES = {'main': MAIN_DIRECTORY,
@@ -35,7 +44,9 @@ DIRECTORIES = {'main': MAIN_DIRECTORY,
                'font': FONTS_DIRECTORY,
                'snd': SOUNDS_DIRECTORY,
                'maps': MAPS_DIRECTORY,
-               'mat': MATERIALS_DIRECTORY}
+               'mat': MATERIALS_DIRECTORY,
+               'prof': PROFILES_DIRECTORY,
+               'cache': CACHE_DIRECTORY}
 
 
 def get_full_path(*path, file_type='main'):
@@ -77,6 +88,15 @@ def load_image(name, pack):
         return None, ()
 
 
+def image_size(path) -> tuple:
+    """Size of image without decoding it, only header is read for png"""
+    with open(path, mode="rb") as file:
+        head = file.read(24)
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return struct.unpack(">II", head[16:24])
+    return pg.image.load(path).get_size()
+
+
 def load_font(name, size, index) -> Union[ImageFont.FreeTypeFont, ImageFont.ImageFont]:
     fullname = get_full_path(name, file_type='font')
 
@@ -111,16 +131,94 @@ def load_text_localization(file: str = None, key: str = None):
         raise ValueError('Provide only one of given args: file, key')
 
 
-def load_map(name):
+LEGACY_MAP_MATERIAL = ["r_devs_1", None]  # material of level rectangles of legacy .lvl maps, they had none
+LEGACY_MAP_CASTS = {'float': float, 'int': int, 'str': str, 'bool': lambda v: v == 'True'}
+
+
+def _legacy_map(data: bytes) -> dict:
+    """Header with inlined chunks (.json layout) of legacy .lvl map: one zlib compressed text of lines
+        <id> <type> <group or none> <x> <y> [<args> ...]     object, WorldRectangle* args are <w> <h> [<layer>]
+        [<id>:<key>:<value>:<type>]                         extra kwarg of object <id>
+    Legacy maps have no chunks, all objects are put into start chunk 0.0"""
+    entries = {}
+    for line in zlib.decompress(data).decode().splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        if line[0] == '[':
+            idd, key, value, type_ = line[1:-1].split(':')
+            entries[idd]["kwargs"][key] = LEGACY_MAP_CASTS[type_](value)
+            continue
+
+        idd, type_, group, *values = line.split()
+        numbers = [float(v) for v in values if v.lstrip('-').replace('.', '', 1).isdigit()]
+        args = [] if group == 'none' else [group]
+        kwargs = {"pos": numbers[:2]}
+        if type_.startswith('WorldRectangle'):
+            kwargs["size"] = numbers[2:4]
+            kwargs["material"] = list(LEGACY_MAP_MATERIAL)
+            if len(numbers) > 4:
+                kwargs["layer"] = int(numbers[4])
+        else:
+            args += values[2:]
+        entries[idd] = {"type": type_, "args": args, "kwargs": kwargs}
+
+    return {"start_chunk": "0.0", "chunks": {"0.0": list(entries.values())}}
+
+
+def load_map(name) -> dict:
+    """Loads map header
+    .json   chunks are stored in header as lists of object entries
+    .lvl    first line is json header, it is followed by zlib compressed json chunks,
+            header["chunks"] maps chunk key to [offset, length] of its compressed data.
+            Legacy .lvl maps (one zlib compressed text, see _legacy_map) are loaded with inlined chunks"""
     fullname = get_full_path(name, file_type='maps')
-    if os.path.exists(fullname):
-        # TODO: MAPS SHOULD BE COMPRESSED AS FILES
-        # HERE YOU SHOULD DECOMPRESS THEM
-
-        with open(fullname, mode="r") as file:
-            return file.readlines()
-
-    raise FileExistsError(f'Not Found: {fullname}')
+    if not os.path.exists(fullname):
+        raise FileExistsError(f'Not Found: {fullname}')
+
+    if fullname.endswith(".lvl"):
+        with open(fullname, mode="rb") as file:
+            line = file.readline()
+            if not line.startswith(b'{'):
+                return _legacy_map(line + file.read())
+        header = json.loads(line)
+        header["data_offset"] = len(line)
+        return header
+
+    with open(fullname, mode="r") as file:
+        return json.load(file)
+
+
+def load_map_chunk(name, header: dict, key: str) -> list:
+    """Returns object entries of chunk. Safe to call from background thread"""
+    chunk = header["chunks"][key]
+    if "data_offset" not in header:
+        return chunk
+
+    offset, length = chunk
+    with open(get_full_path(name, file_type='maps'), mode="rb") as file:
+        file.seek(header["data_offset"] + offset)
+        return json.loads(zlib.decompress(file.read(length)))
+
+
+def save_map(name, header: dict):
+    """Saves map with inlined chunks (.json layout) as .lvl"""
+    header = dict(header)
+    blobs = []
+    offset = 0
+    chunks = {}
+    for key, entries in header["chunks"].items():
+        blob = zlib.compress(json.dumps(entries).encode())
+        chunks[key] = [offset, len(blob)]
+        offset += len(blob)
+        blobs.append(blob)
+    header["chunks"] = chunks
+
+    with open(get_full_path(name, file_type='maps'), mode="wb") as file:
+        file.write(json.dumps(header).encode() + b"\n")
+        for blob in blobs:
+            file.write(blob)
 
 
 def load_material_preset(name: str, pack: str = None):
@@ -148,3 +246,95 @@ def load_material_texture(name: str, pack: str = None):
         return data, image.get_size()
     else:
         return None, ()
+
+
+def _file_hash(path) -> str:
+    with open(path, mode="rb") as file:
+        return hashlib.blake2b(file.read(), digest_size=16).hexdigest()
+
+
+def _read_image_cache(fullname):
+    """:returns (header, mmap) of cache file, (None, None) if it is missing or of other version"""
+    if not os.path.exists(fullname):
+        return None, None
+
+    with open(fullname, mode="rb") as file:
+        line = file.readline()
+        try:
+            header = json.loads(line)
+        except ValueError:
+            return None, None
+        if header.get("version") != IMAGE_CACHE_VERSION:
+            return None, None
+        header["data_offset"] = len(line)
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(fullname) > len(line) else b''
+    return header, data
+
+
+def _write_image_cache(fullname, entries: dict, blobs: list):
+    """Same layout as .lvl maps: first line is json header, it is followed by raw RGBA images,
+    header["entries"] maps image name to its source stamp and offset, width and height of data"""
+    os.makedirs(dirname(fullname), exist_ok=True)
+    header = json.dumps({"version": IMAGE_CACHE_VERSION, "entries": entries}).encode() + b"\n"
+
+    # written next to old cache and swapped, so interrupted write does not leave broken cache
+    temp = fullname + ".tmp"
+    with open(temp, mode="wb") as file:
+        file.write(header)
+        for blob in blobs:
+            file.write(blob)
+    try:
+        os.replace(temp, fullname)
+    except PermissionError:
+        # old cache is still mapped (Windows), it is rebuilt on next start
+        os.remove(temp)
+
+
+class ImageCache:
+    """Decoded RGBA images of pack, stored in one cache file in data/Cache and memory-mapped.
+    Entry is valid while mtime and size of its source match, if they do not, source hash is compared,
+    so touched but unchanged files are not decoded again"""
+
+    def __init__(self, cache_name: str):
+        self.fullname = get_full_path(f"{cache_name}.cache", file_type='cache')
+        self.header, self.data = _read_image_cache(self.fullname)
+        self.entries = self.header["entries"] if self.header else {}
+        self.stamps = {}  # image name -> entry of image returned by get
+        self.changed = self.header is None
+
+    def get(self, name: str, path: str):
+        """Safe to call from worker threads
+        :returns (RGBA data, (width, height)), data of valid entry is uint8 array over mapped cache"""
+        stat = os.stat(path)
+        entry = self.entries.get(name)
+        if entry is not None and (entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size):
+            digest = _file_hash(path)
+            entry = dict(entry, mtime=stat.st_mtime_ns, size=stat.st_size) if entry["hash"] == digest else None
+            self.changed = True
+
+        if entry is not None:
+            data = np.frombuffer(self.data, dtype=np.uint8, count=entry["width"] * entry["height"] * 4,
+                                 offset=self.header["data_offset"] + entry["offset"])
+        else:
+            image = pg.image.load(path)
+            data = pg.image.tostring(image, 'RGBA')
+            entry = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": _file_hash(path),
+                     "width": image.get_width(), "height": image.get_height()}
+            self.changed = True
+
+        self.stamps[name] = entry
+        return data, (entry["width"], entry["height"])
+
+    def save(self, images: dict):
+        """Rewrites cache file if any image was decoded again or set of images changed
+        ::arg images    image name -> (data, size) returned by get"""
+        if not self.changed and images.keys() == self.entries.keys():
+            return
+
+        entries = {}
+        offset = 0
+        for name, (data, _) in images.items():
+            entries[name] = dict(self.stamps[name], offset=offset)
+            offset += len(data)
+        _write_image_cache(self.fullname, entries, [data for data, _ in images.values()])
+
@@ -0,0 +1,189 @@
+"""
+Frame profiler
+
+Scoped timers of hot paths, switchable at runtime:
+
+    with FrameProfiler.scope("physics"):
+        ...
+
+    @profiled("particles.update")
+    def update(self, dt): ...
+
+While disabled every timer costs one attribute check.
+While enabled time of each stage is summed per frame, frame_end() moves sums
+into ring buffer of PROFILER_FRAMES frames, report() gives p50 / p95 / p99 of each stage.
+Every timed scope is also kept as Chrome trace event (chrome://tracing, ui.perfetto.dev),
+dump() writes report and trace into data/Profiles
+"""
+
+from core.Constants import PROFILER_ENABLED, PROFILER_FRAMES, PROFILER_MAX_STAGES, PROFILER_TRACE_EVENTS
+from utils.files import get_full_path
+
+from collections import deque
+from functools import wraps
+from time import perf_counter_ns, strftime
+import numpy as np
+import json
+import os
+
+
+__all__ = [
+    'FrameProfiler',
+    'profiled'
+]
+
+
+class _Scope:
+    """Timer of one stage. Reused, so scopes with the same name must not be nested"""
+    __slots__ = ('profiler', 'column', 'name', 'start')
+
+    def __init__(self, profiler, column, name):
+        self.profiler = profiler
+        self.column = column
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = perf_counter_ns() if self.profiler.enabled else 0
+        return self
+
+    def __exit__(self, *exc):
+        if self.start:
+            self.profiler.add(self.column, self.name, self.start, perf_counter_ns())
+
+
+class __FrameProfiler:
+    __instance = None
+
+    def __init__(self):
+        self.enabled = PROFILER_ENABLED
+
+        self.__scopes = {}
+        self.stages = []
+        """names of stages, index is column in frames"""
+
+        self.frames = np.zeros((PROFILER_FRAMES, PROFILER_MAX_STAGES), dtype=np.float32)
+        """ring buffer, milliseconds spent in stage per frame"""
+        self.frames_count = 0
+        self.__current = [0] * PROFILER_MAX_STAGES  # nanoseconds of current frame
+
+        self.events = deque(maxlen=PROFILER_TRACE_EVENTS)
+        """(name, start ns, end ns) for Chrome trace"""
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__instance is None:
+            cls.__instance = super().__new__(cls)
+        return cls.__instance
+
+    # SWITCH
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        print(f'Profiler {"enabled" if self.enabled else "disabled"}')
+
+    def reset(self):
+        self.frames[:] = 0.0
+        self.frames_count = 0
+        self.__current = [0] * PROFILER_MAX_STAGES
+        self.events.clear()
+
+    # RECORDING
+    def column(self, name: str) -> int:
+        scope = self.__scopes.get(name)
+        if scope is not None:
+            return scope.column
+        if len(self.stages) == PROFILER_MAX_STAGES:
+            raise OverflowError(f'Profiler can not track more than {PROFILER_MAX_STAGES} stages')
+        self.stages.append(name)
+        return len(self.stages) - 1
+
+    def scope(self, name: str) -> _Scope:
+        scope = self.__scopes.get(name)
+        if scope is None:
+            scope = _Scope(self, self.column(name), name)
+            self.__scopes[name] = scope
+        return scope
+
+    def add(self, column: int, name: str, start: int, end: int):
+        self.__current[column] += end - start
+        self.events.append((name, start, end))
+
+    def add_sample(self, name: str, nanoseconds: int):
+        """Adds time, measured outside of CPU timers (e.g. GPU queries), to current frame"""
+        if self.enabled:
+            self.__current[self.scope(name).column] += nanoseconds
+
+    def frame_end(self):
+        if not self.enabled:
+            return
+        self.frames[self.frames_count % PROFILER_FRAMES] = self.__current
+        self.frames[self.frames_count % PROFILER_FRAMES] /= 1e6
+        self.frames_count += 1
+        self.__current = [0] * PROFILER_MAX_STAGES
+
+    # OUTPUT
+    def report(self) -> dict:
+        """:returns {stage: {"p50": ms, "p95": ms, "p99": ms}} over recorded frames"""
+        n = min(self.frames_count, PROFILER_FRAMES)
+        if not n or not self.stages:
+            return {}
+
+        frames = self.frames[:n, :len(self.stages)]
+        p50, p95, p99 = np.percentile(frames, [50, 95, 99], axis=0)
+        return {
+            name: {"p50": float(p50[i]), "p95": float(p95[i]), "p99": float(p99[i])}
+            for i, name in enumerate(self.stages)
+        }
+
+    def print_report(self):
+        print(f'\n-- Profiler: {min(self.frames_count, PROFILER_FRAMES)} frames (ms)')
+        print(f'{"stage":<32}{"p50":>9}{"p95":>9}{"p99":>9}')
+        for name, p in self.report().items():
+            print(f'{name:<32}{p["p50"]:>9.3f}{p["p95"]:>9.3f}{p["p99"]:>9.3f}')
+
+    def trace(self) -> dict:
+        """Chrome trace event format, complete ("X") events in microseconds"""
+        if not self.events:
+            return {"traceEvents": []}
+        first = self.events[0][1]
+        return {"traceEvents": [
+            {"name": name, "ph": "X", "pid": 0, "tid": 0, "ts": (start - first) / 1e3, "dur": (end - start) / 1e3}
+            for name, start, end in self.events
+        ]}
+
+    def dump(self):
+        """Prints report and writes report and Chrome trace to data/Profiles"""
+        self.print_report()
+
+        directory = get_full_path(file_type='prof')
+        os.makedirs(directory, exist_ok=True)
+        stamp = strftime("%Y%m%d_%H%M%S")
+
+        with open(os.path.join(directory, f'report_{stamp}.json'), mode='w') as file:
+            json.dump(self.report(), file, indent=2)
+        with open(os.path.join(directory, f'trace_{stamp}.json'), mode='w') as file:
+            json.dump(self.trace(), file)
+        print(f'Profile saved: {directory}')
+
+
+FrameProfiler = __FrameProfiler()
+
+
+def profiled(name: str):
+    """Decorator, times every call of function as stage <name>"""
+    scope = FrameProfiler.scope(name)
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not FrameProfiler.enabled:
+                return function(*args, **kwargs)
+            with scope:
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator